@@ -0,0 +1,269 @@
+"""Offline benchmarks for main.py.
+
+    python bench.py shards [updates]    end-to-end throughput vs shard worker count (stub Bot API)
+    python bench.py sessions [count]    per-session memory and access cost, dict vs Session
+    python bench.py keys [rounds]       key extraction per caption, single regex vs KeyExtractor
+
+Nothing here talks to Telegram. State files go to a temporary directory.
+"""
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BENCH_DIR = tempfile.mkdtemp(prefix="tkbench-")
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("DEDUP_DB_PATH", os.path.join(BENCH_DIR, "dedup.db"))
+os.environ.setdefault("SESSION_SNAPSHOT_PATH", os.path.join(BENCH_DIR, "sessions.snap"))
+
+import main
+from telegram import Update
+
+# --- Sharded dispatch ---
+# Runs main.py as it is deployed (front process + SHARD_WORKERS workers, or
+# plain polling for 1) against a stub Bot API served from this process.
+# Once every process has called getMe, getUpdates hands out a backlog of
+# /start messages from distinct users, and the clock stops when every reply
+# has come back as sendMessage. That covers the front's routing, the queues,
+# the workers' Application with all its hooks and the shared outbound
+# limiter, whose rates are raised so only the CPU path is measured.
+# Scaling needs as many free cores as workers, plus one for the stub.
+
+def fake_update(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+        }
+    }
+
+class StubBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like api.telegram.org
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        params = {name: values[0] for name, values in parse_qs(body).items()}
+        payload = json.dumps({"ok": True, "result": self.server.answer(method, params)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+class StubBotApi(ThreadingHTTPServer):
+    """Answers the Bot API methods main.py calls; getUpdates serves a fixed backlog."""
+    daemon_threads = True
+
+    def __init__(self, updates: list, processes: int):
+        super().__init__(("127.0.0.1", 0), StubBotApiHandler)
+        self.updates = updates
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.started = 0
+        self.sent = 0
+        self.first_batch = None
+        self.replied = threading.Event()
+
+    def handle_error(self, request, client_address):
+        pass  # a stopping bot hangs up on its open long poll
+
+    def answer(self, method: str, params: dict):
+        if method == "getMe":
+            with self.lock:
+                self.started += 1
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            offset = int(params.get("offset", 0))
+            batch = self.updates[offset:offset + 100] if self.started >= self.processes else []
+            if not batch:
+                time.sleep(min(float(params.get("timeout", 0)), 0.2))
+            elif self.first_batch is None:
+                self.first_batch = time.perf_counter()
+            return batch
+        if method == "sendMessage":
+            with self.lock:
+                self.sent += 1
+                if self.sent == len(self.updates):
+                    self.replied.set()
+            return {"message_id": self.sent, "date": 0, "text": "",
+                    "chat": {"id": int(params["chat_id"]), "type": "private"}}
+        return True
+
+def run_sharded(workers: int, total: int) -> float:
+    server = StubBotApi([fake_update(i, 1000 + i) for i in range(total)], workers + (workers > 1))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    run_dir = tempfile.mkdtemp(dir=BENCH_DIR)
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(main.__file__)), "config.json"), run_dir)
+    env = dict(
+        os.environ,
+        BOT_API_URL=f"http://127.0.0.1:{server.server_address[1]}/bot",
+        SHARD_WORKERS=str(workers),
+        STATE_BACKEND="sqlite",
+        STATE_DB_PATH=os.path.join(run_dir, "state.db"),
+        DEDUP_DB_PATH=os.path.join(run_dir, "dedup.db"),
+        SESSION_SNAPSHOT_PATH=os.path.join(run_dir, "sessions.snap"),
+        BOT_API_GLOBAL_RATE="1000000",
+        BOT_API_PRIVATE_CHAT_RATE="1000000",
+        HEALTH_API_PROBE_INTERVAL="0",
+    )
+    bot = subprocess.Popen([sys.executable, os.path.abspath(main.__file__)], cwd=run_dir, env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not server.replied.wait(timeout=300):
+            raise RuntimeError(f"{workers} workers: only {server.sent}/{total} replies arrived")
+        return total / (time.perf_counter() - server.first_batch)
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            bot.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        server.shutdown()
+
+def bench_shards(total: int = 5000):
+    cores = len(os.sched_getaffinity(0))
+    baseline = None
+    print(f"Sharded end to end, {total} /start updates from {total} users, {cores} cores")
+    for workers in sorted({1, 2, 4, cores}):
+        rate = run_sharded(workers, total)
+        baseline = baseline or rate
+        print(f"  {workers:>2} workers: {rate:>7.0f} updates/s  ({rate / baseline:.2f}x)")
+
+# --- Session memory ---
+# Builds the same sessions both ways: the old free-form dict (every key the
+# handlers used to set, as they set them) and the slotted Session. "idle" is
+# a user who picked a method; "batch" is a Method 2 user holding two APKs.
+
+def dict_session(files: int) -> dict:
+    state = {"status": "normal", "current_method": "method2", "key_mode": "normal",
+             "waiting_key": False, "quote_applied": False, "mono_applied": False,
+             "session_files": [], "session_filenames": [], "session_unique_ids": [],
+             "apk_posts": [], "last_apk_time": None, "last_post_link": None,
+             "saved_key": None, "progress_message_id": None, "preview_message_id": None}
+    for n in range(files):
+        state["session_files"].append(f"file{n}")
+        state["session_filenames"].append(f"app{n}.apk")
+        state["session_unique_ids"].append(f"uniq{n}")
+    return state
+
+def slotted_session(files: int) -> main.Session:
+    session = main.Session(current_method="method2")
+    for n in range(files):
+        session.add_file(f"file{n}", f"app{n}.apk", f"uniq{n}")
+    return session
+
+def measure(build, count: int) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = [build() for _ in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del sessions
+    return used / count
+
+def bench_sessions(count: int = 100000):
+    print(f"Session memory, {count} sessions")
+    for label, files in (("idle", 0), ("batch", 2)):
+        old = measure(lambda: dict_session(files), count)
+        new = measure(lambda: slotted_session(files), count)
+        print(f"  {label:<5} dict {old:>6.0f} B  Session {new:>6.0f} B  ({new / old:.2f}x)")
+
+    state, session, normal = dict_session(2), slotted_session(2), main.SessionStatus.NORMAL
+    old = min(timeit.repeat(lambda: state["status"] == "normal" and state["waiting_key"], number=count, repeat=5))
+    new = min(timeit.repeat(lambda: session.status is normal and session.waiting_key, number=count, repeat=5))
+    print(f"  read  dict {old / count * 1e9:>6.1f} ns  Session {new / count * 1e9:>6.1f} ns")
+
+# --- Key extraction ---
+# Captions as they arrive from source channels: emoji headers, the key in
+# different formats, sometimes in a code entity (given as str spans here,
+# which is what caption_code_spans produces), sometimes several keys.
+
+KEY_CAPTIONS = [
+    ("🔥 New update is live!\n\n📦 Version 4.2.1\nKey - A1B2C3D4\n\n⚡ Join @channel", ()),
+    ("✅ Fresh build uploaded\nKey: QWERTY-1234\n🔒 Valid for 24h", ()),
+    ("🎁 Giveaway\nPassword - hunter2\nShare with friends ❤️", ()),
+    ("🚀 Premium unlocked\nKey - XYZ987 SECOND", ((25, 38),)),
+    ("📢 Two builds today\nKey - ARM64KEY\nKey - ARMV7KEY\nKey - X86KEY", ()),
+    ("🛠 Maintenance release, no key needed this time. Enjoy and report bugs in the group!", ()),
+]
+
+def single_pattern(caption: str):
+    match = re.search(r'Key\s*-\s*(\S+)', caption)
+    return [match.group(1)] if match else []
+
+def per_pattern_keys(patterns, caption: str):
+    # Same result as KeyExtractor.extract without code spans: one finditer
+    # per pattern, merged back into caption order and de-duplicated
+    matches = [match for pattern in patterns for match in pattern.finditer(caption)]
+    matches.sort(key=lambda match: match.start())
+    keys = []
+    for match in matches:
+        if match.group(1) not in keys:
+            keys.append(match.group(1))
+    return keys
+
+def alternation_finditer_keys(regex, caption: str):
+    keys = []
+    for match in regex.finditer(caption):
+        key = match.group(match.lastindex)
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+def bench_keys(rounds: int = 20000):
+    extractor = main.DEFAULT_KEY_EXTRACTOR
+    patterns = [re.compile(pattern) for pattern in main.DEFAULT_KEY_PATTERNS]
+    print(f"Key extraction, {len(KEY_CAPTIONS)} captions x {rounds} rounds")
+    for caption, spans in KEY_CAPTIONS:
+        print(f"  {single_pattern(caption)!s:<14} -> {extractor.extract(caption, spans)}")
+        if not spans:
+            assert per_pattern_keys(patterns, caption) == extractor.extract(caption)
+            assert alternation_finditer_keys(extractor.regex, caption) == extractor.extract(caption)
+
+    captions = [caption for caption, _ in KEY_CAPTIONS]
+    per_caption = rounds * len(KEY_CAPTIONS)
+    variants = [
+        ("single regex", "first 'Key -' only", lambda: [single_pattern(c) for c in captions]),
+        ("bare findalls", "one per format, unordered, repeats", lambda: [[p.findall(c) for p in patterns] for c in captions]),
+        ("per pattern", "one finditer per format, merged", lambda: [per_pattern_keys(patterns, c) for c in captions]),
+        ("alternation", "finditer + lastindex", lambda: [alternation_finditer_keys(extractor.regex, c) for c in captions]),
+        ("KeyExtractor", "findall on the alternation", lambda: [extractor.extract(c) for c in captions]),
+    ]
+    for label, note, run in variants:
+        best = min(timeit.repeat(run, number=rounds, repeat=5))
+        print(f"  {label:<14}{best / per_caption * 1e9:>7.0f} ns / caption ({note})")
+    spans = min(timeit.repeat(lambda: [extractor.extract(c, s) for c, s in KEY_CAPTIONS], number=rounds, repeat=5))
+    print(f"  {'+ code spans':<14}{spans / per_caption * 1e9:>7.0f} ns / caption (KeyExtractor, entities as given)")
+
+BENCHMARKS = {
+    "shards": bench_shards,
+    "sessions": bench_sessions,
+    "keys": bench_keys,
+}
+
+if __name__ == "__main__":
+    name = sys.argv[1] if len(sys.argv) > 1 else "shards"
+    args = [int(arg) for arg in sys.argv[2:]]
+    if name not in BENCHMARKS:
+        sys.exit(f"unknown benchmark {name!r}, choose from: {', '.join(BENCHMARKS)}")
+    BENCHMARKS[name](*args)
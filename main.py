@@ -1,37 +1,166 @@
 import json
 import time
 import datetime
-import random
 import os
+import sys
 import re
 import traceback
+import logging
+import logging.handlers
+import contextvars
+import copy
+import atexit
 import asyncio
-from telegram.error import BadRequest
+import sqlite3
+import struct
+import heapq
+import itertools
+import html
+import hashlib
+import enum
+import abc
+import bisect
+import functools
+import hmac
+import secrets
+import signal
+import multiprocessing
+from queue import Empty, Full, Queue
+from collections import deque, OrderedDict
+import zlib
+from telegram.error import BadRequest, RetryAfter
 from telegram.constants import ParseMode
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaDocument
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes
+from telegram.helpers import escape_markdown
+from telegram import Bot, Update, MessageEntity, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaDocument
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, ExtBot, CommandHandler, MessageHandler, TypeHandler, filters, CallbackQueryHandler, ContextTypes
+
+# --- Logging ---
+# Records are handed to a bounded queue on the event loop and formatted as
+# JSON lines and written by a QueueListener thread, so a slow stdout never
+# stalls the loop (a full queue drops the record and counts it instead).
+# Context variables attach the current user id, setup and update id to
+# every record. Per-logger levels come from LOG_LEVELS, e.g.
+# "trailkeys.autoforward=DEBUG,httpx=WARNING". Records logged with
+# extra={"sample": <name>} keep only 1 in LOG_SAMPLE_EVERY per name.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "httpx=WARNING")
+LOG_SAMPLE_EVERY = max(1, int(os.getenv("LOG_SAMPLE_EVERY", "10")))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_STATS = {"queued": 0, "dropped": 0, "sampled_out": 0}
+
+LOG_USER_ID = contextvars.ContextVar("log_user_id", default=None)
+LOG_SETUP = contextvars.ContextVar("log_setup", default=None)
+LOG_UPDATE_ID = contextvars.ContextVar("log_update_id", default=None)
+
+class LogContextFilter(logging.Filter):
+    def filter(self, record):
+        record.user_id = LOG_USER_ID.get()
+        record.setup = LOG_SETUP.get()
+        record.update_id = LOG_UPDATE_ID.get()
+        return True
+
+class LogSamplingFilter(logging.Filter):
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self.counts = {}
+
+    def filter(self, record):
+        name = getattr(record, "sample", None)
+        if name is None:
+            return True
+        count = self.counts.get(name, 0)
+        self.counts[name] = count + 1
+        if count % self.every:
+            LOG_STATS["sampled_out"] += 1
+            return False
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only merge the message here; JSON encoding happens off the loop
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            LOG_STATS["queued"] += 1
+        except Full:
+            LOG_STATS["dropped"] += 1
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for field in ("user_id", "setup", "update_id"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if os.getenv("SHARD_INDEX"):
+            entry["shard"] = int(os.environ["SHARD_INDEX"])
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging() -> logging.handlers.QueueListener:
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonLogFormatter())
+
+    queue_handler = DroppingQueueHandler(Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(LogSamplingFilter(LOG_SAMPLE_EVERY))
+    queue_handler.addFilter(LogContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    for item in LOG_LEVELS.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+LOG_LISTENER = setup_logging()
+log = logging.getLogger("trailkeys")
+persist_log = logging.getLogger("trailkeys.persist")
+session_log = logging.getLogger("trailkeys.sessions")
+scheduler_log = logging.getLogger("trailkeys.scheduler")
+ratelimit_log = logging.getLogger("trailkeys.ratelimit")
+dedup_log = logging.getLogger("trailkeys.dedup")
+server_log = logging.getLogger("trailkeys.server")
+shard_log = logging.getLogger("trailkeys.shard")
+upload_log = logging.getLogger("trailkeys.upload")
+forward_log = logging.getLogger("trailkeys.autoforward")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")  # Get token from Railway environment
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable not set")
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")  # e.g. a local Bot API server
 
 # Load config
 with open("config.json") as f:
     config = json.load(f)
 
 OWNER_ID = config["owner_id"]
-ALLOWED_USERS = set(config["allowed_users"])
-USER_DATA = config["user_data"]
-
-# Load new setups
-AUTO_SETUP = config.get("auto_setup", {
-    "setup1": {"source_channel": "", "dest_channel": "", "dest_caption": "", "completed_count": 0},
-    "setup2": {"source_channel": "", "dest_channel": "", "dest_caption": "", "completed_count": 0},
-    "setup3": {"source_channel": "", "dest_channel": "", "dest_caption": "", "completed_count": 0}
-})
+# ALLOWED_USERS, USER_DATA and AUTO_SETUP are loaded by the state backend below
 
 START_TIME = time.time()
-USER_STATE = {}  # Tracks per-user upload state
+# USER_STATE (per-user upload state) is a bounded SessionStore, see below
+METHOD2_TIMERS = {}  # user_id -> the one running Method 2 countdown task
 
 owner_keyboard = ReplyKeyboardMarkup(
     keyboard=[
@@ -54,14 +183,2736 @@ allowed_user_keyboard = ReplyKeyboardMarkup(
     one_time_keyboard=False
     )
 
+# --- Write-behind config persistence ---
+# save_config() only marks the state dirty. A background flusher coalesces
+# all changes made within CONFIG_FLUSH_INTERVAL into one atomic write that
+# runs off the event loop, and a final flush happens on shutdown.
+CONFIG_PATH = "config.json"
+CONFIG_FLUSH_INTERVAL = float(os.getenv("CONFIG_FLUSH_INTERVAL", "2"))
+
+PERSIST_STATS = {
+    "flushes": 0,
+    "coalesced": 0,
+    "failures": 0,
+    "last_latency_ms": 0.0,
+    "last_bytes": 0,
+    "total_bytes": 0
+}
+
+_config_dirty = False
+_config_generation = 0  # bumped by every save_config()
+_config_flush_lock = asyncio.Lock()
+
 def save_config():
-    with open("config.json", "w") as f:
-        json.dump({
-            "owner_id": OWNER_ID,
-            "allowed_users": list(ALLOWED_USERS),
-            "user_data": USER_DATA,
-            "auto_setup": AUTO_SETUP
-        }, f, indent=4)
+    global _config_dirty, _config_generation
+    if _config_dirty:
+        PERSIST_STATS["coalesced"] += 1
+    _config_dirty = True
+    _config_generation += 1
+
+def _config_payload() -> bytes:
+    # Serialized on the loop so the snapshot is consistent; the C encoder is
+    # only used without indent, which keeps this step cheap.
+    return json.dumps({
+        "owner_id": OWNER_ID,
+        "allowed_users": list(ALLOWED_USERS),
+        "user_data": USER_DATA,
+        "auto_setup": AUTO_SETUP
+    }, ensure_ascii=False).encode("utf-8")
+
+def _write_file_atomic(path: str, payload: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # Make the rename itself durable
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+async def flush_config():
+    global _config_dirty
+
+    async with _config_flush_lock:
+        if not _config_dirty:
+            return
+
+        generation = _config_generation
+        payload = _config_payload()
+        started = time.perf_counter()
+
+        write = asyncio.ensure_future(asyncio.to_thread(_write_file_atomic, CONFIG_PATH, payload))
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # The thread can't be stopped; hold the lock until it is done so
+            # the next flush never writes the same temp file alongside it
+            await asyncio.wait([write])
+            raise
+        except Exception as e:
+            PERSIST_STATS["failures"] += 1
+            persist_log.error("Config flush failed: %s", e)
+            return
+
+        # Still dirty if anything changed while the payload was being written
+        if _config_generation == generation:
+            _config_dirty = False
+
+        latency_ms = (time.perf_counter() - started) * 1000
+        PERSIST_STATS["flushes"] += 1
+        PERSIST_STATS["last_latency_ms"] = round(latency_ms, 2)
+        PERSIST_STATS["last_bytes"] = len(payload)
+        PERSIST_STATS["total_bytes"] += len(payload)
+        persist_log.debug("💾 Config flushed: %d bytes in %.2f ms", len(payload), latency_ms)
+
+async def config_flusher():
+    while True:
+        await asyncio.sleep(CONFIG_FLUSH_INTERVAL)
+        try:
+            await flush_config()
+        except Exception as e:
+            persist_log.exception("Config flusher error: %s", e)
+
+# --- Pluggable state backends ---
+# ALLOWED_USERS, USER_DATA and AUTO_SETUP stay in memory as the read path.
+# Every mutation goes through the helpers below, which update memory and
+# then await STORAGE with the single changed row, so a backend never blocks
+# the event loop on disk.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json").lower()
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.db")
+
+# Sharded mode (see run_shard_front) keeps durable state in the shared
+# SQLite store; worker processes get SHARD_INDEX from the front process.
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "1"))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "-1"))
+if SHARD_WORKERS > 1 and STATE_BACKEND != "sqlite":
+    raise ValueError("SHARD_WORKERS > 1 requires STATE_BACKEND=sqlite")
+
+USER_COLUMNS = ("channel", "caption")
+SETUP_COLUMNS = ("source_channel", "dest_channel", "dest_caption", "completed_count")
+
+def default_setup() -> dict:
+    return {"source_channel": "", "dest_channel": "", "dest_caption": "", "completed_count": 0}
+
+class StateBackend(abc.ABC):
+    name = "base"
+
+    @abc.abstractmethod
+    def load(self, config: dict):
+        """Return (allowed_users, user_data, auto_setup) for the in-memory copies."""
+
+    @abc.abstractmethod
+    async def add_users(self, user_ids):
+        pass
+
+    @abc.abstractmethod
+    async def remove_users(self, user_ids):
+        pass
+
+    @abc.abstractmethod
+    async def set_user_field(self, user_id: int, field: str, value):
+        pass
+
+    @abc.abstractmethod
+    async def reset_all_users(self):
+        pass
+
+    @abc.abstractmethod
+    async def set_setup_field(self, name: str, field: str, value):
+        pass
+
+    @abc.abstractmethod
+    async def replace_setup(self, name: str, setup: dict):
+        pass
+
+    @abc.abstractmethod
+    async def delete_setup(self, name: str):
+        pass
+
+    @abc.abstractmethod
+    async def increment_setup_field(self, name: str, field: str, delta: int = 1):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def refresh(self, apply):
+        """Hand the rows other processes changed to apply(changes), if any."""
+
+    def close(self):
+        pass
+
+class JsonStateBackend(StateBackend):
+    """Keeps everything in config.json through the write-behind flusher."""
+    name = "json"
+
+    def load(self, config: dict):
+        auto_setup = config.get("auto_setup") or {f"setup{i}": default_setup() for i in range(1, 4)}
+        return set(config["allowed_users"]), config["user_data"], auto_setup
+
+    async def add_users(self, user_ids):
+        save_config()
+
+    async def remove_users(self, user_ids):
+        save_config()
+
+    async def set_user_field(self, user_id: int, field: str, value):
+        save_config()
+
+    async def reset_all_users(self):
+        save_config()
+
+    async def set_setup_field(self, name: str, field: str, value):
+        save_config()
+
+    async def replace_setup(self, name: str, setup: dict):
+        save_config()
+
+    async def delete_setup(self, name: str):
+        save_config()
+
+    async def increment_setup_field(self, name: str, field: str, delta: int = 1):
+        save_config()
+
+    async def flush(self):
+        await flush_config()
+
+class SqliteStateBackend(StateBackend):
+    """Row-level SQLite (WAL) store with a one-time import from config.json.
+
+    Known fields live in real columns, anything else a later feature adds to
+    a user or setup is kept in the per-row ``extra`` JSON column. Writes run
+    in a worker thread, one transaction at a time and in the order issued.
+
+    With ``track_changes`` every write also logs the rows it touched in the
+    ``changes`` table, so other processes sharing the file can reload just
+    those rows (see refresh).
+    """
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS allowed_users (
+            user_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            channel TEXT NOT NULL DEFAULT '',
+            caption TEXT NOT NULL DEFAULT '',
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS setups (
+            name TEXT PRIMARY KEY,
+            source_channel TEXT NOT NULL DEFAULT '',
+            dest_channel TEXT NOT NULL DEFAULT '',
+            dest_caption TEXT NOT NULL DEFAULT '',
+            completed_count INTEGER NOT NULL DEFAULT 0,
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE INDEX IF NOT EXISTS idx_setups_source ON setups(source_channel);
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL
+        );
+    """
+    CHANGE_LOG_KEEP = 10000  # newest entries kept; a reader further behind reloads everything
+    USER_SELECT = "SELECT user_id, channel, caption, extra FROM user_data"
+    SETUP_SELECT = "SELECT name, source_channel, dest_channel, dest_caption, completed_count, extra FROM setups"
+
+    def __init__(self, path: str, track_changes: bool = False):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.write_lock = asyncio.Lock()
+
+        self.track_changes = track_changes
+        self.origin = secrets.token_hex(8)
+        self.last_seq = self.conn.execute("SELECT coalesce(max(seq), 0) FROM changes").fetchone()[0]
+        self.refresh_lock = asyncio.Lock()
+        self.reader = None
+        if track_changes:
+            # Refreshes read on their own connection so they never share one
+            # with a write transaction running in another thread
+            self.reader = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            self.data_version = self.reader.execute("PRAGMA data_version").fetchone()[0]
+
+    def changed_elsewhere(self) -> bool:
+        """True if any connection, our own writer included, committed since the last check."""
+        version = self.reader.execute("PRAGMA data_version").fetchone()[0]
+        changed = version != self.data_version
+        self.data_version = version
+        return changed
+
+    def _import_config(self, config: dict):
+        allowed_users, user_data, auto_setup = JsonStateBackend().load(config)
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO allowed_users (user_id) VALUES (?)",
+                [(int(user_id),) for user_id in allowed_users]
+            )
+            for user_id, info in user_data.items():
+                self.conn.execute(*self._user_row(int(user_id), info))
+            for name, setup in auto_setup.items():
+                self.conn.execute(*self._setup_row(name, setup))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('imported_from_json', ?)",
+                (str(int(time.time())),)
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        persist_log.info("📥 Imported %d users, %d user records and %d setups from config.json into %s",
+                         len(allowed_users), len(user_data), len(auto_setup), self.path)
+
+    def load(self, config: dict):
+        imported = self.conn.execute(
+            "SELECT 1 FROM meta WHERE key = 'imported_from_json'"
+        ).fetchone()
+        if not imported:
+            self._import_config(config)
+
+        allowed_users = {row[0] for row in self.conn.execute("SELECT user_id FROM allowed_users")}
+        user_data = dict(map(self._user_info, self.conn.execute(self.USER_SELECT)))
+        auto_setup = dict(map(self._setup_info, self.conn.execute(self.SETUP_SELECT)))
+        return allowed_users, user_data, auto_setup
+
+    @staticmethod
+    def _user_info(row):
+        user_id, channel, caption, extra = row
+        info = json.loads(extra)
+        info["channel"] = channel
+        info["caption"] = caption
+        return str(user_id), info
+
+    @staticmethod
+    def _setup_info(row):
+        name, source, dest, dest_caption, completed, extra = row
+        setup = json.loads(extra)
+        setup.update({
+            "source_channel": source,
+            "dest_channel": dest,
+            "dest_caption": dest_caption,
+            "completed_count": completed
+        })
+        return name, setup
+
+    @staticmethod
+    def _user_row(user_id: int, info: dict):
+        extra = {k: v for k, v in info.items() if k not in USER_COLUMNS}
+        return (
+            "INSERT OR REPLACE INTO user_data (user_id, channel, caption, extra) VALUES (?, ?, ?, ?)",
+            (user_id, info.get("channel", ""), info.get("caption", ""), json.dumps(extra))
+        )
+
+    @staticmethod
+    def _setup_row(name: str, setup: dict):
+        extra = {k: v for k, v in setup.items() if k not in SETUP_COLUMNS}
+        return (
+            "INSERT OR REPLACE INTO setups "
+            "(name, source_channel, dest_channel, dest_caption, completed_count, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (name, setup.get("source_channel", ""), str(setup.get("dest_channel", "")),
+             setup.get("dest_caption", ""), int(setup.get("completed_count", 0)), json.dumps(extra))
+        )
+
+    def _apply(self, statements, changed):
+        """Run (sql, params) pairs as one transaction; a list of params is executemany."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in statements:
+                if isinstance(params, list):
+                    self.conn.executemany(sql, params)
+                else:
+                    self.conn.execute(sql, params)
+            if self.track_changes:
+                self.conn.executemany(
+                    "INSERT INTO changes (origin, kind, key) VALUES (?, ?, ?)",
+                    [(self.origin, kind, key) for kind, key in changed]
+                )
+                self.conn.execute(
+                    "DELETE FROM changes WHERE seq <= (SELECT max(seq) FROM changes) - ?", (self.CHANGE_LOG_KEEP,)
+                )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    async def _write(self, changed, *statements):
+        """``changed`` lists the (kind, key) rows touched; key "*" means every row of the kind."""
+        # asyncio.Lock wakes waiters in FIFO order, so writes commit in the
+        # order the handlers issued them
+        async with self.write_lock:
+            await asyncio.to_thread(self._apply, statements, changed)
+
+    def _read_changes(self):
+        """Rows other processes changed since the last refresh, read from one snapshot.
+
+        Returns (last seq, {kind: (complete, {key: row or None})}); a complete
+        kind holds every row, otherwise missing rows map to None (deleted).
+        """
+        self.reader.execute("BEGIN")
+        try:
+            first, last = self.reader.execute("SELECT min(seq), max(seq) FROM changes").fetchone()
+            if last is None or last <= self.last_seq:
+                return self.last_seq, {}
+
+            if first > self.last_seq + 1:
+                wanted = dict.fromkeys(("allowed", "user", "setup"), "*")  # the log was trimmed past us
+            else:
+                wanted = {}
+                for kind, key in self.reader.execute(
+                    "SELECT kind, key FROM changes WHERE seq > ? AND origin != ?", (self.last_seq, self.origin)
+                ):
+                    if key == "*":
+                        wanted[kind] = "*"
+                    elif wanted.get(kind) != "*":
+                        wanted.setdefault(kind, set()).add(key)
+
+            return last, {kind: self._read_rows(kind, keys) for kind, keys in wanted.items()}
+        finally:
+            self.reader.execute("COMMIT")
+
+    def _read_rows(self, kind: str, keys):
+        if kind == "allowed":
+            select, where, parse = "SELECT user_id FROM allowed_users", "user_id", lambda row: (str(row[0]), True)
+        elif kind == "user":
+            select, where, parse = self.USER_SELECT, "user_id", self._user_info
+        else:
+            select, where, parse = self.SETUP_SELECT, "name", self._setup_info
+
+        if keys == "*":
+            return True, dict(map(parse, self.reader.execute(select)))
+
+        rows = dict.fromkeys(keys)
+        for key in keys:
+            value = int(key) if where == "user_id" else key
+            rows.update(map(parse, self.reader.execute(f"{select} WHERE {where} = ?", (value,))))
+        return False, rows
+
+    async def refresh(self, apply):
+        if not self.track_changes:
+            return
+        async with self.refresh_lock:
+            if not self.changed_elsewhere():
+                return
+            # Holding the write lock keeps our own commits out of the snapshot,
+            # and apply runs before any queued write of ours can commit
+            async with self.write_lock:
+                self.last_seq, changes = await asyncio.to_thread(self._read_changes)
+                if changes:
+                    apply(changes)
+
+    async def add_users(self, user_ids):
+        await self._write(
+            [("allowed", str(u)) for u in user_ids],
+            ("INSERT OR IGNORE INTO allowed_users (user_id) VALUES (?)", [(u,) for u in user_ids])
+        )
+
+    async def remove_users(self, user_ids):
+        await self._write(
+            [("allowed", str(u)) for u in user_ids],
+            ("DELETE FROM allowed_users WHERE user_id = ?", [(u,) for u in user_ids])
+        )
+
+    async def set_user_field(self, user_id: int, field: str, value):
+        if field in USER_COLUMNS:
+            update = (f"UPDATE user_data SET {field} = ? WHERE user_id = ?", (value, user_id))
+        else:
+            update = (
+                "UPDATE user_data SET extra = json_set(extra, ?, json(?)) WHERE user_id = ?",
+                (f"$.{field}", json.dumps(value), user_id)
+            )
+        await self._write(
+            [("user", str(user_id))],
+            ("INSERT OR IGNORE INTO user_data (user_id) VALUES (?)", (user_id,)), update
+        )
+
+    async def reset_all_users(self):
+        await self._write([("user", "*")], ("UPDATE user_data SET channel = '', caption = ''", ()))
+
+    async def set_setup_field(self, name: str, field: str, value):
+        if field in SETUP_COLUMNS:
+            update = (f"UPDATE setups SET {field} = ? WHERE name = ?", (value, name))
+        else:
+            update = (
+                "UPDATE setups SET extra = json_set(extra, ?, json(?)) WHERE name = ?",
+                (f"$.{field}", json.dumps(value), name)
+            )
+        await self._write([("setup", name)], ("INSERT OR IGNORE INTO setups (name) VALUES (?)", (name,)), update)
+
+    async def replace_setup(self, name: str, setup: dict):
+        await self._write([("setup", name)], self._setup_row(name, setup))
+
+    async def delete_setup(self, name: str):
+        await self._write([("setup", name)], ("DELETE FROM setups WHERE name = ?", (name,)))
+
+    async def increment_setup_field(self, name: str, field: str, delta: int = 1):
+        if field in SETUP_COLUMNS:
+            update = (f"UPDATE setups SET {field} = {field} + ? WHERE name = ?", (delta, name))
+        else:
+            update = (
+                "UPDATE setups SET extra = json_set(extra, ?, "
+                "coalesce(json_extract(extra, ?), 0) + ?) WHERE name = ?",
+                (f"$.{field}", f"$.{field}", delta, name)
+            )
+        await self._write([("setup", name)], update)
+
+    async def flush(self):
+        # Wait for writes still queued behind the lock
+        async with self.write_lock:
+            pass
+
+    def close(self):
+        self.conn.close()
+        if self.reader:
+            self.reader.close()
+
+if STATE_BACKEND == "sqlite":
+    STORAGE = SqliteStateBackend(STATE_DB_PATH, track_changes=SHARD_WORKERS > 1)
+else:
+    STORAGE = JsonStateBackend()
+
+ALLOWED_USERS, USER_DATA, AUTO_SETUP = STORAGE.load(config)
+
+# Memory changes whose storage write hasn't committed yet, as (rows, apply)
+# in issue order. A refresh that reloads one of those rows from disk runs
+# apply again, so the local change isn't lost under the older disk copy.
+PENDING_WRITES = []
+
+async def write_through(changed, apply, write):
+    """Apply a change to memory now, then await its storage write."""
+    apply()
+    entry = (changed, apply)
+    PENDING_WRITES.append(entry)
+    try:
+        await write
+    finally:
+        PENDING_WRITES.remove(entry)
+
+def apply_shared_changes(changes: dict):
+    """Merge rows another process committed (see SqliteStateBackend.refresh)."""
+    if "allowed" in changes:
+        complete, rows = changes["allowed"]
+        if complete:
+            ALLOWED_USERS.clear()
+        for user_id, row in rows.items():
+            if row:
+                ALLOWED_USERS.add(int(user_id))
+            else:
+                ALLOWED_USERS.discard(int(user_id))
+
+    for kind, target in (("user", USER_DATA), ("setup", AUTO_SETUP)):
+        if kind not in changes:
+            continue
+        complete, rows = changes[kind]
+        if complete:
+            target.clear()
+        for key, row in rows.items():
+            if row is None:
+                target.pop(key, None)
+            else:
+                target[key] = row
+
+    if "setup" in changes:
+        complete, rows = changes["setup"]
+        for name in (set(SETUP_FILTERS) | set(KEY_EXTRACTORS)) if complete else rows:
+            forget_setup_caches(name)
+
+    for changed, apply in PENDING_WRITES:
+        if any(kind in changes and (key == "*" or changes[kind][0] or key in changes[kind][1])
+               for kind, key in changed):
+            apply()
+
+    if "setup" in changes:
+        rebuild_setup_index()
+
+async def add_allowed_users(user_ids) -> list:
+    """Allow many users in one storage transaction, returning the ones that were new."""
+    added = sorted(set(user_ids) - ALLOWED_USERS)
+    if added:
+        await write_through(
+            [("allowed", str(u)) for u in added],
+            lambda: ALLOWED_USERS.update(added),
+            STORAGE.add_users(added)
+        )
+    return added
+
+async def remove_allowed_users(user_ids) -> list:
+    """Remove many users in one storage transaction, returning the ones that were allowed."""
+    removed = sorted(set(user_ids) & ALLOWED_USERS)
+    if removed:
+        await write_through(
+            [("allowed", str(u)) for u in removed],
+            lambda: ALLOWED_USERS.difference_update(removed),
+            STORAGE.remove_users(removed)
+        )
+    return removed
+
+async def set_user_field(user_id: int, field: str, value):
+    def apply():
+        USER_DATA.setdefault(str(user_id), {})[field] = value
+        if field == "caption":
+            user_caption_template(user_id)
+    await write_through([("user", str(user_id))], apply, STORAGE.set_user_field(user_id, field, value))
+
+async def reset_all_user_data():
+    def apply():
+        for info in USER_DATA.values():
+            info["channel"] = ""
+            info["caption"] = ""
+    await write_through([("user", "*")], apply, STORAGE.reset_all_users())
+
+async def set_setup_field(name: str, field: str, value):
+    def apply():
+        AUTO_SETUP.setdefault(name, default_setup())[field] = value
+        if field == "source_channel":
+            rebuild_setup_index()
+        elif field == "dest_caption":
+            setup_caption_template(name)
+        elif field == "rules":
+            setup_filter(name)
+        elif field == "key_patterns":
+            setup_key_extractor(name)
+    await write_through([("setup", name)], apply, STORAGE.set_setup_field(name, field, value))
+
+async def replace_setup(name: str, setup: dict):
+    drop_pending_rejections(name)
+    def apply():
+        AUTO_SETUP[name] = setup
+        forget_setup_caches(name)
+        rebuild_setup_index()
+    await write_through([("setup", name)], apply, STORAGE.replace_setup(name, setup))
+
+async def delete_setup(name: str):
+    drop_pending_rejections(name)
+    def apply():
+        AUTO_SETUP.pop(name, None)
+        forget_setup_caches(name)
+        rebuild_setup_index()
+    await write_through([("setup", name)], apply, STORAGE.delete_setup(name))
+
+def forget_setup_caches(name: str):
+    # A setup created later under the same name must start from scratch
+    CAPTION_TEMPLATES.pop(("setup", name), None)
+    SETUP_FILTERS.pop(name, None)
+    KEY_EXTRACTORS.pop(name, None)
+
+def setup_label(name: str) -> str:
+    # "setup3" is shown as "3" like before, custom names as they are
+    return name[5:] if name.startswith("setup") and name[5:].isdigit() else name
+
+def setup_sort_key(name: str):
+    label = setup_label(name)
+    return (0, int(label), "") if label.isdigit() else (1, 0, label)
+
+# Source channel -> setup names, keyed by the numeric chat id string or the
+# case-folded @username. Rebuilt whenever a source changes.
+SETUP_INDEX = {}
+
+def rebuild_setup_index():
+    index = {}
+    for name in sorted(AUTO_SETUP, key=setup_sort_key):
+        source = str(AUTO_SETUP[name].get("source_channel") or "").strip()
+        if not source:
+            continue
+        key = source.casefold() if source.startswith("@") else source
+        index.setdefault(key, []).append(name)
+
+    SETUP_INDEX.clear()
+    SETUP_INDEX.update(index)
+
+rebuild_setup_index()
+
+def setup_destinations(setup: dict) -> list:
+    # Older setups only carry the single dest_channel string
+    dests = setup.get("dest_channels")
+    if dests:
+        return dests
+    return [setup["dest_channel"]] if setup.get("dest_channel") else []
+
+async def set_setup_destinations(name: str, dests: list):
+    await set_setup_field(name, "dest_channels", list(dests))
+    await set_setup_field(name, "dest_channel", dests[0] if dests else "")
+
+async def increment_setup_field(name: str, field: str, delta: int = 1):
+    def apply():
+        setup = AUTO_SETUP.get(name)
+        if setup is not None:  # a replay may find the setup deleted elsewhere
+            setup[field] = setup.get(field, 0) + delta
+    await write_through([("setup", name)], apply, STORAGE.increment_setup_field(name, field, delta))
+
+# Filter rejections can arrive for every post of a busy channel, so they are
+# counted here and written as one increment per (setup, rule) every
+# SETUP_COUNT_FLUSH_INTERVAL and on shutdown. Readers add the unflushed part
+# through setup_rejections(); it stays out of AUTO_SETUP until written, so a
+# shard refresh can't drop it.
+SETUP_COUNT_FLUSH_INTERVAL = float(os.getenv("SETUP_COUNT_FLUSH_INTERVAL", "10"))
+PENDING_REJECTIONS = {}  # (setup name, rule) -> rejections not yet written
+
+def count_rejection(name: str, rule: str):
+    PENDING_REJECTIONS[(name, rule)] = PENDING_REJECTIONS.get((name, rule), 0) + 1
+
+def drop_pending_rejections(name: str):
+    for key in [key for key in PENDING_REJECTIONS if key[0] == name]:
+        del PENDING_REJECTIONS[key]
+
+def setup_rejections(name: str) -> dict:
+    """Rule -> rejections for one setup, unflushed ones included."""
+    setup = AUTO_SETUP.get(name, {})
+    counts = {}
+    for rule in FILTER_RULE_TYPES:
+        count = setup.get(f"rejected_{rule}", 0) + PENDING_REJECTIONS.get((name, rule), 0)
+        if count:
+            counts[rule] = count
+    return counts
+
+async def flush_rejections():
+    while PENDING_REJECTIONS:
+        (name, rule), delta = PENDING_REJECTIONS.popitem()
+        if name not in AUTO_SETUP:
+            continue
+        write = asyncio.ensure_future(increment_setup_field(name, f"rejected_{rule}", delta))
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # Let the write land so shutdown's final flush doesn't race it
+            await asyncio.wait([write])
+            raise
+        except Exception as e:
+            persist_log.error("Rejection count flush failed for setup %s: %s", name, e)
+
+async def rejection_flusher():
+    while True:
+        await asyncio.sleep(SETUP_COUNT_FLUSH_INTERVAL)
+        try:
+            await flush_rejections()
+        except Exception as e:
+            persist_log.exception("Rejection flusher error: %s", e)
+
+# --- Bounded session store ---
+# USER_STATE keeps the dict interface the handlers use, but a session idle
+# for SESSION_TTL expires and the least recently used one is evicted once
+# SESSION_MAX are live, so a long-running worker's memory stays flat.
+# Handler reads (get, [], setdefault) count as activity; the snapshotter
+# uses peek() and items(), which don't.
+SESSION_TTL = float(os.getenv("SESSION_TTL", "21600"))  # seconds idle
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+SESSION_SWEEP_INTERVAL = 60
+
+def deep_sizeof(obj) -> int:
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k) + deep_sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(v) for v in obj)
+    elif hasattr(obj, "__slots__"):
+        # Enum members are shared singletons, so only the slot pointers count
+        for name in obj.__slots__:
+            value = getattr(obj, name)
+            if not isinstance(value, enum.Enum):
+                size += deep_sizeof(value)
+    return size
+
+class SessionStatus(str, enum.Enum):
+    NORMAL = "normal"
+    SELECTING_METHOD = "selecting_method"
+    WAITING_CHANNEL = "waiting_channel"
+    WAITING_CAPTION = "waiting_caption"
+    WAITING_NEW_CAPTION = "waiting_new_caption"
+
+class KeyMode(str, enum.Enum):
+    NORMAL = "normal"
+    QUOTE = "quote"
+    MONO = "mono"
+
+NO_FILES = ()  # shared by every session without files; lists are made on first use
+
+class Session:
+    """One user's upload state.
+
+    Method 1 keeps its pending APK in file_id / file_name / file_size;
+    Method 2 batches go to the three parallel session_* lists.
+    """
+    # Append only: the slot order is the session snapshot record layout
+    __slots__ = (
+        "status", "current_method", "waiting_key", "key_mode", "saved_key",
+        "file_id", "file_name", "file_size",
+        "session_files", "session_filenames", "session_unique_ids",
+        "apk_posts", "last_apk_time", "last_post_link",
+        "progress_message_id", "preview_message_id",
+        "quote_applied", "mono_applied"
+    )
+
+    def __init__(self, status: SessionStatus = SessionStatus.NORMAL, current_method=None):
+        self.status = status
+        self.current_method = current_method
+        self.waiting_key = False
+        self.key_mode = KeyMode.NORMAL
+        self.saved_key = None
+        self.file_id = None
+        self.file_name = None
+        self.file_size = None
+        self.session_files = NO_FILES
+        self.session_filenames = NO_FILES
+        self.session_unique_ids = NO_FILES
+        self.apk_posts = NO_FILES
+        self.last_apk_time = None
+        self.last_post_link = None
+        self.progress_message_id = None
+        self.preview_message_id = None
+        self.quote_applied = False
+        self.mono_applied = False
+
+    def add_file(self, file_id: str, file_name: str, file_unique_id: str):
+        # Any of the three may still be the shared NO_FILES tuple
+        if not isinstance(self.session_files, list):
+            self.session_files = list(self.session_files)
+        if not isinstance(self.session_filenames, list):
+            self.session_filenames = list(self.session_filenames)
+        if not isinstance(self.session_unique_ids, list):
+            self.session_unique_ids = list(self.session_unique_ids)
+        self.session_files.append(file_id)
+        self.session_filenames.append(file_name)
+        self.session_unique_ids.append(file_unique_id)
+
+    def clear_files(self):
+        self.session_files = self.session_filenames = self.session_unique_ids = NO_FILES
+
+    def end_batch(self):
+        """A Method 2 batch is done; the chosen method and status stay."""
+        self.clear_files()
+        self.saved_key = None
+        self.waiting_key = False
+        self.last_apk_time = None
+        self.key_mode = KeyMode.NORMAL
+
+    def to_record(self) -> list:
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_record(cls, record) -> "Session":
+        """Rebuild from to_record() output or a legacy (version 1) state dict."""
+        session = cls()
+        if isinstance(record, dict):
+            items = ((name, record[name]) for name in cls.__slots__ if name in record)
+        else:
+            items = zip(cls.__slots__, record)
+        for name, value in items:
+            setattr(session, name, value)
+        # Version 1 dicts may carry only some of the parallel file lists;
+        # a partial batch can't be lined up again, so it is dropped whole
+        files = (session.session_files, session.session_filenames, session.session_unique_ids)
+        if all(files) and len({len(field) for field in files}) == 1:
+            session.session_files, session.session_filenames, session.session_unique_ids = map(list, files)
+        else:
+            session.clear_files()
+        try:
+            session.status = SessionStatus(session.status)
+        except ValueError:
+            session.status = SessionStatus.NORMAL
+        try:
+            session.key_mode = KeyMode(session.key_mode)
+        except ValueError:
+            session.key_mode = KeyMode.NORMAL
+        return session
+
+class SessionStore:
+    def __init__(self, ttl: float, max_sessions: int):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.states = OrderedDict()  # user_id -> state, least recently used first
+        self.last_used = {}          # user_id -> monotonic time of last use
+        self.stats = {"created": 0, "expired": 0, "evicted": 0}
+
+    def _expired(self, user_id, now: float) -> bool:
+        return now - self.last_used[user_id] > self.ttl
+
+    def _drop(self, user_id, reason: str):
+        del self.states[user_id]
+        del self.last_used[user_id]
+        self.stats[reason] += 1
+        session_dropped(user_id)
+
+    def _touch(self, user_id):
+        if user_id not in self.states:
+            return None
+        now = time.monotonic()
+        if self._expired(user_id, now):
+            self._drop(user_id, "expired")
+            return None
+        self.last_used[user_id] = now
+        self.states.move_to_end(user_id)
+        return self.states[user_id]
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.states and not self._expired(user_id, time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def __getitem__(self, user_id):
+        state = self._touch(user_id)
+        if state is None:
+            raise KeyError(user_id)
+        return state
+
+    def get(self, user_id, default=None):
+        state = self._touch(user_id)
+        return default if state is None else state
+
+    def peek(self, user_id):
+        return self.states.get(user_id)
+
+    def __setitem__(self, user_id, state):
+        if self._touch(user_id) is None:
+            self.stats["created"] += 1
+            while len(self.states) >= self.max_sessions:
+                self._drop(next(iter(self.states)), "evicted")
+        self.states[user_id] = state
+        self.last_used[user_id] = time.monotonic()
+
+    def setdefault(self, user_id, default):
+        state = self._touch(user_id)
+        if state is None:
+            self[user_id] = state = default
+        return state
+
+    def pop(self, user_id, default=None):
+        if user_id not in self.states:
+            return default
+        state = self.states.pop(user_id)
+        del self.last_used[user_id]
+        session_dropped(user_id)
+        return state
+
+    def __delitem__(self, user_id):
+        del self.states[user_id]
+        del self.last_used[user_id]
+        session_dropped(user_id)
+
+    def items(self):
+        return list(self.states.items())
+
+    def sweep(self) -> int:
+        """Expire idle sessions; they sit at the front in last-use order."""
+        now = time.monotonic()
+        expired = 0
+        while self.states:
+            user_id = next(iter(self.states))
+            if not self._expired(user_id, now):
+                break
+            self._drop(user_id, "expired")
+            expired += 1
+        return expired
+
+    def approx_bytes(self, sample_size: int = 200) -> int:
+        if not self.states:
+            return sys.getsizeof(self.states) + sys.getsizeof(self.last_used)
+        sample = list(itertools.islice(reversed(self.states.values()), sample_size))
+        per_session = sum(deep_sizeof(state) for state in sample) / len(sample)
+        # Key ints and the float timestamps are about 60 bytes per session
+        return int(per_session * len(self.states)) + 60 * len(self.states) \
+            + sys.getsizeof(self.states) + sys.getsizeof(self.last_used)
+
+def session_dropped(user_id):
+    # A dropped session takes its countdown with it and is tombstoned in
+    # the next snapshot so it isn't restored after a restart
+    cancel_method2_timer(user_id)
+    SESSION_SNAPSHOTS.mark_dirty(user_id)
+
+USER_STATE = SessionStore(SESSION_TTL, SESSION_MAX)
+
+async def session_sweeper():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        expired = USER_STATE.sweep()
+        if expired:
+            session_log.info("⌛ Expired %d idle sessions", expired)
+
+# --- Crash-safe USER_STATE snapshots ---
+# Sessions touched since the last tick are appended to an append-only
+# record log. The log is compacted atomically once it holds much more
+# history than live sessions. On startup the log is only indexed in the
+# background. A user's session is decoded on their first update.
+#
+# File format: header "<4sB" (magic, version), then records "<qI"
+# (user_id, payload length) + zlib-compressed JSON. Length 0 = deleted.
+# Version 2 payloads are Session.to_record() lists; version 1 files hold
+# state dicts, are still read and get rewritten as version 2.
+SESSION_SNAPSHOT_PATH = os.getenv("SESSION_SNAPSHOT_PATH", "sessions.snap")
+if SHARD_INDEX >= 0:
+    SESSION_SNAPSHOT_PATH = f"{SESSION_SNAPSHOT_PATH}.{SHARD_INDEX}"  # sessions are per worker
+SESSION_SNAPSHOT_INTERVAL = float(os.getenv("SESSION_SNAPSHOT_INTERVAL", "10"))
+
+SNAPSHOT_MAGIC = b"TKSS"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_READABLE_VERSIONS = (1, 2)
+SNAPSHOT_HEADER = struct.Struct("<4sB")
+SNAPSHOT_RECORD = struct.Struct("<qI")
+
+def encode_session(session: Session) -> bytes:
+    return zlib.compress(json.dumps(session.to_record(), separators=(",", ":")).encode("utf-8"))
+
+def decode_session(payload: bytes) -> Session:
+    return Session.from_record(json.loads(zlib.decompress(payload)))
+
+class SessionSnapshotter:
+    def __init__(self, path: str):
+        self.path = path
+        self.dirty = set()
+        self.pending = {}  # user_id -> payload not restored yet
+        self.records = 0
+        self.needs_rewrite = False
+        self.load_task = None
+        self.stats = {"snapshots": 0, "written": 0, "restored": 0, "compactions": 0, "last_bytes": 0}
+
+    def mark_dirty(self, user_id: int):
+        self.dirty.add(user_id)
+
+    def _read_index(self):
+        pending = {}
+        records = 0
+        needs_rewrite = False
+
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return pending, records, True
+
+        if len(data) < SNAPSHOT_HEADER.size:
+            return pending, records, True
+
+        magic, version = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version not in SNAPSHOT_READABLE_VERSIONS:
+            session_log.warning("Ignoring session snapshot with unknown format (version %s)", version)
+            return pending, records, True
+        needs_rewrite = version != SNAPSHOT_VERSION
+
+        offset = SNAPSHOT_HEADER.size
+        while offset < len(data):
+            if offset + SNAPSHOT_RECORD.size > len(data):
+                needs_rewrite = True  # torn header from a crash mid-append
+                break
+            user_id, length = SNAPSHOT_RECORD.unpack_from(data, offset)
+            offset += SNAPSHOT_RECORD.size
+            if offset + length > len(data):
+                needs_rewrite = True  # torn payload
+                break
+            if length:
+                pending[user_id] = data[offset:offset + length]
+            else:
+                pending.pop(user_id, None)
+            offset += length
+            records += 1
+
+        return pending, records, needs_rewrite
+
+    async def load(self):
+        pending, records, needs_rewrite = await asyncio.to_thread(self._read_index)
+        # Sessions created before the index finished loading win
+        for user_id, payload in pending.items():
+            if user_id not in USER_STATE:
+                self.pending[user_id] = payload
+        self.records = records
+        self.needs_rewrite = needs_rewrite
+        session_log.info("🗂️ Session snapshot indexed: %d sessions from %d records", len(self.pending), records)
+
+    def start_loading(self):
+        self.load_task = asyncio.create_task(self.load())
+
+    async def restore(self, user_id: int):
+        """Bring back a snapshotted session; returns it, or None if there was none."""
+        if self.load_task and not self.load_task.done():
+            await self.load_task
+
+        payload = self.pending.pop(user_id, None)
+        if payload is None or user_id in USER_STATE:
+            return None
+
+        try:
+            session = USER_STATE[user_id] = decode_session(payload)
+        except Exception as e:
+            session_log.warning("Failed to restore session for %s: %s", user_id, e)
+            return None
+        self.stats["restored"] += 1
+        return session
+
+    def _append(self, chunk: bytes):
+        with open(self.path, "ab") as f:
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact_payload(self) -> bytes:
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION)]
+        for user_id, payload in self.pending.items():
+            parts.append(SNAPSHOT_RECORD.pack(user_id, len(payload)))
+            parts.append(payload)
+        for user_id, state in USER_STATE.items():
+            payload = encode_session(state)
+            parts.append(SNAPSHOT_RECORD.pack(user_id, len(payload)))
+            parts.append(payload)
+        return b"".join(parts)
+
+    async def snapshot(self):
+        if self.load_task and not self.load_task.done():
+            return
+
+        # Sessions marked while the write runs go to the next tick; a failed
+        # write puts the taken ones back so nothing is skipped for good
+        live = len(USER_STATE) + len(self.pending)
+        if self.needs_rewrite or self.records > max(1000, 2 * live):
+            dirty, self.dirty = self.dirty, set()
+            payload = self._compact_payload()
+            try:
+                await asyncio.to_thread(_write_file_atomic, self.path, payload)
+            except BaseException:
+                self.dirty |= dirty
+                raise
+            self.records = live
+            self.needs_rewrite = False
+            self.stats["compactions"] += 1
+        elif self.dirty:
+            dirty, self.dirty = self.dirty, set()
+            parts = []
+            for user_id in dirty:
+                state = USER_STATE.peek(user_id)
+                payload = encode_session(state) if state is not None else b""
+                parts.append(SNAPSHOT_RECORD.pack(user_id, len(payload)))
+                parts.append(payload)
+            payload = b"".join(parts)
+            try:
+                await asyncio.to_thread(self._append, payload)
+            except BaseException:
+                self.dirty |= dirty
+                raise
+            self.records += len(dirty)
+            self.stats["written"] += len(dirty)
+        else:
+            return
+
+        self.stats["snapshots"] += 1
+        self.stats["last_bytes"] = len(payload)
+
+SESSION_SNAPSHOTS = SessionSnapshotter(SESSION_SNAPSHOT_PATH)
+
+async def session_snapshotter():
+    while True:
+        await asyncio.sleep(SESSION_SNAPSHOT_INTERVAL)
+        try:
+            await SESSION_SNAPSHOTS.snapshot()
+        except Exception as e:
+            session_log.exception("Session snapshot failed: %s", e)
+
+async def restore_session_hook(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user:
+        return
+    session = await SESSION_SNAPSHOTS.restore(update.effective_user.id)
+    # Timers don't survive a restart: a Method 2 batch that was still in
+    # its countdown gets a fresh one so the key prompt still comes
+    # (private chat ids equal the user id)
+    if session and session.session_files and not session.waiting_key:
+        restart_method2_timer(update.effective_user.id, update.effective_user.id, context)
+
+async def mark_session_dirty_hook(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        SESSION_SNAPSHOTS.mark_dirty(update.effective_user.id)
+
+# --- Delayed forward scheduler ---
+# One timer heap for every delayed auto-forward: scheduling and cancelling
+# are O(log n) / O(1) and a single task sleeps until the earliest job.
+FORWARD_DELAY = float(os.getenv("FORWARD_DELAY", "20"))
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "5"))
+
+class ScheduledJob:
+    __slots__ = ("job_id", "due", "callback", "data", "cancelled")
+
+    def __init__(self, job_id: int, due: float, callback, data: dict):
+        self.job_id = job_id
+        self.due = due
+        self.callback = callback
+        self.data = data
+        self.cancelled = False
+
+class DelayedScheduler:
+    def __init__(self):
+        self.heap = []
+        self.jobs = {}
+        self.running = set()
+        # Shard workers number jobs 1+i, 1+i+N, 1+i+2N... so IDs stay unique
+        # across workers and the front can route /canceljob by ID alone
+        self.ids = itertools.count(max(SHARD_INDEX, 0) + 1, max(1, SHARD_WORKERS))
+        self.wakeup = asyncio.Event()
+        self.bot = None
+
+    def reserve(self) -> int:
+        """A job id to announce before the job itself is scheduled."""
+        return next(self.ids)
+
+    def schedule(self, delay: float, callback, job_id: int = None, **data) -> ScheduledJob:
+        due = asyncio.get_running_loop().time() + delay
+        job = ScheduledJob(job_id or next(self.ids), due, callback, data)
+        heapq.heappush(self.heap, (due, job.job_id, job))
+        self.jobs[job.job_id] = job
+        if self.heap[0][2] is job:
+            self.wakeup.set()
+        return job
+
+    def cancel(self, job_id: int):
+        job = self.jobs.pop(job_id, None)
+        if job:
+            job.cancelled = True  # dropped lazily when it reaches the heap top
+        return job
+
+    def pending(self):
+        return sorted(self.jobs.values(), key=lambda job: job.due)
+
+    async def _run_job(self, job: ScheduledJob):
+        try:
+            await job.callback(self.bot, job)
+        except Exception as e:
+            scheduler_log.exception("Scheduled job #%d failed: %s", job.job_id, e)
+
+    async def run(self, bot):
+        self.bot = bot
+        loop = asyncio.get_running_loop()
+
+        while True:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+
+            if not self.heap:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            delay = self.heap[0][0] - loop.time()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, job = heapq.heappop(self.heap)
+            self.jobs.pop(job.job_id, None)
+            task = asyncio.create_task(self._run_job(job))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+FORWARD_SCHEDULER = DelayedScheduler()
+
+# --- Concurrent update processing ---
+# Updates for different users / source channels run in parallel (up to
+# MAX_CONCURRENT_UPDATES), while updates sharing a key are serialized in
+# arrival order so USER_STATE transitions stay consistent. A key's lock is
+# dropped as soon as nothing is queued on it.
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.key_locks = {}  # key -> [lock, queued updates]
+        self.stats = {"processed": 0, "serialized": 0}
+
+    @staticmethod
+    def update_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.channel_post or update.edited_channel_post:
+            return ("chat", update.effective_chat.id)
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+        return None
+
+    def queued(self) -> int:
+        return sum(entry[1] for entry in self.key_locks.values())
+
+    async def process_update(self, update, coroutine):
+        key = self.update_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            self.stats["processed"] += 1
+            return
+
+        # Flooding users are deferred or dropped before they queue on their lock
+        if key[0] == "user" and INBOUND_LIMITER.applies_to(update):
+            if not await INBOUND_LIMITER.admit(update, key[1]):
+                coroutine.close()
+                return
+
+        entry = self.key_locks.get(key)
+        if entry is None:
+            entry = self.key_locks[key] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.stats["serialized"] += 1
+        entry[1] += 1
+
+        try:
+            # Take the per-key lock first so queued updates of a busy user
+            # don't hold global slots while they wait
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+                self.stats["processed"] += 1
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.key_locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+UPDATE_PROCESSOR = KeyedUpdateProcessor(max(1, MAX_CONCURRENT_UPDATES))
+
+# --- Outbound Bot API rate limiting ---
+# Every Bot API call (except getUpdates) passes through OUTBOUND_LIMITER:
+# a global token bucket plus one bucket per target chat, sized to
+# Telegram's limits. A RetryAfter pauses all sending for the requested time
+# and the call is retried. Shard workers keep these buckets and the pause in
+# shared memory (SharedRateLimits), so together they stay within one budget.
+BOT_API_GLOBAL_RATE = float(os.getenv("BOT_API_GLOBAL_RATE", "30"))        # calls / sec
+BOT_API_PRIVATE_CHAT_RATE = float(os.getenv("BOT_API_PRIVATE_CHAT_RATE", "1"))  # per private chat / sec
+BOT_API_GROUP_CHAT_RATE = float(os.getenv("BOT_API_GROUP_CHAT_RATE", "20")) / 60  # per group/channel / sec
+BOT_API_MAX_RETRIES = int(os.getenv("BOT_API_MAX_RETRIES", "3"))
+CHAT_BUCKET_LIMIT = 10000
+SHARED_CHAT_SLOTS = 4096
+
+def chat_rate_limit(chat_id) -> tuple:
+    """(tokens / sec, burst) for one target chat."""
+    key = str(chat_id)
+    if key.startswith("@") or key.startswith("-"):
+        return BOT_API_GROUP_CHAT_RATE, 3
+    return BOT_API_PRIVATE_CHAT_RATE, 1
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """Take one token, returning how long the caller must wait for it."""
+        self.refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+class SharedRateLimits:
+    """Token buckets in shared memory, created by the shard front for its workers.
+
+    values holds the pause deadline, the global bucket's (tokens, updated)
+    and SHARED_CHAT_SLOTS per-chat pairs. Chats hash onto slots, so two
+    chats on one slot share a budget rather than exceed it. All processes
+    read time.monotonic(), which is system-wide on Linux.
+    """
+
+    def __init__(self, ctx):
+        self.values = ctx.Array("d", 3 + 2 * SHARED_CHAT_SLOTS)  # zeros refill to full buckets
+
+    @staticmethod
+    def _take(values, i: int, rate: float, capacity: float, now: float) -> float:
+        tokens = min(capacity, values[i] + (now - values[i + 1]) * rate) - 1
+        values[i] = tokens
+        values[i + 1] = now
+        return 0.0 if tokens >= 0 else -tokens / rate
+
+    def reserve(self, chat_id, now: float) -> float:
+        """Take a global and a chat token, returning how long the caller must wait."""
+        with self.values.get_lock():
+            values = self.values.get_obj()
+            wait = self._take(values, 1, BOT_API_GLOBAL_RATE, BOT_API_GLOBAL_RATE, now)
+            if chat_id is not None:
+                slot = zlib.crc32(str(chat_id).encode()) % SHARED_CHAT_SLOTS
+                wait = max(wait, self._take(values, 3 + 2 * slot, *chat_rate_limit(chat_id), now))
+        return wait
+
+    def paused_until(self) -> float:
+        return self.values[0]
+
+    def pause(self, until: float):
+        with self.values.get_lock():
+            self.values[0] = max(self.values[0], until)
+
+class OutboundRateLimiter(BaseRateLimiter):
+    def __init__(self):
+        self.global_bucket = TokenBucket(BOT_API_GLOBAL_RATE, BOT_API_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.paused_until = 0.0
+        self.shared = None  # SharedRateLimits in shard workers
+        self.recent_delays = deque(maxlen=1000)
+        self.stats = {
+            "calls": 0,
+            "delayed": 0,
+            "total_delay": 0.0,
+            "max_delay": 0.0,
+            "retry_after": 0,
+            "dropped": 0
+        }
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        key = str(chat_id)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            if len(self.chat_buckets) >= CHAT_BUCKET_LIMIT:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.is_full(now)}
+            bucket = self.chat_buckets[key] = TokenBucket(*chat_rate_limit(key))
+        return bucket
+
+    def _pause(self, until: float):
+        if self.shared:
+            self.shared.pause(until)
+        else:
+            self.paused_until = max(self.paused_until, until)
+
+    async def _acquire(self, chat_id) -> float:
+        started = time.monotonic()
+
+        pause = (self.shared.paused_until() if self.shared else self.paused_until) - started
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+        now = time.monotonic()
+        if self.shared:
+            wait = self.shared.reserve(chat_id, now)
+        else:
+            wait = self.global_bucket.reserve(now)
+            if chat_id is not None:
+                wait = max(wait, self._chat_bucket(chat_id, now).reserve(now))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        return time.monotonic() - started
+
+    def _record(self, delay: float):
+        self.stats["calls"] += 1
+        self.stats["total_delay"] += delay
+        self.recent_delays.append(delay)
+        if delay > 0.001:
+            self.stats["delayed"] += 1
+        if delay > self.stats["max_delay"]:
+            self.stats["max_delay"] = delay
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        delay = 0.0
+
+        for attempt in range(BOT_API_MAX_RETRIES + 1):
+            delay += await self._acquire(chat_id)
+            started = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                BOT_API_SECONDS.observe((endpoint,), time.perf_counter() - started)
+                BOT_API_CALLS.inc((endpoint, "ok"))
+                self._record(delay)
+                return result
+            except RetryAfter as e:
+                BOT_API_CALLS.inc((endpoint, "retry_after"))
+                self.stats["retry_after"] += 1
+                if attempt == BOT_API_MAX_RETRIES:
+                    self.stats["dropped"] += 1
+                    self._record(delay)
+                    raise
+                ratelimit_log.warning("⏸️ Flood limit on %s, pausing %ss", endpoint, e.retry_after)
+                self._pause(time.monotonic() + e.retry_after + 0.1)
+            except Exception as e:
+                BOT_API_SECONDS.observe((endpoint,), time.perf_counter() - started)
+                BOT_API_CALLS.inc((endpoint, type(e).__name__))
+                raise
+
+OUTBOUND_LIMITER = OutboundRateLimiter()
+
+# --- Inbound per-user rate limiting ---
+# Private messages (uploads, key text, commands) pass a per-user token
+# bucket in UPDATE_PROCESSOR before they take the user's lock or a global
+# slot. Over the limit, up to INBOUND_DEFER_MAX updates per user wait for a
+# token (at most INBOUND_DEFER_SECONDS); anything beyond that is dropped and
+# the user gets one "slow down" reply per flood. Callback buttons have their
+# own cooldown and channel posts are never limited here.
+INBOUND_LIMITS = {  # role -> (tokens / sec, burst)
+    "owner": (float(os.getenv("INBOUND_OWNER_RATE", "2")), float(os.getenv("INBOUND_OWNER_BURST", "20"))),
+    "user": (float(os.getenv("INBOUND_USER_RATE", "0.5")), float(os.getenv("INBOUND_USER_BURST", "8"))),
+    "guest": (float(os.getenv("INBOUND_GUEST_RATE", "0.1")), float(os.getenv("INBOUND_GUEST_BURST", "3"))),
+}
+INBOUND_DEFER_MAX = int(os.getenv("INBOUND_DEFER_MAX", "5"))
+INBOUND_DEFER_SECONDS = float(os.getenv("INBOUND_DEFER_SECONDS", "10"))
+INBOUND_USER_LIMIT = 10000
+
+class InboundRateLimiter:
+    def __init__(self):
+        # user_id -> [bucket, deferred updates waiting, warned this flood],
+        # least recently seen first
+        self.users = OrderedDict()
+        self.stats = {"admitted": 0, "deferred": 0, "dropped": 0, "warned": 0}
+
+    @staticmethod
+    def applies_to(update) -> bool:
+        message = update.message
+        return message is not None and message.chat.type == "private"
+
+    @staticmethod
+    def role(user_id: int) -> str:
+        if user_id == OWNER_ID:
+            return "owner"
+        return "user" if user_id in ALLOWED_USERS else "guest"
+
+    def _prune(self, now: float):
+        # Users with a full bucket and nothing deferred lose no state when forgotten
+        for user_id in [k for k, e in self.users.items() if not e[1] and e[0].is_full(now)]:
+            del self.users[user_id]
+        # Nobody idle enough: forget the least recently seen instead
+        while len(self.users) >= INBOUND_USER_LIMIT:
+            self.users.popitem(last=False)
+
+    def _entry(self, user_id: int, now: float) -> list:
+        role = self.role(user_id)
+        entry = self.users.get(user_id)
+        if entry is None:
+            if len(self.users) >= INBOUND_USER_LIMIT:
+                self._prune(now)
+            entry = self.users[user_id] = [TokenBucket(*INBOUND_LIMITS[role]), 0, False]
+            return entry
+        self.users.move_to_end(user_id)
+        # Re-read the role every time so /adduser and /removeuser apply at once
+        entry[0].rate, entry[0].capacity = INBOUND_LIMITS[role]
+        return entry
+
+    async def admit(self, update, user_id: int) -> bool:
+        """Wait out a short deferral if needed; False means drop the update."""
+        now = time.monotonic()
+        entry = self._entry(user_id, now)
+        wait = entry[0].reserve(now)
+        if wait <= 0:
+            entry[2] = False
+            self.stats["admitted"] += 1
+            return True
+
+        if entry[1] < INBOUND_DEFER_MAX and wait <= INBOUND_DEFER_SECONDS:
+            self.stats["deferred"] += 1
+            entry[1] += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                entry[1] -= 1
+            return True
+
+        entry[0].tokens += 1  # a dropped update doesn't spend its token
+        self.stats["dropped"] += 1
+        ratelimit_log.info("🐢 Dropped update from flooding user %s", user_id, extra={"sample": "inbound_drop"})
+        if not entry[2]:
+            entry[2] = True
+            self.stats["warned"] += 1
+            try:
+                await update.message.reply_text(
+                    "🐢 *Slow down!* You're sending too fast, extra messages are being ignored.\n"
+                    "Wait a few seconds and try again.",
+                    parse_mode="Markdown"
+                )
+            except Exception as e:
+                ratelimit_log.warning("Slow down reply failed: %s", e)
+        return False
+
+INBOUND_LIMITER = InboundRateLimiter()
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+# --- Caption templates ---
+# A saved caption is compiled once into literal segments and slots: the
+# "Key -" placeholder plus optional {file_name} / {file_size} metadata.
+# Rendered captions are cached per (template version, key, key mode,
+# position), with the metadata added to the cache key only when the
+# template uses it. Metadata is escaped for the key mode's parse mode:
+# HTML, or legacy Markdown for "markdown" (auto-forward).
+KEY_PLACEHOLDER = "Key -"
+TEMPLATE_SLOT_PATTERN = re.compile(r"(Key -|\{file_name\}|\{file_size\})")
+TEMPLATE_SLOTS = {KEY_PLACEHOLDER: "key", "{file_name}": "file_name", "{file_size}": "file_size"}
+RENDER_CACHE_SIZE = 4096
+
+# How the key replaces the placeholder, per key mode
+KEY_FORMATS = {
+    "normal": "Key - {key}",
+    "mono": "Key - <code>{key}</code>",
+    "quote": "<blockquote>Key - <code>{key}</code></blockquote>",
+    "markdown": "Key - `{key}`"
+}
+
+_template_versions = itertools.count(1)
+RENDER_CACHE = OrderedDict()
+CAPTION_TEMPLATES = {}  # ("user", user_id) / ("setup", name) -> CaptionTemplate
+
+def escape_for_mode(text: str, mode: str) -> str:
+    if mode == "markdown":
+        return escape_markdown(text, version=1)
+    return html.escape(text, quote=False)
+
+def render_key(key: str, mode: str = "normal") -> str:
+    """Several keys (joined with KEY_SEPARATOR) get one "Key -" line each."""
+    if KEY_SEPARATOR in key:
+        return "\n".join(render_key(k, mode) for k in key.split(KEY_SEPARATOR))
+    if mode != "markdown":
+        key = html.escape(key, quote=False)
+    return KEY_FORMATS.get(mode, KEY_FORMATS["normal"]).format(key=key)
+
+class CaptionTemplate:
+    __slots__ = ("source", "version", "segments", "has_key_slot", "uses_metadata")
+
+    def __init__(self, source: str):
+        self.source = source
+        self.version = next(_template_versions)
+        # re.split with a group alternates literal text and slot tokens
+        self.segments = [
+            (TEMPLATE_SLOTS[token] if i % 2 else None, token)
+            for i, token in enumerate(TEMPLATE_SLOT_PATTERN.split(source))
+            if token
+        ]
+        slots = {slot for slot, _ in self.segments if slot}
+        self.has_key_slot = "key" in slots
+        self.uses_metadata = bool(slots - {"key"})
+
+    def render(self, key: str, mode: str = "normal", position: str = "single",
+               file_name: str = "", file_size=None) -> str:
+        """Position is "single", "middle" or "last"; middle files get only the key."""
+        cache_key = (self.version, key, mode, position)
+        if self.uses_metadata and position != "middle":
+            cache_key += (file_name, file_size)
+
+        rendered = RENDER_CACHE.get(cache_key)
+        if rendered is not None:
+            RENDER_CACHE.move_to_end(cache_key)
+            return rendered
+
+        key_text = render_key(key, mode)
+        if position == "middle":
+            rendered = key_text
+        else:
+            values = {
+                "key": key_text,
+                "file_name": escape_for_mode(file_name or "", mode),
+                "file_size": f"{file_size / (1024 * 1024):.1f} MB" if file_size else ""
+            }
+            rendered = "".join(values[slot] if slot else text for slot, text in self.segments)
+            if not self.has_key_slot:
+                rendered += f"\n{key_text}"
+
+        RENDER_CACHE[cache_key] = rendered
+        if len(RENDER_CACHE) > RENDER_CACHE_SIZE:
+            RENDER_CACHE.popitem(last=False)
+        return rendered
+
+def caption_template(owner, source: str) -> CaptionTemplate:
+    template = CAPTION_TEMPLATES.get(owner)
+    if template is None or template.source != source:
+        template = CAPTION_TEMPLATES[owner] = CaptionTemplate(source)
+    return template
+
+def user_caption_template(user_id: int) -> CaptionTemplate:
+    return caption_template(("user", user_id), USER_DATA.get(str(user_id), {}).get("caption", ""))
+
+def setup_caption_template(name: str) -> CaptionTemplate:
+    return caption_template(("setup", name), AUTO_SETUP.get(name, {}).get("dest_caption", ""))
+
+def file_position(idx: int, total: int) -> str:
+    if total == 1:
+        return "single"
+    return "last" if idx == total else "middle"
+
+# --- Setup filter rules ---
+# Each setup filters channel posts by its "rules": {type: value} as typed
+# into /setfilter, or the defaults below when it has none. Rules compile
+# once into predicates over the post, run cheapest first, and recompile
+# only when the stored rules change. A post is forwarded by a setup only
+# if every rule passes; the first failing rule gets the rejection count.
+FILTER_RULE_TYPES = ("size", "mime", "sender", "name", "caption")  # evaluation order
+DEFAULT_FILTER_RULES = {"name": r"\.apk$"}
+DEFAULT_SETUP_FILTER_RULES = {
+    "setup1": {"size": "1-50", "name": r"\.apk$"},
+    "setup2": {"size": "80-2048", "name": r"\.apk$"},
+}
+FILTER_LIST_SEPARATORS = re.compile(r"[\s,]+")
+
+def compile_size_rule(value: str):
+    """Comma separated MB ranges: 1-50, 80- (at least) or -20 (at most)."""
+    ranges = []
+    for part in value.split(","):
+        low, dash, high = part.strip().partition("-")
+        if not dash:
+            raise ValueError(f"size range {part.strip()!r} needs a '-', e.g. 1-50")
+        ranges.append((float(low or 0) * 1024 * 1024, float(high) * 1024 * 1024 if high else float("inf")))
+    return lambda message: any(low <= (message.document.file_size or 0) <= high for low, high in ranges)
+
+def compile_mime_rule(value: str):
+    mime_types = {t.casefold() for t in FILTER_LIST_SEPARATORS.split(value) if t}
+    return lambda message: (message.document.mime_type or "").casefold() in mime_types
+
+def post_senders(message) -> set:
+    """Everything a channel post can be attributed to, case-folded."""
+    senders = {message.author_signature, message.forward_signature}
+    for chat in (message.sender_chat, message.forward_from_chat):
+        if chat:
+            senders.add(str(chat.id))
+            if chat.username:
+                senders.add(f"@{chat.username}")
+    return {sender.casefold() for sender in senders if sender}
+
+def compile_sender_rule(value: str):
+    senders = {t.casefold() for t in FILTER_LIST_SEPARATORS.split(value) if t}
+    return lambda message: not senders.isdisjoint(post_senders(message))
+
+def compile_name_rule(value: str):
+    pattern = re.compile(value)
+    return lambda message: pattern.search(message.document.file_name or "") is not None
+
+def compile_caption_rule(value: str):
+    pattern = re.compile(value)
+    return lambda message: pattern.search(message.caption or "") is not None
+
+FILTER_RULE_COMPILERS = {
+    "size": compile_size_rule,
+    "mime": compile_mime_rule,
+    "sender": compile_sender_rule,
+    "name": compile_name_rule,
+    "caption": compile_caption_rule,
+}
+
+class SetupFilter:
+    __slots__ = ("source", "checks")
+
+    def __init__(self, rules: dict):
+        self.source = dict(rules)
+        self.checks = [
+            (rule_type, FILTER_RULE_COMPILERS[rule_type](rules[rule_type]))
+            for rule_type in FILTER_RULE_TYPES
+            if rules.get(rule_type)
+        ]
+
+    def rejection(self, message):
+        """The type of the first rule the post fails, or None if it passes."""
+        for rule_type, check in self.checks:
+            if not check(message):
+                return rule_type
+        return None
+
+SETUP_FILTERS = {}  # setup name -> SetupFilter
+
+def setup_filter_rules(name: str) -> dict:
+    rules = AUTO_SETUP.get(name, {}).get("rules")
+    if rules is None:
+        return DEFAULT_SETUP_FILTER_RULES.get(name, DEFAULT_FILTER_RULES)
+    return rules
+
+def setup_filter(name: str) -> SetupFilter:
+    rules = setup_filter_rules(name)
+    compiled = SETUP_FILTERS.get(name)
+    if compiled is None or compiled.source != rules:
+        compiled = SETUP_FILTERS[name] = SetupFilter(rules)
+    return compiled
+
+# --- Key extraction ---
+# A KeyExtractor joins its patterns (one capture group each) into a single
+# alternation, so every format costs one scan of the caption. A code/pre
+# caption entity starting where a match's key starts wins over the regex
+# capture, since it has the exact key boundaries; with no match at all the
+# code/pre entities themselves are the keys. All keys come back in caption
+# order. Setups can replace the defaults with /setkeypattern; Method 1
+# uploads use the defaults.
+#
+# Trade-off (bench.py keys): the alternation scan alone beats one findall
+# per pattern, but ordering and de-duplicating the keys costs a few hundred
+# ns, so a caption takes longer than bare per-pattern findalls that return
+# unordered, repeated keys. Per-pattern scans giving the same result
+# (merge by position, dedup) are slower again, and so is finditer with
+# lastindex instead of the findall tuples.
+DEFAULT_KEY_PATTERNS = (
+    r"Key\s*[-:]\s*(\S+)",
+    r"Password\s*[-:]\s*(\S+)",
+)
+KEY_ENTITY_TYPES = (MessageEntity.CODE, MessageEntity.PRE)
+KEY_SEPARATOR = "\n"  # several keys travel as one string, see render_key
+
+def entity_keys(text: str) -> list:
+    # A pre block may hold one key per line
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+class KeyExtractor:
+    __slots__ = ("patterns", "regex", "joined_groups")
+
+    def __init__(self, patterns):
+        for pattern in patterns:
+            if re.compile(pattern).groups != 1:
+                raise ValueError(f"{pattern!r} needs exactly one (group) around the key")
+        self.patterns = tuple(patterns)
+        self.regex = re.compile("|".join(f"(?:{pattern})" for pattern in self.patterns))
+        # With several patterns findall yields a tuple per match in which only
+        # the matching pattern's group is non-empty
+        self.joined_groups = len(self.patterns) > 1
+
+    def extract(self, text: str, code_spans=()) -> list:
+        """Every key in text, in order and without repeats."""
+        keys = []
+        if not code_spans:
+            for found in self.regex.findall(text):
+                key = "".join(found) if self.joined_groups else found
+                if key and key not in keys:
+                    keys.append(key)
+            return keys
+
+        for match in self.regex.finditer(text):
+            start, end = match.span(match.lastindex)
+            for span_start, span_end in code_spans:
+                if start <= span_start < end:
+                    found = entity_keys(text[span_start:span_end])
+                    break
+            else:
+                found = [match.group(match.lastindex)]
+            keys.extend(key for key in found if key and key not in keys)
+        if not keys:
+            for span_start, span_end in code_spans:
+                keys.extend(key for key in entity_keys(text[span_start:span_end]) if key not in keys)
+        return keys
+
+def caption_code_spans(message) -> list:
+    """(start, end) of the code/pre caption entities as str indexes.
+
+    Entity offsets count UTF-16 units, which differ from str indexes as soon
+    as the caption has an emoji before the entity.
+    """
+    entities = [e for e in message.caption_entities or () if e.type in KEY_ENTITY_TYPES]
+    if not entities:
+        return []
+    utf16 = message.caption.encode("utf-16-le")
+    spans = []
+    for entity in entities:
+        start = len(utf16[:entity.offset * 2].decode("utf-16-le"))
+        length = len(utf16[entity.offset * 2:(entity.offset + entity.length) * 2].decode("utf-16-le"))
+        spans.append((start, start + length))
+    return spans
+
+def caption_keys(extractor: KeyExtractor, message) -> str:
+    """Keys of a captioned message joined with KEY_SEPARATOR, "" if none."""
+    caption = message.caption or ""
+    return KEY_SEPARATOR.join(extractor.extract(caption, caption_code_spans(message)))
+
+def keys_label(key: str) -> str:
+    return key.replace(KEY_SEPARATOR, ", ")
+
+DEFAULT_KEY_EXTRACTOR = KeyExtractor(DEFAULT_KEY_PATTERNS)
+KEY_EXTRACTORS = {}  # setup name -> KeyExtractor
+
+def setup_key_extractor(name: str) -> KeyExtractor:
+    patterns = tuple(AUTO_SETUP.get(name, {}).get("key_patterns") or DEFAULT_KEY_PATTERNS)
+    extractor = KEY_EXTRACTORS.get(name)
+    if extractor is None or extractor.patterns != patterns:
+        extractor = KEY_EXTRACTORS[name] = (
+            DEFAULT_KEY_EXTRACTOR if patterns == DEFAULT_KEY_PATTERNS else KeyExtractor(patterns)
+        )
+    return extractor
+
+# --- File metadata cache ---
+# Bounded LRU of document metadata keyed by file_unique_id, filled when a
+# file is uploaded so previews don't need getFile round trips.
+FILE_META_CACHE_SIZE = int(os.getenv("FILE_META_CACHE_SIZE", "5000"))
+
+class FileMetaCache:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0}
+
+    def put(self, file_unique_id: str, file_id: str, file_name: str, file_size):
+        if not file_unique_id:
+            return
+        self.entries[file_unique_id] = {"file_id": file_id, "file_name": file_name, "file_size": file_size}
+        self.entries.move_to_end(file_unique_id)
+        if len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def get(self, file_unique_id: str):
+        meta = self.entries.get(file_unique_id)
+        if meta is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(file_unique_id)
+        self.stats["hits"] += 1
+        return meta
+
+FILE_META = FileMetaCache(FILE_META_CACHE_SIZE)
+
+# --- Auto-forward duplicate suppression ---
+# A forward is identified by (file_unique_id, key, destination). Recent
+# ones live in a bounded in-memory LRU backed by an on-disk SQLite index,
+# and entries older than the retention window are ignored and purged.
+# A scheduled forward claims its digests in the claims table, which every
+# shard worker shares, so a repost during the delay is dropped whichever
+# worker it reaches; the digests move to the forwarded table once the send
+# succeeded. Claims belong to the worker that made them: a restarted worker
+# drops its own (their jobs died with it) instead of blocking reposts.
+# All disk work runs in a thread, one operation at a time, and the
+# database is only opened by post_init.
+DEDUP_DB_PATH = os.getenv("DEDUP_DB_PATH", "dedup.db")
+DEDUP_RETENTION = float(os.getenv("DEDUP_RETENTION_HOURS", "72")) * 3600
+DEDUP_MEMORY_SIZE = int(os.getenv("DEDUP_MEMORY_SIZE", "10000"))
+DEDUP_CLAIM_TTL = FORWARD_DELAY + 600  # a claim this old is left over from a crash
+
+class ForwardDeduplicator:
+    def __init__(self, path: str, retention: float, memory_size: int):
+        self.path = path
+        self.retention = retention
+        self.memory_size = memory_size
+        self.memory = OrderedDict()  # digest -> seen_at
+        self.claims = {}  # digest -> claimed_at, this worker's forwards not sent yet
+        self.owner = str(SHARD_INDEX)
+        self.stats = {"dropped": 0, "memory_hits": 0, "disk_hits": 0, "purged": 0}
+        self.conn = None
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def digest(file_unique_id: str, key: str, dest) -> str:
+        raw = f"{file_unique_id}\x1f{key}\x1f{str(dest).casefold()}"
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS forwarded (digest TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_forwarded_seen ON forwarded(seen_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS claims "
+            "(digest TEXT PRIMARY KEY, claimed_at REAL NOT NULL, owner TEXT NOT NULL)"
+        )
+        conn.execute("DELETE FROM claims WHERE owner = ?", (self.owner,))
+        return conn
+
+    async def open(self):
+        self.conn = await asyncio.to_thread(self._connect)
+
+    async def _run(self, fn, *args):
+        async with self.lock:
+            return await asyncio.to_thread(fn, *args)
+
+    def _transaction(self, fn, *args):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def _remember(self, digest: str, seen_at: float):
+        self.memory[digest] = seen_at
+        self.memory.move_to_end(digest)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _claim_rows(self, digests, now: float):
+        # Runs inside BEGIN IMMEDIATE, so check-and-claim is atomic across workers
+        claimed, forwarded = [], {}
+        for digest in digests:
+            row = self.conn.execute("SELECT seen_at FROM forwarded WHERE digest = ?", (digest,)).fetchone()
+            if row and now - row[0] < self.retention:
+                forwarded[digest] = row[0]
+                continue
+            cursor = self.conn.execute(
+                "INSERT INTO claims (digest, claimed_at, owner) VALUES (?, ?, ?) "
+                "ON CONFLICT(digest) DO UPDATE SET claimed_at = excluded.claimed_at, owner = excluded.owner "
+                "WHERE claims.claimed_at < ?",
+                (digest, now, self.owner, now - DEDUP_CLAIM_TTL)
+            )
+            if cursor.rowcount:
+                claimed.append(digest)
+        return claimed, forwarded
+
+    async def claim(self, digests) -> set:
+        """Claim the digests not forwarded or claimed yet; returns those claimed."""
+        now = time.time()
+        fresh = []
+        for digest in digests:
+            seen_at = self.memory.get(digest)
+            if digest in self.claims or (seen_at is not None and now - seen_at < self.retention):
+                self.stats["memory_hits"] += 1
+            else:
+                fresh.append(digest)
+        if not fresh:
+            return set()
+
+        claimed, forwarded = await self._run(self._transaction, self._claim_rows, fresh, now)
+        for digest, seen_at in forwarded.items():
+            self._remember(digest, seen_at)
+        self.stats["disk_hits"] += len(fresh) - len(claimed)
+        for digest in claimed:
+            self.claims[digest] = now
+        return set(claimed)
+
+    def _release_rows(self, digests):
+        self.conn.executemany("DELETE FROM claims WHERE digest = ? AND owner = ?",
+                              [(digest, self.owner) for digest in digests])
+
+    async def release(self, digests):
+        digests = [digest for digest in digests if self.claims.pop(digest, None) is not None]
+        if digests:
+            await self._run(self._transaction, self._release_rows, digests)
+
+    def _record_rows(self, digests, now: float):
+        self.conn.executemany("INSERT OR REPLACE INTO forwarded (digest, seen_at) VALUES (?, ?)",
+                              [(digest, now) for digest in digests])
+        self._release_rows(digests)
+
+    async def record(self, digests):
+        digests = list(digests)
+        if not digests:
+            return
+        now = time.time()
+        for digest in digests:
+            self.claims.pop(digest, None)
+            self._remember(digest, now)
+        await self._run(self._transaction, self._record_rows, digests, now)
+
+    def _purge_rows(self, cutoff: float, claim_cutoff: float) -> int:
+        purged = self.conn.execute("DELETE FROM forwarded WHERE seen_at < ?", (cutoff,)).rowcount
+        self.conn.execute("DELETE FROM claims WHERE claimed_at < ?", (claim_cutoff,))
+        return purged
+
+    async def purge(self):
+        now = time.time()
+        cutoff = now - self.retention
+        self.stats["purged"] += await self._run(self._purge_rows, cutoff, now - DEDUP_CLAIM_TTL)
+        for digest in [d for d, seen_at in self.memory.items() if seen_at < cutoff]:
+            del self.memory[digest]
+
+    async def close(self):
+        async with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+DEDUP = ForwardDeduplicator(DEDUP_DB_PATH, DEDUP_RETENTION, DEDUP_MEMORY_SIZE)
+
+async def dedup_janitor():
+    while True:
+        await asyncio.sleep(3600)
+        try:
+            await DEDUP.purge()
+        except Exception as e:
+            dedup_log.exception("Dedup purge failed: %s", e)
+
+# --- Metrics ---
+# Prometheus text-format counters, histograms and scrape-time gauges for
+# handlers, Bot API calls and queues. METRICS_PORT enables a local
+# GET /metrics endpoint (each shard worker listens on METRICS_PORT + index).
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = disabled
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def metric_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}  # label values tuple -> count
+
+    def inc(self, labels=(), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name + metric_labels(self.label_names, labels), value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}  # label values tuple -> [per-bucket counts, sum, count]
+
+    def observe(self, labels, value: float):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        bucket_names = self.label_names + ("le",)
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket" + metric_labels(bucket_names, labels + (bound,)), cumulative
+            yield self.name + "_bucket" + metric_labels(bucket_names, labels + ("+Inf",)), count
+            yield self.name + "_sum" + metric_labels(self.label_names, labels), total
+            yield self.name + "_count" + metric_labels(self.label_names, labels), count
+
+class Gauge:
+    """Read at scrape time; collect() returns {label values tuple: value}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, label_names, collect):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect().items():
+            yield self.name + metric_labels(self.label_names, labels), value
+
+class CollectedCounter(Gauge):
+    """A monotonic count kept elsewhere (stats dicts, setup fields), read at scrape time."""
+    kind = "counter"
+
+HANDLER_CALLS = Counter("bot_handler_calls_total", "Handler invocations by outcome", ("handler", "outcome"))
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler run time", ("handler",))
+BOT_API_CALLS = Counter("bot_api_requests_total", "Bot API requests by method and outcome", ("method", "outcome"))
+BOT_API_SECONDS = Histogram("bot_api_request_seconds", "Bot API request time, excluding rate-limit waits", ("method",))
+UPDATE_DISPATCH_SECONDS = Histogram("bot_update_dispatch_seconds", "Time from receiving an update to its first handler")
+METRICS_APPLICATION = None  # set by post_init for the update_queue gauge
+
+METRICS = [
+    HANDLER_CALLS,
+    HANDLER_SECONDS,
+    BOT_API_CALLS,
+    BOT_API_SECONDS,
+    UPDATE_DISPATCH_SECONDS,
+    Gauge("bot_update_queue_depth", "Updates waiting in the application queue", (),
+          lambda: {(): METRICS_APPLICATION.update_queue.qsize() if METRICS_APPLICATION else 0}),
+    Gauge("bot_update_processor_waiting", "Updates waiting on a per-user/chat lock", (),
+          lambda: {(): UPDATE_PROCESSOR.queued()}),
+    Gauge("bot_scheduled_forwards", "Delayed auto-forward jobs pending", (),
+          lambda: {(): len(FORWARD_SCHEDULER.jobs)}),
+    Gauge("bot_active_sessions", "Users with in-memory session state", (),
+          lambda: {(): len(USER_STATE)}),
+    CollectedCounter("bot_sessions_dropped_total", "Sessions expired (idle) or evicted (LRU)", ("reason",),
+                     lambda: {("expired",): USER_STATE.stats["expired"], ("evicted",): USER_STATE.stats["evicted"]}),
+    CollectedCounter("bot_inbound_updates_total", "Private messages through the inbound limiter by outcome", ("outcome",),
+                     lambda: {(outcome,): count for outcome, count in INBOUND_LIMITER.stats.items()}),
+    CollectedCounter("bot_callbacks_total", "Button callbacks by outcome", ("outcome",),
+                     lambda: {(outcome,): count for outcome, count in CALLBACKS.stats.items()}),
+    CollectedCounter("bot_setup_forwards_total", "Completed auto-forwards per setup", ("setup",),
+                     lambda: {(name,): setup.get("completed_count", 0) for name, setup in AUTO_SETUP.items()}),
+    CollectedCounter("bot_setup_duplicates_total", "Duplicate auto-forwards dropped per setup", ("setup",),
+                     lambda: {(name,): setup.get("duplicate_count", 0) for name, setup in AUTO_SETUP.items()}),
+    CollectedCounter("bot_setup_rejections_total", "Channel posts rejected per setup and filter rule", ("setup", "rule"),
+                     lambda: {(name, rule): count for name in AUTO_SETUP
+                              for rule, count in setup_rejections(name).items()}),
+]
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for sample, value in metric.samples():
+            lines.append(f"{sample} {value}")
+    return "\n".join(lines) + "\n"
+
+def instrument_handler(callback):
+    name = getattr(callback, "__name__", type(callback).__name__)
+
+    @functools.wraps(callback)
+    async def instrumented(update, context):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            HANDLER_SECONDS.observe((name,), time.perf_counter() - started)
+            HANDLER_CALLS.inc((name, outcome))
+
+    return instrumented
+
+async def serve_metrics(reader, writer):
+    try:
+        while True:
+            request = await asyncio.wait_for(read_http_request(reader), timeout=HTTP_IDLE_TIMEOUT)
+            if request is None:
+                break
+            keep_alive = request[2].get("connection", "").lower() != "close"
+            if request[1] != "/metrics":
+                writer.write(http_response(404, keep_alive=keep_alive))
+            else:
+                body = render_metrics().encode("utf-8")
+                writer.write(http_response(200, body, "text/plain; version=0.0.4", keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError, OverflowError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(application: Application):
+    global METRICS_APPLICATION
+    METRICS_APPLICATION = application
+    port = METRICS_PORT + max(SHARD_INDEX, 0)
+    server = await asyncio.start_server(serve_metrics, host=METRICS_LISTEN, port=port)
+    server_log.info("📈 Metrics on http://%s:%d/metrics", METRICS_LISTEN, port)
+    return server
+
+# --- Update receive tracking ---
+# Both serving modes stamp each update when it reaches the process
+# (getUpdates response or webhook POST), and a group -4 hook measures the
+# time until handlers start, so polling and webhook can be compared.
+UPDATE_RECEIVED_AT = {}  # update_id -> perf_counter() at receipt
+UPDATE_LATENCY = deque(maxlen=1000)
+
+def stamp_update_received(update_id: int):
+    if len(UPDATE_RECEIVED_AT) > 10000:
+        UPDATE_RECEIVED_AT.clear()  # updates that never reached a handler
+    UPDATE_RECEIVED_AT[update_id] = time.perf_counter()
+
+class TrackingBot(ExtBot):
+    async def get_updates(self, *args, **kwargs):
+        updates = await super().get_updates(*args, **kwargs)
+        HEALTH.last_fetch = time.monotonic()
+        for update in updates:
+            stamp_update_received(update.update_id)
+        return updates
+
+async def bind_log_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Later groups run in the same task, so every log record of this update
+    # carries its ids
+    LOG_UPDATE_ID.set(update.update_id)
+    LOG_USER_ID.set(update.effective_user.id if update.effective_user else None)
+    LOG_SETUP.set(None)
+
+async def track_update_latency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    received_at = UPDATE_RECEIVED_AT.pop(update.update_id, None)
+    if received_at is not None:
+        UPDATE_LATENCY.append(time.perf_counter() - received_at)
+        UPDATE_DISPATCH_SECONDS.observe((), UPDATE_LATENCY[-1])
+
+# --- Health probe ---
+# Real numbers for /ping: a monitor task measures event-loop lag every
+# HEALTH_SAMPLE_INTERVAL and samples tasks, backlog, RSS and the Bot API
+# round trip (get_me) on a slower cadence, keeping a rolling window for
+# the owner's "/ping stats". last_fetch is the last getUpdates response,
+# webhook POST or shard batch, depending on the serving mode.
+HEALTH_SAMPLE_INTERVAL = 0.5
+HEALTH_API_PROBE_INTERVAL = float(os.getenv("HEALTH_API_PROBE_INTERVAL", "60"))  # 0 = only on /ping
+HEALTH_WINDOW = 720
+
+class HealthProbe:
+    SERIES = ("api_rtt", "loop_lag", "tasks", "backlog", "rss")
+
+    def __init__(self):
+        self.samples = {name: deque(maxlen=HEALTH_WINDOW) for name in self.SERIES}
+        self.last_fetch = None
+
+    @staticmethod
+    def rss_bytes() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    @staticmethod
+    def backlog(application: Application) -> int:
+        return application.update_queue.qsize() + UPDATE_PROCESSOR.queued()
+
+    async def measure_api(self, bot, record: bool = True) -> float:
+        """getMe round trip; record=False keeps an on-demand reading out of the window."""
+        # Straight through the request object: bot.get_me() would queue in
+        # OUTBOUND_LIMITER and count its wait as network time. The call is
+        # still counted in the Bot API metrics, like any limited one.
+        started = time.perf_counter()
+        try:
+            await bot.request.post(f"{bot.base_url}/getMe")
+        except Exception as e:
+            BOT_API_SECONDS.observe(("getMe",), time.perf_counter() - started)
+            BOT_API_CALLS.inc(("getMe", type(e).__name__))
+            raise
+        rtt = time.perf_counter() - started
+        BOT_API_SECONDS.observe(("getMe",), rtt)
+        BOT_API_CALLS.inc(("getMe", "ok"))
+        if record:
+            self.samples["api_rtt"].append(rtt)
+        return rtt
+
+    def readings(self, application: Application) -> dict:
+        return {
+            "tasks": len(asyncio.all_tasks()),
+            "backlog": self.backlog(application),
+            "rss": self.rss_bytes()
+        }
+
+    def sample(self, application: Application):
+        for name, value in self.readings(application).items():
+            self.samples[name].append(value)
+
+    async def monitor(self, application: Application):
+        ticks = 0
+        last_api_probe = time.monotonic()
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(HEALTH_SAMPLE_INTERVAL)
+            self.samples["loop_lag"].append(max(0.0, time.monotonic() - started - HEALTH_SAMPLE_INTERVAL))
+
+            ticks += 1
+            if ticks % 20 == 0:
+                self.sample(application)
+            if HEALTH_API_PROBE_INTERVAL and time.monotonic() - last_api_probe >= HEALTH_API_PROBE_INTERVAL:
+                last_api_probe = time.monotonic()
+                try:
+                    await self.measure_api(application.bot)
+                except Exception as e:
+                    log.warning("Health API probe failed: %s", e)
+
+    def fetch_age(self):
+        return None if self.last_fetch is None else time.monotonic() - self.last_fetch
+
+HEALTH = HealthProbe()
+
+# --- Webhook serving mode ---
+# BOT_MODE=webhook serves updates from a small built-in HTTP/1.1 listener
+# instead of run_polling(). Without WEBHOOK_URL no webhook is registered
+# with Telegram, so recorded Update JSON can be POSTed to it locally:
+#   curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -d @update.json http://127.0.0.1:8443/telegram
+# Every POST must carry the secret token. When WEBHOOK_SECRET is unset and
+# the webhook is registered, a random one is generated and handed to
+# set_webhook; local replay without WEBHOOK_URL needs it set explicitly.
+# SIGHUP restarts the listener gracefully, SIGTERM / SIGINT drain and stop.
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    if not WEBHOOK_URL:
+        raise ValueError("BOT_MODE=webhook without WEBHOOK_URL requires WEBHOOK_SECRET")
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)
+WEBHOOK_BACKLOG = int(os.getenv("WEBHOOK_BACKLOG", "128"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_IDLE_TIMEOUT = 75
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+async def read_http_request(reader):
+    """Read one HTTP/1.1 request; returns (method, path, headers, body) or None on EOF."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise ValueError("malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+        if len(headers) > 100:
+            raise ValueError("too many headers")
+
+    length = int(headers.get("content-length") or 0)
+    if length > HTTP_MAX_BODY:
+        raise OverflowError("body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+def http_response(status: int, body: bytes = b"", content_type: str = "text/plain", keep_alive: bool = True) -> bytes:
+    head = (
+        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode("latin-1") + body
+
+class WebhookServer:
+    def __init__(self, application: Application):
+        self.application = application
+        self.server = None
+        self.accepting = False
+        self.in_flight = 0
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.writers = set()
+        self.stats = {"received": 0, "rejected": 0, "bad_requests": 0, "restarts": 0}
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle_connection,
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            backlog=WEBHOOK_BACKLOG,
+            reuse_address=True
+        )
+        self.accepting = True
+        server_log.info("🌐 Webhook listening on %s:%d%s (backlog %d)", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_BACKLOG)
+
+    async def stop(self):
+        """Stop accepting, let in-flight requests finish, then close connections."""
+        self.accepting = False
+        if self.server:
+            self.server.close()
+        try:
+            await asyncio.wait_for(self.drained.wait(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            server_log.warning("Webhook drain timed out with %d requests in flight", self.in_flight)
+        for writer in list(self.writers):
+            writer.close()
+        if self.server:
+            await self.server.wait_closed()
+            self.server = None
+
+    async def restart(self):
+        server_log.info("🔁 Restarting webhook listener...")
+        await self.stop()
+        await self.start()
+        self.stats["restarts"] += 1
+
+    async def handle_connection(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while self.accepting:
+                try:
+                    request = await asyncio.wait_for(read_http_request(reader), timeout=HTTP_IDLE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except OverflowError:
+                    writer.write(http_response(413, keep_alive=False))
+                    break
+                except ValueError:
+                    writer.write(http_response(400, keep_alive=False))
+                    break
+                if request is None:
+                    break
+
+                self.in_flight += 1
+                self.drained.clear()
+                try:
+                    status = await self.handle_request(*request)
+                finally:
+                    self.in_flight -= 1
+                    if not self.in_flight:
+                        self.drained.set()
+
+                keep_alive = self.accepting and request[2].get("connection", "").lower() != "close"
+                writer.write(http_response(status, keep_alive=keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except Exception as e:
+            server_log.warning("Webhook connection error: %s", e)
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def handle_request(self, method, path, headers, body) -> int:
+        if path != WEBHOOK_PATH:
+            return 404
+        if method != "POST":
+            return 405
+        if not hmac.compare_digest(
+            headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET
+        ):
+            self.stats["rejected"] += 1
+            return 403
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            self.stats["bad_requests"] += 1
+            server_log.warning("Bad webhook payload: %s", e)
+            return 400
+        if update is None:
+            self.stats["bad_requests"] += 1
+            return 400
+
+        stamp_update_received(update.update_id)
+        HEALTH.last_fetch = time.monotonic()
+        await self.application.update_queue.put(update)
+        self.stats["received"] += 1
+        return 200
+
+WEBHOOK_SERVER = None
+
+async def run_fed_application(application: Application, start_feed, stop_feed, stop_signals):
+    """Run an updater-less application while start_feed() fills its queue.
+
+    Stops on one of stop_signals or when start_feed sets the stop event
+    it is given; stop_feed() runs before the application drains and stops.
+    """
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in stop_signals:
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    try:
+        await start_feed(stop_event)
+        await stop_event.wait()
+    finally:
+        await stop_feed()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+async def run_webhook(application: Application):
+    global WEBHOOK_SERVER
+    WEBHOOK_SERVER = WebhookServer(application)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(WEBHOOK_SERVER.restart()))
+
+    async def start_feed(stop_event):
+        await WEBHOOK_SERVER.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+            server_log.info("✅ Webhook registered at %s%s", WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH)
+
+    await run_fed_application(application, start_feed, WEBHOOK_SERVER.stop, (signal.SIGINT, signal.SIGTERM))
+
+# --- Sharded multi-process mode ---
+# SHARD_WORKERS=N (N > 1) runs a front process that long-polls Telegram and
+# routes each update to one of N worker processes by the key the update
+# processor serializes on (user id, or chat id for channel posts). The front
+# polls through the public get_updates API, takes the key from each Update
+# and ships each getUpdates batch to a worker as one list of update dicts,
+# so workers get a whole batch per queue hop. A user's session and a source
+# channel's delayed jobs therefore always live in the same worker.
+#
+# Durable state is shared through the SQLite backend. Every write also logs
+# the rows it touched, and before each update a worker reloads only the rows
+# other workers changed (SqliteStateBackend.refresh), off the event loop.
+# Session snapshots are per worker; the outbound rate limits are shared.
+#
+# Job IDs are unique across workers and encode the worker that owns them,
+# so the front sends /canceljob N to that worker and /pending to every
+# worker, each listing its own jobs.
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "100"))  # batches per worker
+SHARD_STOP_TIMEOUT = float(os.getenv("SHARD_STOP_TIMEOUT", "30"))
+
+def shard_for(key, workers: int) -> int:
+    # Plain modulo instead of hash() so routing survives restarts, which
+    # keeps users matched with their worker's session snapshot
+    return 0 if key is None else key[1] % workers
+
+def job_shard(job_id: int, workers: int) -> int:
+    return (job_id - 1) % workers
+
+def shard_targets(update: Update, workers: int) -> list:
+    message = update.message
+    if message and message.text and message.from_user and message.from_user.id == OWNER_ID:
+        parts = message.text.split()
+        command = parts[0].split("@")[0]
+        if command == "/pending":
+            return list(range(workers))
+        if command == "/canceljob" and len(parts) > 1 and parts[1].lstrip("#").isdigit():
+            return [job_shard(int(parts[1].lstrip("#")), workers)]
+    return [shard_for(KeyedUpdateProcessor.update_key(update), workers)]
+
+async def refresh_shared_state_hook(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await STORAGE.refresh(apply_shared_changes)
+
+def start_shard_worker(ctx, index: int, inbox, limits: SharedRateLimits):
+    os.environ["SHARD_INDEX"] = str(index)
+    try:
+        process = ctx.Process(target=shard_worker, args=(index, inbox, limits), name=f"shard-{index}")
+        process.start()
+    finally:
+        del os.environ["SHARD_INDEX"]
+    return process
+
+def shard_worker(index: int, inbox, limits: SharedRateLimits):
+    # Ctrl+C reaches the whole process group; workers stop on the front's
+    # sentinel instead so nothing already routed to them is lost
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shard_log.info("🧩 Shard worker %d/%d started (pid %d)", index + 1, SHARD_WORKERS, os.getpid())
+    OUTBOUND_LIMITER.shared = limits
+    asyncio.run(run_shard_worker(build_application(with_updater=False), inbox))
+
+async def run_shard_worker(application: Application, inbox):
+    loop = asyncio.get_running_loop()
+    feed_task = None
+
+    async def feed(stop_event):
+        while True:
+            try:
+                batch = await loop.run_in_executor(None, inbox.get, True, 1.0)
+            except Empty:
+                continue
+            if batch is None:
+                stop_event.set()
+                return
+            HEALTH.last_fetch = time.monotonic()
+            for payload in batch:
+                update = Update.de_json(payload, application.bot)
+                stamp_update_received(update.update_id)
+                await application.update_queue.put(update)
+
+    async def start_feed(stop_event):
+        nonlocal feed_task
+        feed_task = asyncio.create_task(feed(stop_event))
+
+    async def stop_feed():
+        if not feed_task.done():
+            feed_task.cancel()
+
+    await run_fed_application(application, start_feed, stop_feed, (signal.SIGTERM,))
+
+async def run_shard_front(workers: int):
+    ctx = multiprocessing.get_context("spawn")
+    inboxes = [ctx.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(workers)]
+    limits = SharedRateLimits(ctx)
+    processes = [start_shard_worker(ctx, index, inbox, limits) for index, inbox in enumerate(inboxes)]
+
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    bot = Bot(BOT_TOKEN, base_url=BOT_API_URL, get_updates_request=HTTPXRequest())
+    routed = [0] * workers
+    offset = None
+
+    async def route(updates):
+        batches = {}
+        for update in updates:
+            payload = update.to_dict()
+            for index in shard_targets(update, workers):
+                batches.setdefault(index, []).append(payload)
+        for index, batch in batches.items():
+            try:
+                inboxes[index].put_nowait(batch)
+            except Full:
+                # Back-pressure: stop polling until the busy worker catches up
+                await loop.run_in_executor(None, inboxes[index].put, batch)
+            routed[index] += len(batch)
+
+    async def poll():
+        nonlocal offset
+        while True:
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    shard_log.warning("⚠️ Shard worker %d exited (%s), restarting", index + 1, process.exitcode)
+                    processes[index] = start_shard_worker(ctx, index, inboxes[index], limits)
+            try:
+                updates = await bot.get_updates(
+                    offset=offset, timeout=30, read_timeout=35,
+                    allowed_updates=Update.ALL_TYPES
+                )
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                shard_log.warning("Shard front polling error: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if updates:
+                await route(updates)
+                offset = updates[-1].update_id + 1
+
+    async with bot:
+        await bot.delete_webhook()
+        shard_log.info("🔀 Routing updates to %d shard workers", workers)
+        poller = asyncio.create_task(poll())
+        stopper = asyncio.create_task(stop_event.wait())
+        await asyncio.wait([poller, stopper], return_when=asyncio.FIRST_COMPLETED)
+        stopper.cancel()
+        poller.cancel()
+        try:
+            await poller
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            shard_log.exception("Shard front polling stopped: %s", e)
+        if offset is not None:
+            # Confirm the last routed update so it isn't delivered again
+            await bot.get_updates(offset=offset, timeout=0)
+
+    for inbox in inboxes:
+        await loop.run_in_executor(None, inbox.put, None)
+    for index, process in enumerate(processes):
+        await loop.run_in_executor(None, process.join, SHARD_STOP_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+        shard_log.info("Shard worker %d: %d updates routed", index + 1, routed[index])
 
 def is_authorized(user_id: int) -> bool:
     return user_id == OWNER_ID or user_id in ALLOWED_USERS
@@ -78,17 +2929,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Initialize or Reset user state
-    USER_STATE[user_id] = {
-        "current_method": None,
-        "status": "selecting_method",
-        "session_files": [],
-        "saved_key": None,
-        "apk_posts": [],
-        "waiting_key": False,
-        "last_apk_time": None,
-        "last_post_link": None,
-        "preview_message_id": None
-    }
+    cancel_method2_timer(user_id)
+    USER_STATE[user_id] = Session(SessionStatus.SELECTING_METHOD)
 
     keyboard = [
         [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
@@ -120,10 +2962,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "➔ /resetcaption - Reset Caption\n"
             "➔ /resetchannelid - Reset Channel\n"
             "➔ /reset - Full Reset\n\n"
-            "➔ /adduser - Add Allowed User\n"
-            "➔ /removeuser - Remove User\n"
+            "➔ /adduser - Add Users (IDs or .txt)\n"
+            "➔ /removeuser - Remove Users\n"
             "➔ /userlist - List Users\n"
+            "➔ /stats - Bot Internals\n"
             "➔ /ping - Bot Status\n"
+            "➔ /ping stats - Latency p50/p95\n"
             "➔ /rules - Bot Rules\n",
             parse_mode="Markdown",
             reply_markup=InlineKeyboardMarkup(keyboard)
@@ -146,64 +2990,136 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("❌ You are not allowed to use this bot.")
         
+# --- User administration ---
+# /adduser and /removeuser take any number of ids (spaces, commas or new
+# lines), or a .txt file sent with the command as caption or replied to with
+# it; each call is one storage transaction. /userlist pages through the
+# allowed users in id order, using the first/last id on screen as cursor.
+USER_FILE_MAX_BYTES = 1024 * 1024
+USERLIST_PAGE_SIZE = int(os.getenv("USERLIST_PAGE_SIZE", "10"))
+USER_FILE_COMMANDS = re.compile(r"^/(adduser|removeuser)(@\w+)?(\s|$)", re.IGNORECASE)
+USER_ID_SEPARATORS = re.compile(r"[\s,;]+")
+
+def parse_user_ids(text: str):
+    """Split free text into (ids, invalid tokens); '#' starts a comment."""
+    user_ids, invalid = [], []
+    for line in text.splitlines():
+        for token in USER_ID_SEPARATORS.split(line.split("#", 1)[0]):
+            if not token:
+                continue
+            try:
+                user_ids.append(int(token))
+            except ValueError:
+                invalid.append(token)
+    return user_ids, invalid
+
+async def user_ids_from_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    parts = (message.text or message.caption or "").split(None, 1)
+    text = parts[1] if len(parts) > 1 else ""
+
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if document and (document.file_name or "").lower().endswith(".txt") and (document.file_size or 0) <= USER_FILE_MAX_BYTES:
+        file = await context.bot.get_file(document.file_id)
+        text += "\n" + (await file.download_as_bytearray()).decode("utf-8", errors="replace")
+
+    return parse_user_ids(text)
+
+def bulk_user_summary(title: str, unchanged_label: str, unchanged: int, invalid: list) -> str:
+    shown = ", ".join(f"<code>{html.escape(token[:20])}</code>" for token in invalid[:5])
+    if len(invalid) > 5:
+        shown += ", …"
+    return (
+        f"{title}\n"
+        f"├─ {unchanged_label} : {unchanged}\n"
+        f"└─ Invalid : {len(invalid)}{' (' + shown + ')' if invalid else ''}"
+    )
+
 async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("𝖮𝗍𝗁𝖺 𝖡𝖺𝖺𝖽𝗎 🫵🏼. 𝖢𝗈𝗇𝗍𝖺𝖼𝗍 𝖸𝗈𝗎𝗋 𝖺𝖽𝗆𝗂𝗇 @Ceo_DarkFury 🌝")
         return
 
-    if not context.args:
+    user_ids, invalid = await user_ids_from_command(update, context)
+    if not user_ids and not invalid:
         await update.message.reply_text(
-            "⚠️ *Oops\\!* You forgot to give a user ID\\.\n\nTry like this:\n`/adduser \\<user_id\\>` ✍️",
+            "⚠️ *Oops\\!* You forgot to give a user ID\\.\n\nTry like this:\n`/adduser \\<user_id\\> \\<user_id\\> …` ✍️\n"
+            "Or send a \\.txt file of IDs with `/adduser` as caption\\.",
             parse_mode="MarkdownV2"
         )
-        return        
-
-    try:
-        user_id = int(context.args[0])
-        ALLOWED_USERS.add(user_id)
-        save_config()
-        await update.message.reply_text(f"✅ User `{user_id}` added successfully!", parse_mode="Markdown")
-    except ValueError:
+        return
+    if not user_ids:
         await update.message.reply_text("Hmm... that doesn't look like a valid user ID. Try a number! 🔢")
+        return
+
+    added = await add_allowed_users(user_ids)
+    if len(user_ids) == 1 and not invalid:
+        await update.message.reply_text(f"✅ User `{user_ids[0]}` added successfully!", parse_mode="Markdown")
+        return
+
+    await update.message.reply_text(
+        bulk_user_summary(f"✅ <b>{len(added)} Users Added!</b>",
+                          "Already Allowed", len(set(user_ids)) - len(added), invalid),
+        parse_mode="HTML"
+    )
 
 async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("🗣️𝖳𝗁𝗂𝗋𝗎𝗆𝖻𝗂 𝖯𝖺𝖺𝗋𝗎𝖽𝖺 𝖳𝗁𝖾𝗏𝖽𝗂𝗒𝖺 𝖯𝖺𝗂𝗒𝖺")
         return
 
-    if not context.args:
+    user_ids, invalid = await user_ids_from_command(update, context)
+    if not user_ids and not invalid:
         await update.message.reply_text(
-            "📝 *Usage:* `/removeuser` \\<user\\_id\\>\\ Don\\'t leave me hanging\\!",
+            "📝 *Usage:* `/removeuser` \\<user\\_id\\> \\<user\\_id\\> …\\ Don\\'t leave me hanging\\!",
             parse_mode=ParseMode.MARKDOWN_V2
         )
         return
+    if not user_ids:
+        await update.message.reply_text("❌ That doesn't look like a valid user ID. Numbers only, please! 🔢")
+        return
 
-    try:
-        user_id = int(context.args[0])
-        ALLOWED_USERS.discard(user_id)
-        save_config()
+    removed = await remove_allowed_users(user_ids)
+    if len(user_ids) == 1 and not invalid:
         await update.message.reply_text(
-            f"👋 *User* `{user_id}` *has been kicked out of the VIP list!* 🚪💨",
+            f"👋 *User* `{user_ids[0]}` *has been kicked out of the VIP list!* 🚪💨",
             parse_mode="Markdown"
         )
-    except ValueError:
-        await update.message.reply_text("❌ That doesn't look like a valid user ID. Numbers only, please! 🔢")
-
-async def userlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("𝖮𝗋𝗎𝗎 𝗉𝖺𝗂𝗒𝖺𝗌𝖺𝗏𝗎𝗄𝗄𝗎🥴 𝖯𝗎𝗋𝖺𝗃𝖺𝗇𝖺𝗆 𝗂𝗅𝖺 𝖽𝖺𝖺 𝗉𝗎𝗇𝖽𝖺 🫵🏼")
         return
 
-    if not ALLOWED_USERS:
-        await update.message.reply_text("No allowed users.")
-        return
+    await update.message.reply_text(
+        bulk_user_summary(f"👋 <b>{len(removed)} Users Removed!</b>",
+                          "Not In List", len(set(user_ids)) - len(removed), invalid),
+        parse_mode="HTML"
+    )
+
+async def user_file_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """A document captioned /adduser or /removeuser."""
+    command = USER_FILE_COMMANDS.match(update.message.caption).group(1).lower()
+    await (add_user if command == "adduser" else remove_user)(update, context)
+
+def userlist_page(after: int = None, before: int = None):
+    """Render the page after (or before) a cursor id; returns (text, markup)."""
+    if before is not None:
+        page = sorted(heapq.nlargest(USERLIST_PAGE_SIZE, (u for u in ALLOWED_USERS if u < before)))
+    elif after is not None:
+        page = heapq.nsmallest(USERLIST_PAGE_SIZE, (u for u in ALLOWED_USERS if u > after))
+    else:
+        page = []
+    if not page:
+        # No cursor, or the users around it were removed meanwhile
+        page = heapq.nsmallest(USERLIST_PAGE_SIZE, ALLOWED_USERS)
 
-    lines = [f"🧾 <b>Total Allowed Users:</b> {len(ALLOWED_USERS)}\n"]
-    for index, user_id in enumerate(ALLOWED_USERS, start=1):
+    total = len(ALLOWED_USERS)
+    rank = sum(1 for u in ALLOWED_USERS if u < page[0])
+    pages = -(-total // USERLIST_PAGE_SIZE)
+
+    lines = [f"🧾 <b>Total Allowed Users:</b> {total} • Page {min(pages, rank // USERLIST_PAGE_SIZE + 1)}/{pages}\n"]
+    for index, user_id in enumerate(page, start=rank + 1):
         user_data = USER_DATA.get(str(user_id), {})
-        nickname = user_data.get("first_name", "—")
-        username = user_data.get("username", "—")
-        channel = user_data.get("channel", "—")
+        nickname = html.escape(user_data.get("first_name", "—"))
+        username = html.escape(user_data.get("username", "—"))
+        channel = html.escape(str(user_data.get("channel") or "—"))
 
         lines.append(
             f"📌 <b>User {index}</b>\n"
@@ -214,7 +3130,24 @@ async def userlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "━━━━━━━━━━━━━━━━━━━━"
         )
 
-    await update.message.reply_text("\n".join(lines), parse_mode="HTML", disable_web_page_preview=True)
+    buttons = []
+    if rank > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"userlist_prev_{page[0]}"))
+    if rank + len(page) < total:
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"userlist_next_{page[-1]}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def userlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != OWNER_ID:
+        await update.message.reply_text("𝖮𝗋𝗎𝗎 𝗉𝖺𝗂𝗒𝖺𝗌𝖺𝗏𝗎𝗄𝗄𝗎🥴 𝖯𝗎𝗋𝖺𝗃𝖺𝗇𝖺𝗆 𝗂𝗅𝖺 𝖽𝖺𝖺 𝗉𝗎𝗇𝖽𝖺 🫵🏼")
+        return
+
+    if not ALLOWED_USERS:
+        await update.message.reply_text("No allowed users.")
+        return
+
+    text, markup = userlist_page()
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup, disable_web_page_preview=True)
     
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_authorized(update.effective_user.id):
@@ -226,14 +3159,133 @@ async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     hours, remainder = divmod(remainder, 3600)
     minutes, seconds = divmod(remainder, 60)
 
-    ping_ms = round(random.uniform(10, 80), 2)
+    if context.args and context.args[0].lower() == "stats":
+        if update.effective_user.id != OWNER_ID:
+            await update.message.reply_text("❌ Only Owner can view ping stats!")
+            return
+        await update.message.reply_text(ping_stats_text(), parse_mode="HTML")
+        return
+
+    # Read on demand, outside the sample windows, so /ping bursts don't
+    # skew the /ping stats percentiles
+    try:
+        api_ms = f"{await HEALTH.measure_api(context.bot, record=False) * 1000:.2f} ms"
+    except Exception as e:
+        api_ms = f"failed ({type(e).__name__})"
+    now = HEALTH.readings(context.application)
+
+    loop_lag = HEALTH.samples["loop_lag"]
+    fetch_age = HEALTH.fetch_age()
     today = datetime.datetime.now().strftime("%d:%m:%Y")
 
     msg = (
         "🏓 <b>𝗣𝗼𝗻𝗴!</b>\n\n"
         f"    📅 <b>Update:</b> {today}\n"
         f"    ⏳ <b>Uptime:</b> {days}D : {hours}H : {minutes}M : {seconds}S\n"
-        f"    ⚡ <b>Ping:</b> {ping_ms} ms"
+        f"    ⚡ <b>Ping:</b> {api_ms}\n"
+        f"    🌀 <b>Loop Lag:</b> {(loop_lag[-1] if loop_lag else 0) * 1000:.2f} ms\n"
+        f"    🧵 <b>Tasks:</b> {now['tasks']}\n"
+        f"    📥 <b>Backlog:</b> {now['backlog']} updates\n"
+        f"    💾 <b>Memory:</b> {now['rss'] / 1024 / 1024:.1f} MB\n"
+        f"    🔄 <b>Last Fetch:</b> {'never' if fetch_age is None else f'{fetch_age:.1f}s ago'}"
+    )
+    await update.message.reply_text(msg, parse_mode="HTML")
+
+def ping_stats_text() -> str:
+    samples = HEALTH.samples
+    rows = [
+        ("⚡ Bot API RTT", [v * 1000 for v in samples["api_rtt"]], " ms"),
+        ("🌀 Loop Lag", [v * 1000 for v in samples["loop_lag"]], " ms"),
+        ("🧵 Tasks", samples["tasks"], ""),
+        ("📥 Backlog", samples["backlog"], ""),
+        ("💾 Memory", [v / 1024 / 1024 for v in samples["rss"]], " MB"),
+    ]
+    lines = ["📈 <b>Ping Stats</b> (rolling window)\n"]
+    for label, values, unit in rows:
+        lines.append(
+            f"<b>{label}</b> ({len(values)} samples)\n"
+            f"├─ p50 : {percentile(values, 50):.2f}{unit}\n"
+            f"└─ p95 : {percentile(values, 95):.2f}{unit}\n"
+        )
+    fetch_age = HEALTH.fetch_age()
+    lines.append(f"🔄 Last Fetch: {'never' if fetch_age is None else f'{fetch_age:.1f}s ago'}")
+    return "\n".join(lines)
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != OWNER_ID:
+        await update.message.reply_text("❌ Only Owner can view stats!")
+        return
+
+    calls = OUTBOUND_LIMITER.stats["calls"]
+    limiter_avg_ms = OUTBOUND_LIMITER.stats["total_delay"] / calls * 1000 if calls else 0.0
+    limiter_p95_ms = percentile(OUTBOUND_LIMITER.recent_delays, 95) * 1000
+
+    msg = (
+        "📊 <b>Bot Stats</b>\n\n"
+        f"📥 <b>Updates</b> ({BOT_MODE if SHARD_INDEX < 0 else f'shard {SHARD_INDEX + 1}/{SHARD_WORKERS}'})\n"
+        f"├─ Receive → Handler p50 : {percentile(UPDATE_LATENCY, 50) * 1000:.2f} ms\n"
+        f"└─ Receive → Handler p95 : {percentile(UPDATE_LATENCY, 95) * 1000:.2f} ms\n\n"
+        f"💾 <b>Config Persistence</b> ({STORAGE.name})\n"
+        f"├─ Flushes : {PERSIST_STATS['flushes']}\n"
+        f"├─ Coalesced Saves : {PERSIST_STATS['coalesced']}\n"
+        f"├─ Failures : {PERSIST_STATS['failures']}\n"
+        f"├─ Last Flush : {PERSIST_STATS['last_latency_ms']} ms\n"
+        f"├─ Last Size : {PERSIST_STATS['last_bytes']} bytes\n"
+        f"└─ Total Written : {PERSIST_STATS['total_bytes']} bytes\n\n"
+        "👥 <b>Sessions</b>\n"
+        f"├─ Live : {len(USER_STATE)} / {USER_STATE.max_sessions}\n"
+        f"├─ Created : {USER_STATE.stats['created']}\n"
+        f"├─ Expired (idle {USER_STATE.ttl / 3600:g}h) : {USER_STATE.stats['expired']}\n"
+        f"├─ Evicted (LRU) : {USER_STATE.stats['evicted']}\n"
+        f"└─ Approx Memory : {USER_STATE.approx_bytes() / 1024:.1f} KB\n\n"
+        "🗂️ <b>Session Snapshots</b>\n"
+        f"├─ Snapshots : {SESSION_SNAPSHOTS.stats['snapshots']}\n"
+        f"├─ Sessions Written : {SESSION_SNAPSHOTS.stats['written']}\n"
+        f"├─ Restored : {SESSION_SNAPSHOTS.stats['restored']}\n"
+        f"├─ Awaiting Restore : {len(SESSION_SNAPSHOTS.pending)}\n"
+        f"└─ Compactions : {SESSION_SNAPSHOTS.stats['compactions']}\n\n"
+        "⚙️ <b>Update Dispatch</b>\n"
+        f"├─ Concurrency Cap : {UPDATE_PROCESSOR.max_concurrent_updates}\n"
+        f"├─ Processed : {UPDATE_PROCESSOR.stats['processed']}\n"
+        f"├─ Serialized Behind Same Key : {UPDATE_PROCESSOR.stats['serialized']}\n"
+        f"├─ Active Keys : {len(UPDATE_PROCESSOR.key_locks)}\n"
+        f"└─ Queued : {UPDATE_PROCESSOR.queued()}\n\n"
+        "🐢 <b>Inbound Rate Limiter</b>\n"
+        f"├─ Admitted : {INBOUND_LIMITER.stats['admitted']}\n"
+        f"├─ Deferred : {INBOUND_LIMITER.stats['deferred']}\n"
+        f"├─ Dropped : {INBOUND_LIMITER.stats['dropped']}\n"
+        f"├─ Slow Down Replies : {INBOUND_LIMITER.stats['warned']}\n"
+        f"└─ Users Tracked : {len(INBOUND_LIMITER.users)}\n\n"
+        "🔘 <b>Button Callbacks</b>\n"
+        f"├─ Routed : {CALLBACKS.stats['routed']}\n"
+        f"├─ Unknown : {CALLBACKS.stats['unknown']}\n"
+        f"├─ Session Expired : {CALLBACKS.stats['expired']}\n"
+        f"├─ Suppressed (cooldown {CALLBACK_COOLDOWNS.window:g}s) : {CALLBACKS.stats['suppressed']}\n"
+        f"└─ Users In Cooldown : {len(CALLBACK_COOLDOWNS.last_press)} / {CALLBACK_COOLDOWNS.max_users}\n\n"
+        "🚦 <b>Outbound Rate Limiter</b>\n"
+        f"├─ Calls : {OUTBOUND_LIMITER.stats['calls']}\n"
+        f"├─ Delayed : {OUTBOUND_LIMITER.stats['delayed']}\n"
+        f"├─ Avg Delay : {limiter_avg_ms:.1f} ms\n"
+        f"├─ p95 Delay : {limiter_p95_ms:.1f} ms\n"
+        f"├─ Max Delay : {OUTBOUND_LIMITER.stats['max_delay'] * 1000:.1f} ms\n"
+        f"├─ RetryAfter Hits : {OUTBOUND_LIMITER.stats['retry_after']}\n"
+        f"└─ Given Up : {OUTBOUND_LIMITER.stats['dropped']}\n\n"
+        "📦 <b>File Metadata Cache</b>\n"
+        f"├─ Entries : {len(FILE_META.entries)} / {FILE_META.limit}\n"
+        f"├─ Hits : {FILE_META.stats['hits']}\n"
+        f"├─ Misses : {FILE_META.stats['misses']}\n"
+        f"└─ Evicted : {FILE_META.stats['evicted']}\n\n"
+        "♻️ <b>Forward Dedup</b>\n"
+        f"├─ Dropped : {DEDUP.stats['dropped']}\n"
+        f"├─ In Memory : {len(DEDUP.memory)} / {DEDUP.memory_size}\n"
+        f"├─ Claimed (scheduled) : {len(DEDUP.claims)}\n"
+        f"├─ Memory / Disk Hits : {DEDUP.stats['memory_hits']} / {DEDUP.stats['disk_hits']}\n"
+        f"└─ Purged : {DEDUP.stats['purged']}\n\n"
+        "📝 <b>Logging</b>\n"
+        f"├─ Queued : {LOG_STATS['queued']}\n"
+        f"├─ Backlog : {LOG_LISTENER.queue.qsize()} / {LOG_QUEUE_SIZE}\n"
+        f"├─ Dropped (queue full) : {LOG_STATS['dropped']}\n"
+        f"└─ Sampled Out : {LOG_STATS['sampled_out']}"
     )
     await update.message.reply_text(msg, parse_mode="HTML")
 
@@ -256,8 +3308,7 @@ async def reset_caption(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🫥𝖭𝖺𝖺𝗇𝗍𝗁𝖺𝗇 𝖽𝖺𝖺 𝗅𝖾𝗈𝗈")
         return
 
-    USER_DATA[str(user_id)]["caption"] = ""
-    save_config()
+    await set_user_field(user_id, "caption", "")
     await update.message.reply_text(
         "🧼 *Caption Cleared\\!* \nReady for a fresh start\\? ➕\nUse /SetCaption to drop a new vibe 🎯",
         parse_mode="MarkdownV2"
@@ -269,8 +3320,7 @@ async def reset_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🗣️𝖮𝗈𝗆𝖻𝗎𝗎𝗎")
         return
 
-    USER_DATA[str(user_id)]["channel"] = ""
-    save_config()
+    await set_user_field(user_id, "channel", "")
     await update.message.reply_text(
         "📡 *Channel ID wiped\\!* ✨\nSet new one: /setchannelid 🛠️🚀",
         parse_mode="MarkdownV2"
@@ -281,10 +3331,7 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🗣️𝖮𝗈𝗆𝖻𝗎𝗎𝗎")
         return
 
-    for user_id in USER_DATA:
-        USER_DATA[user_id]["channel"] = ""
-        USER_DATA[user_id]["caption"] = ""
-    save_config()
+    await reset_all_user_data()
     
     await update.message.reply_text(
         "🧹 *Cleaned up\\!*\n"
@@ -299,7 +3346,7 @@ async def set_channel_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🗣️ 𝖮𝗈𝗆𝖻𝗎𝗎𝗎")
         return
 
-    USER_STATE[user_id] = {"status": "waiting_channel"}
+    USER_STATE[user_id] = Session(SessionStatus.WAITING_CHANNEL)
     await update.message.reply_text(
         "🔧 *Setup Time\\!*\n"
         "Send me your Channel ID now\\. 📡\n"
@@ -313,11 +3360,12 @@ async def set_caption(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("𝖮𝗈𝗆𝖻𝗎𝗎𝗎 😭")
         return
 
-    USER_STATE[user_id] = {"status": "waiting_caption"}
+    USER_STATE[user_id] = Session(SessionStatus.WAITING_CAPTION)
     await update.message.reply_text(
         "📝 *Caption Time\\!*\n"
         "Send me your Caption Including\\. ↙️\n"
-        "The Placeholder `Key \\-` 🔑",
+        "The Placeholder `Key \\-` 🔑\n"
+        "Optional: `{file_name}` `{file_size}` 📦",
         parse_mode="MarkdownV2"
     )
     
@@ -348,7 +3396,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- Now continue with your logic ---
     state = USER_STATE.get(user_id)
-    if not state or not state.get("current_method"):
+    if not state or not state.current_method:
         keyboard = [
             [InlineKeyboardButton("⚡ Choose Method", callback_data="back_to_methods")]
         ]
@@ -360,7 +3408,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    method = state.get("current_method")
+    method = state.current_method
     
     if method == "method1":
         await process_method1_apk(update, context)
@@ -375,10 +3423,8 @@ async def process_method1_apk(update: Update, context: ContextTypes.DEFAULT_TYPE
     doc = update.message.document
     caption = update.message.caption or ""
 
-    match = re.search(r'Key\s*-\s*(\S+)', caption)
-    if match:
-        key = match.group(1)
-
+    key = caption_keys(DEFAULT_KEY_EXTRACTOR, update.message) if caption else ""
+    if key:
         user_info = USER_DATA.get(str(user_id), {})
         saved_caption = user_info.get("caption", "")
         channel_id = user_info.get("channel", "")
@@ -390,19 +3436,27 @@ async def process_method1_apk(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return
 
-        final_caption = saved_caption.replace("Key -", f"Key - <code>{key}</code>")
+        final_caption = user_caption_template(user_id).render(
+            key, "mono", file_name=doc.file_name, file_size=doc.file_size
+        )
         await context.bot.send_document(
             chat_id=channel_id,
             document=doc.file_id,
             caption=final_caption,
             parse_mode="HTML"
         )
-        await update.message.reply_text("✅ *APK posted successfully!*", parse_mode="Markdown")
+        # Say which keys were read: every supported format counts, not just "Key -"
+        await update.message.reply_text(
+            f"✅ <b>APK posted successfully!</b>\n🔑 Key: <code>{html.escape(keys_label(key))}</code>",
+            parse_mode="HTML"
+        )
 
     else:
         # If key missing, ask to send key manually
-        USER_STATE[user_id]["waiting_key"] = True
-        USER_STATE[user_id]["file_id"] = doc.file_id
+        USER_STATE[user_id].waiting_key = True
+        USER_STATE[user_id].file_id = doc.file_id
+        USER_STATE[user_id].file_name = doc.file_name
+        USER_STATE[user_id].file_size = doc.file_size
         await update.message.reply_text("⏳ *Send the Key now!*", parse_mode="Markdown")
 
 async def process_method2_apk(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -411,16 +3465,15 @@ async def process_method2_apk(update: Update, context: ContextTypes.DEFAULT_TYPE
     file_id = doc.file_id
     file_name = doc.file_name or ""
 
-    state = USER_STATE.setdefault(user_id, {})
-    session_files = state.setdefault("session_files", [])
-    session_filenames = state.setdefault("session_filenames", [])
+    state = USER_STATE.setdefault(user_id, Session())
 
-    # Save the file
-    session_files.append(file_id)
-    session_filenames.append(file_name)
+    # Save the file, keeping its metadata for previews
+    state.add_file(file_id, file_name, doc.file_unique_id)
+    session_files = state.session_files
+    FILE_META.put(doc.file_unique_id, file_id, file_name, doc.file_size)
 
     # Progress message handling (same as your current)
-    message_id = state.get("progress_message_id")
+    message_id = state.progress_message_id
     chat_id = update.message.chat_id
 
     if message_id:
@@ -432,7 +3485,7 @@ async def process_method2_apk(update: Update, context: ContextTypes.DEFAULT_TYPE
                 parse_mode="Markdown"
             )
         except Exception as e:
-            print(f"Error editing progress message: {e}")
+            upload_log.warning("Error editing progress message: %s", e)
             message_id = None
 
     if not message_id:
@@ -440,21 +3493,61 @@ async def process_method2_apk(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"✅ {len(session_files)} APKs Received! ☑️\nWaiting 5 seconds for next APK...",
             parse_mode="Markdown"
         )
-        state["progress_message_id"] = sent_msg.message_id
-
-    USER_STATE[user_id]["last_apk_time"] = time.time()
-
-    context.application.create_task(countdown_and_check(user_id, chat_id, context))
+        state.progress_message_id = sent_msg.message_id
+
+    USER_STATE[user_id].last_apk_time = time.time()
+
+    # Debounce: every new APK restarts the session's single countdown
+    restart_method2_timer(user_id, chat_id, context)
+
+def restart_method2_timer(user_id, chat_id, context):
+    cancel_method2_timer(user_id)
+    task = context.application.create_task(countdown_and_check(user_id, chat_id, context))
+    METHOD2_TIMERS[user_id] = task
+
+    def forget(finished, user_id=user_id):
+        if METHOD2_TIMERS.get(user_id) is finished:
+            del METHOD2_TIMERS[user_id]
+
+    task.add_done_callback(forget)
+
+def cancel_method2_timer(user_id):
+    task = METHOD2_TIMERS.pop(user_id, None)
+    if task and not task.done():
+        task.cancel()
+
+def render_session_captions(user_id, state, key, key_mode, file_sizes=None) -> list:
+    """Pass file_sizes when the caller already has them from session_file_sizes()."""
+    template = user_caption_template(user_id)
+    session_files = state.session_files
+    session_filenames = state.session_filenames
+    session_unique_ids = state.session_unique_ids
+    total = len(session_files)
+    if file_sizes is None:
+        file_sizes = []
+        for idx in range(total):
+            meta = FILE_META.get(session_unique_ids[idx]) if idx < len(session_unique_ids) else None
+            file_sizes.append(meta["file_size"] if meta else None)
+    captions = []
+    for idx in range(1, total + 1):
+        captions.append(template.render(
+            key,
+            key_mode,
+            file_position(idx, total),
+            file_name=session_filenames[idx - 1] if idx <= len(session_filenames) else "",
+            file_size=file_sizes[idx - 1]
+        ))
+    return captions
 
 async def method2_send_to_channel(user_id, context):
     user_info = USER_DATA.get(str(user_id), {})
     channel_id = user_info.get("channel")
     saved_caption = user_info.get("caption")
-    state = USER_STATE.get(user_id, {})
+    state = USER_STATE.get(user_id) or Session()
 
-    session_files = state.get("session_files", [])
-    key = state.get("saved_key", "")
-    key_mode = state.get("key_mode", "normal")
+    session_files = state.session_files
+    key = state.saved_key
+    key_mode = state.key_mode
 
     if not channel_id or not saved_caption or not session_files or not key:
         await context.bot.send_message(
@@ -464,57 +3557,47 @@ async def method2_send_to_channel(user_id, context):
         )
         return
 
-    posted_ids = []
-    last_message = None
+    # Middle APKs get just the key, the last (or only) one the full caption
+    captions = render_session_captions(user_id, state, key, key_mode)
 
-    for idx, file_id in enumerate(session_files, start=1):
-        is_last_apk = (idx == len(session_files))
-    
-        if key_mode == "quote":
-            if len(session_files) == 1 or is_last_apk:
-                # Only 1 APK or last APK
-                caption = saved_caption.replace("Key -", f"<blockquote>Key - <code>{key}</code></blockquote>")
-            else:
-                # Middle APKs
-                caption = f"<blockquote>Key - <code>{key}</code></blockquote>"
-    
-        elif key_mode == "mono":
-            if len(session_files) == 1 or is_last_apk:
-                caption = saved_caption.replace("Key -", f"Key - <code>{key}</code>")
-            else:
-                caption = f"Key - <code>{key}</code>"
-    
-        else:  # normal
-            if len(session_files) == 1 or is_last_apk:
-                caption = saved_caption.replace("Key -", f"Key - {key}")
-            else:
-                caption = f"Key - {key}"
+    # Post the whole batch as one album; fall back to one post per file
+    sent_messages = []
+    grouped = False
 
-        sent_message = await context.bot.send_document(
-            chat_id=channel_id,
-            document=file_id,
-            caption=caption,
-            parse_mode="HTML"
-        )
-        posted_ids.append(sent_message.message_id)
-        last_message = sent_message
-
-    USER_STATE[user_id]["apk_posts"] = posted_ids
-
-    if len(posted_ids) == 1:
-        # 1 APK posted - Session ends quietly
-        USER_STATE[user_id]["session_files"] = []
-        USER_STATE[user_id]["session_filenames"] = []
-        USER_STATE[user_id]["saved_key"] = None
-        USER_STATE[user_id]["waiting_key"] = False
-        USER_STATE[user_id]["last_apk_time"] = None
-        USER_STATE[user_id]["key_mode"] = "normal"
+    if len(session_files) >= 2:
+        try:
+            media = [
+                InputMediaDocument(media=file_id, caption=caption, parse_mode="HTML")
+                for file_id, caption in zip(session_files, captions)
+            ]
+            sent_messages = list(await context.bot.send_media_group(chat_id=channel_id, media=media))
+            grouped = True
+        except Exception as e:
+            upload_log.warning("Media group post failed, sending files one by one: %s", e)
+
+    if not grouped:
+        for file_id, caption in zip(session_files, captions):
+            sent_message = await context.bot.send_document(
+                chat_id=channel_id,
+                document=file_id,
+                caption=caption,
+                parse_mode="HTML"
+            )
+            sent_messages.append(sent_message)
+
+    posted_ids = [msg.message_id for msg in sent_messages]
+    last_message = sent_messages[-1] if sent_messages else None
+
+    USER_STATE[user_id].apk_posts = posted_ids
+
+    if len(posted_ids) == 1 or grouped:
+        # 1 APK or an album posted - Session ends quietly
+        USER_STATE[user_id].end_batch()
         # DO NOT touch current_method or status
     else:
         # 2-3 APKs, wait for auto recaption
-        USER_STATE[user_id]["session_files"] = session_files
-        USER_STATE[user_id]["waiting_key"] = False
-        USER_STATE[user_id]["last_apk_time"] = None
+        USER_STATE[user_id].waiting_key = False
+        USER_STATE[user_id].last_apk_time = None
 
     if last_message:
         if channel_id.startswith("@"):
@@ -524,11 +3607,12 @@ async def method2_send_to_channel(user_id, context):
         else:
             post_link = "Unknown"
 
-        USER_STATE[user_id]["last_post_link"] = post_link
+        USER_STATE[user_id].last_post_link = post_link
 
     buttons = [[InlineKeyboardButton("📄 View Last Post", url=post_link)]]
 
-    if len(posted_ids) >= 2:
+    if len(posted_ids) >= 2 and not grouped:
+        # Separate posts only: Re-Caption merges them into an album
         buttons.append([InlineKeyboardButton("✏️ Auto Re-Caption", callback_data="auto_recaption")])
 
     buttons.append([InlineKeyboardButton("🗑️ Delete APK Post", callback_data="delete_apk_post")])
@@ -536,7 +3620,7 @@ async def method2_send_to_channel(user_id, context):
 
     await context.bot.edit_message_text(
         chat_id=user_id,
-        message_id=state.get("preview_message_id"),
+        message_id=state.preview_message_id,
         text="✅ <b>All APKs Posted Successfully!</b>\n\nManage your posts below:",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup(buttons)
@@ -544,14 +3628,13 @@ async def method2_send_to_channel(user_id, context):
 
 async def auto_recaption(user_id, context):
     user_info = USER_DATA.get(str(user_id), {})
-    state = USER_STATE.get(user_id, {})
+    state = USER_STATE.get(user_id) or Session()
     channel_id = user_info.get("channel")
-    saved_caption = user_info.get("caption", "")
-    session_files = state.get("session_files", [])
-    key = state.get("saved_key", "")
-    key_mode = state.get("key_mode", "normal")
-    old_posts = state.get("apk_posts", [])
-    preview_message_id = state.get("preview_message_id")
+    session_files = state.session_files
+    key = state.saved_key
+    key_mode = state.key_mode
+    old_posts = state.apk_posts
+    preview_message_id = state.preview_message_id
 
     if not channel_id or not session_files or not key:
         await context.bot.send_message(
@@ -561,29 +3644,11 @@ async def auto_recaption(user_id, context):
         )
         return
 
-    media = []
-    for idx, file_id in enumerate(session_files, start=1):
-        is_last_apk = (idx == len(session_files))
-    
-        if key_mode == "quote":
-            if len(session_files) == 1 or is_last_apk:
-                caption = saved_caption.replace("Key -", f"<blockquote>Key - <code>{key}</code></blockquote>")
-            else:
-                caption = f"<blockquote>Key - <code>{key}</code></blockquote>"
-    
-        elif key_mode == "mono":
-            if len(session_files) == 1 or is_last_apk:
-                caption = saved_caption.replace("Key -", f"Key - <code>{key}</code>")
-            else:
-                caption = f"Key - <code>{key}</code>"
-    
-        else:  # normal
-            if len(session_files) == 1 or is_last_apk:
-                caption = saved_caption.replace("Key -", f"Key - {key}")
-            else:
-                caption = f"Key - {key}"
-    
-        media.append(InputMediaDocument(media=file_id, caption=caption, parse_mode="HTML"))
+    captions = render_session_captions(user_id, state, key, key_mode)
+    media = [
+        InputMediaDocument(media=file_id, caption=caption, parse_mode="HTML")
+        for file_id, caption in zip(session_files, captions)
+    ]
 
     # Send corrected media group
     new_posts = await context.bot.send_media_group(chat_id=channel_id, media=media)
@@ -596,7 +3661,7 @@ async def auto_recaption(user_id, context):
             pass
 
     # Update new post links
-    USER_STATE[user_id]["apk_posts"] = [msg.message_id for msg in new_posts]
+    USER_STATE[user_id].apk_posts = [msg.message_id for msg in new_posts]
     last_msg = new_posts[-1]
 
     if channel_id.startswith("@"):
@@ -606,7 +3671,7 @@ async def auto_recaption(user_id, context):
     else:
         post_link = "Unknown"
 
-    USER_STATE[user_id]["last_post_link"] = post_link
+    USER_STATE[user_id].last_post_link = post_link
 
     # Build buttons
     buttons = [
@@ -625,37 +3690,14 @@ async def auto_recaption(user_id, context):
             reply_markup=InlineKeyboardMarkup(buttons)
         )
     except Exception as e:
-        print(f"Error editing message after auto-recaption: {e}")
+        upload_log.warning("Error editing message after auto-recaption: %s", e)
 
     # Important: Session ends quietly after re-caption
-    USER_STATE[user_id]["session_files"] = []
-    USER_STATE[user_id]["session_filenames"] = []
-    USER_STATE[user_id]["saved_key"] = None
-    USER_STATE[user_id]["waiting_key"] = False
-    USER_STATE[user_id]["last_apk_time"] = None
-    USER_STATE[user_id]["key_mode"] = "normal"
-
-async def check_session_timeout(user_id, context):
-    await asyncio.sleep(5)
-
-    state = USER_STATE.get(user_id)
-    if not state:
-        return
-
-    last_apk_time = state.get("last_apk_time")
-    if not last_apk_time:
-        return
-
-    now = time.time()
-    if now - last_apk_time >= 5:
-        # Timeout reached, move to key capture
-        session = state.get("session_files", [])
-        if session:
-            await ask_key_for_method2(user_id, context)
+    USER_STATE[user_id].end_batch()
 
 async def ask_key_for_method2(user_id, context):
     chat_id = user_id
-    USER_STATE[user_id]["waiting_key"] = True
+    USER_STATE[user_id].waiting_key = True
 
     await context.bot.send_message(
         chat_id=chat_id,
@@ -681,33 +3723,33 @@ async def countdown_and_check(user_id, chat_id, context):
         for remaining in range(5, 0, -1):
             await asyncio.sleep(1)
 
-            state = USER_STATE.get(user_id, {})
-            message_id = state.get("progress_message_id")
+            state = USER_STATE.get(user_id) or Session()
+            message_id = state.progress_message_id
 
             if message_id:
                 try:
                     await context.bot.edit_message_text(
                         chat_id=chat_id,
                         message_id=message_id,
-                        text=f"✅ {len(state.get('session_files', []))} APKs Received! ☑️\nWaiting {remaining} sec for next APK...",
+                        text=f"✅ {len(state.session_files)} APKs Received! ☑️\nWaiting {remaining} sec for next APK...",
                         parse_mode="Markdown"
                     )
-                except telegram.error.BadRequest as e:
+                except BadRequest as e:
                     if "Message is not modified" in str(e):
                         pass  # Safe ignore
                     else:
-                        print(f"Countdown edit failed: {e}")
+                        upload_log.warning("Countdown edit failed: %s", e)
                         break
 
         # After countdown complete, check if session still active
-        state = USER_STATE.get(user_id, {})
-        session_files = state.get("session_files", [])
-        if session_files and not state.get("waiting_key", False):
+        state = USER_STATE.get(user_id) or Session()
+        session_files = state.session_files
+        if session_files and not state.waiting_key:
             # Now ask for the Key
             try:
                 await context.bot.edit_message_text(
                     chat_id=chat_id,
-                    message_id=state["progress_message_id"],
+                    message_id=state.progress_message_id,
                     text="🔑 *Send the Key now!* (Only one Key for 2-3 APKs)",
                     parse_mode="Markdown"
                 )
@@ -719,11 +3761,12 @@ async def countdown_and_check(user_id, chat_id, context):
                     parse_mode="Markdown"
                 )
 
-            USER_STATE[user_id]["waiting_key"] = True
-            USER_STATE[user_id]["progress_message_id"] = None
+            USER_STATE[user_id].waiting_key = True
+            USER_STATE[user_id].progress_message_id = None
+            SESSION_SNAPSHOTS.mark_dirty(user_id)
 
     except Exception as e:
-        print(f"Countdown error: {e}")
+        upload_log.exception("Countdown error: %s", e)
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -758,12 +3801,10 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Handle Channel Setting
-    if state.get("status") == "waiting_channel":
+    if state.status == SessionStatus.WAITING_CHANNEL:
         channel_id = update.message.text.strip()
-        USER_DATA[str(user_id)] = USER_DATA.get(str(user_id), {})
-        USER_DATA[str(user_id)]["channel"] = channel_id
-        save_config()
-        USER_STATE[user_id]["status"] = "normal"
+        await set_user_field(user_id, "channel", channel_id)
+        USER_STATE[user_id].status = SessionStatus.NORMAL
     
         keyboard = [
             [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
@@ -781,7 +3822,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Handle Caption Setting
-    if state.get("status") == "waiting_caption":
+    if state.status == SessionStatus.WAITING_CAPTION:
         caption = update.message.text.strip()
         if "Key -" not in caption:
             await update.message.reply_text(
@@ -789,10 +3830,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode="Markdown"
             )
         else:
-            USER_DATA[str(user_id)] = USER_DATA.get(str(user_id), {})
-            USER_DATA[str(user_id)]["caption"] = caption
-            save_config()
-            USER_STATE[user_id]["status"] = "normal"
+            await set_user_field(user_id, "caption", caption)
+            USER_STATE[user_id].status = SessionStatus.NORMAL
     
             keyboard = [
                 [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
@@ -811,11 +3850,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
     # Handle waiting key for Method 1
-    if state.get("waiting_key") and state.get("current_method") == "method1":
+    if state.waiting_key and state.current_method == "method1":
         key = update.message.text.strip()
         saved_caption = USER_DATA.get(str(user_id), {}).get("caption", "")
         channel_id = USER_DATA.get(str(user_id), {}).get("channel", "")
-        file_id = state.get("file_id")
+        file_id = state.file_id
 
         if not key or not file_id or not saved_caption or not channel_id:
             await update.message.reply_text(
@@ -824,7 +3863,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        final_caption = saved_caption.replace("Key -", f"Key - <code>{key}</code>")
+        final_caption = user_caption_template(user_id).render(
+            key, "mono", file_name=state.file_name, file_size=state.file_size
+        )
         await context.bot.send_document(
             chat_id=channel_id,
             document=file_id,
@@ -833,14 +3874,14 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         await update.message.reply_text("✅ *APK posted successfully!*", parse_mode="Markdown")
 
-        USER_STATE[user_id]["waiting_key"] = False
-        USER_STATE[user_id]["file_id"] = None
+        USER_STATE[user_id].waiting_key = False
+        USER_STATE[user_id].file_id = None
         return
 
     # Handle waiting key for Method 2
-    if state.get("waiting_key") and state.get("current_method") == "method2":
+    if state.waiting_key and state.current_method == "method2":
         key = update.message.text.strip()
-        session_files = state.get("session_files", [])
+        session_files = state.session_files
     
         if not key or not session_files:
             await update.message.reply_text(
@@ -849,11 +3890,12 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
     
-        USER_STATE[user_id]["saved_key"] = key
-        USER_STATE[user_id]["waiting_key"] = False
-        USER_STATE[user_id]["progress_message_id"] = None  # STOP Countdown
-        USER_STATE[user_id]["quote_applied"] = False  # Important Reset
-        USER_STATE[user_id]["mono_applied"] = False  # Important Reset
+        cancel_method2_timer(user_id)
+        USER_STATE[user_id].saved_key = key
+        USER_STATE[user_id].waiting_key = False
+        USER_STATE[user_id].progress_message_id = None  # STOP Countdown
+        USER_STATE[user_id].quote_applied = False  # Important Reset
+        USER_STATE[user_id].mono_applied = False  # Important Reset
     
         buttons = [
             [InlineKeyboardButton("✅ Yes", callback_data="method2_yes"),
@@ -870,73 +3912,19 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=InlineKeyboardMarkup(buttons)
         )
     
-        USER_STATE[user_id]["preview_message_id"] = sent_message.message_id
+        USER_STATE[user_id].preview_message_id = sent_message.message_id
         return
 
     # Handle waiting new caption after Edit
-    if state.get("status") == "waiting_new_caption":
+    if state.status == SessionStatus.WAITING_NEW_CAPTION:
         await method2_edit_caption(update, context)
         return
 
-async def method2_edit_caption(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    new_caption = update.message.text.strip()
-
-    if "Key -" not in new_caption:
-        await update.message.reply_text(
-            "❌ *Invalid Caption!*\n\nIt must include `Key -` placeholder.",
-            parse_mode="Markdown"
-        )
-        return
-
-    # Save new Caption
-    USER_DATA[str(user_id)] = USER_DATA.get(str(user_id), {})
-    USER_DATA[str(user_id)]["caption"] = new_caption
-    save_config()
-
-    USER_STATE[user_id]["status"] = "normal"
-
-    # Update Preview
-    preview_message_id = USER_STATE.get(user_id, {}).get("preview_message_id")
-    key = USER_STATE.get(user_id, {}).get("saved_key", "")
-    session_files = USER_STATE.get(user_id, {}).get("session_files", [])
-
-    if not preview_message_id or not key or not session_files:
-        await update.message.reply_text(
-            "⚠️ *No active session found!*",
-            parse_mode="Markdown"
-        )
-        return
-
-    text = "✅ *New Caption Saved!*\n\n"
-    final_caption = new_caption.replace("Key -", f"Key - {key}")
-
-    for idx, _ in enumerate(session_files, start=1):
-        text += f"📦 APK {idx}: {final_caption}\n"
-
-    buttons = [
-        [InlineKeyboardButton("🔙 Back", callback_data="method2_back_fullmenu")]
-    ]
-
-    try:
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=preview_message_id,
-            text=text,
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    except telegram.error.BadRequest as e:
-        if "Error editing preview after caption" in str(e):
-            pass  # ignore if same
-        else:
-            raise e  # raise normally if another error
-
 async def method2_convert_quote(user_id, context: ContextTypes.DEFAULT_TYPE):
-    state = USER_STATE.get(user_id, {})
-    preview_message_id = state.get("preview_message_id")
-    key = state.get("saved_key", "")
-    session_files = state.get("session_files", [])
+    state = USER_STATE.get(user_id) or Session()
+    preview_message_id = state.preview_message_id
+    key = state.saved_key
+    session_files = state.session_files
 
     if not preview_message_id or not key or not session_files:
         await context.bot.send_message(
@@ -948,10 +3936,10 @@ async def method2_convert_quote(user_id, context: ContextTypes.DEFAULT_TYPE):
 
     text = "✅ *Key converted to Quote Style!*\n\n"
     for idx, _ in enumerate(session_files, start=1):
-        text += f"📦 APK {idx}: <blockquote>Key - <code>{key}</code></blockquote>\n"
+        text += f"📦 APK {idx}: {render_key(key, 'quote')}\n"
 
     # Mark quote_applied = True (for button hiding)
-    USER_STATE[user_id]["quote_applied"] = True
+    USER_STATE[user_id].quote_applied = True
 
     buttons = build_method2_buttons(user_id)  # Rebuild dynamic buttons
 
@@ -964,13 +3952,13 @@ async def method2_convert_quote(user_id, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=buttons
         )
     except Exception as e:
-        print(f"Error converting to quote style: {e}")
+        upload_log.warning("Error converting to quote style: %s", e)
 
 async def method2_convert_mono(user_id, context: ContextTypes.DEFAULT_TYPE):
-    state = USER_STATE.get(user_id, {})
-    preview_message_id = state.get("preview_message_id")
-    key = state.get("saved_key", "")
-    session_files = state.get("session_files", [])
+    state = USER_STATE.get(user_id) or Session()
+    preview_message_id = state.preview_message_id
+    key = state.saved_key
+    session_files = state.session_files
 
     if not preview_message_id or not key or not session_files:
         await context.bot.send_message(
@@ -982,10 +3970,10 @@ async def method2_convert_mono(user_id, context: ContextTypes.DEFAULT_TYPE):
 
     text = "✅ <code>Key converted to Normal Style!</code>\n\n"
     for idx, _ in enumerate(session_files, start=1):
-        text += f"📦 APK {idx}: Key - <code>{key}</code>\n"
+        text += f"📦 APK {idx}: {render_key(key, 'mono')}\n"
 
     # Mark mono_applied = True (for button hiding)
-    USER_STATE[user_id]["mono_applied"] = True
+    USER_STATE[user_id].mono_applied = True
 
     buttons = build_method2_buttons(user_id)  # Rebuild dynamic buttons
 
@@ -997,7 +3985,7 @@ async def method2_convert_mono(user_id, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="HTML",
             reply_markup=buttons
         )
-    except telegram.error.BadRequest as e:
+    except BadRequest as e:
         if "Error converting to mono style" in str(e):
             pass  # ignore if same
         else:
@@ -1015,17 +4003,16 @@ async def method2_edit_caption(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     # Save new caption
-    USER_DATA[str(user_id)] = USER_DATA.get(str(user_id), {})
-    USER_DATA[str(user_id)]["caption"] = new_caption
-    save_config()
+    await set_user_field(user_id, "caption", new_caption)
 
-    USER_STATE[user_id]["status"] = "normal"
-    USER_STATE[user_id]["quote_applied"] = False
-    USER_STATE[user_id]["mono_applied"] = False
+    state = USER_STATE[user_id]
+    state.status = SessionStatus.NORMAL
+    state.quote_applied = False
+    state.mono_applied = False
 
-    preview_message_id = USER_STATE.get(user_id, {}).get("preview_message_id")
-    key = USER_STATE.get(user_id, {}).get("saved_key", "")
-    session_files = USER_STATE.get(user_id, {}).get("session_files", [])
+    preview_message_id = state.preview_message_id
+    key = state.saved_key
+    session_files = state.session_files
 
     if not preview_message_id or not key or not session_files:
         await update.message.reply_text(
@@ -1037,7 +4024,7 @@ async def method2_edit_caption(update: Update, context: ContextTypes.DEFAULT_TYP
     # Build the new text
     text = "✅ *New Caption Saved!*\n\n"
     for idx, _ in enumerate(session_files, start=1):
-        text += f"📦 APK {idx}: Key - {key}\n"
+        text += f"📦 APK {idx}: {render_key(key)}\n"
 
     # Only show Back button after editing caption
     buttons = [
@@ -1058,13 +4045,51 @@ async def method2_edit_caption(update: Update, context: ContextTypes.DEFAULT_TYP
         else:
             raise e  # if other error, show normally
 
+async def session_file_sizes(bot, state) -> list:
+    """File sizes from FILE_META; only misses hit the Bot API, all at once."""
+    session_files = state.session_files
+    session_filenames = state.session_filenames
+    session_unique_ids = list(state.session_unique_ids)
+
+    sizes = [None] * len(session_files)
+    missing = []
+    for idx, file_id in enumerate(session_files):
+        file_unique_id = session_unique_ids[idx] if idx < len(session_unique_ids) else None
+        meta = FILE_META.get(file_unique_id) if file_unique_id else None
+        if meta:
+            sizes[idx] = meta["file_size"]
+        else:
+            if not file_unique_id:
+                FILE_META.stats["misses"] += 1
+            missing.append(idx)
+
+    if missing:
+        results = await asyncio.gather(
+            *(bot.get_file(session_files[idx]) for idx in missing),
+            return_exceptions=True
+        )
+        for idx, result in zip(missing, results):
+            if isinstance(result, Exception):
+                upload_log.warning("Failed to fetch file size: %s", result)
+                continue
+            sizes[idx] = result.file_size
+            file_name = session_filenames[idx] if idx < len(session_filenames) else ""
+            FILE_META.put(result.file_unique_id, result.file_id, file_name, result.file_size)
+
+            # Remember the id so the next preview is a cache hit
+            while len(session_unique_ids) <= idx:
+                session_unique_ids.append(None)
+            session_unique_ids[idx] = result.file_unique_id
+        state.session_unique_ids = session_unique_ids
+
+    return sizes
+
 async def method2_show_preview(user_id, context):
-    user_state = USER_STATE.get(user_id, {})
-    session_files = user_state.get("session_files", [])
-    session_filenames = user_state.get("session_filenames", [])
-    key = user_state.get("saved_key", "")
-    saved_caption = USER_DATA.get(str(user_id), {}).get("caption", "")
-    key_mode = user_state.get("key_mode", "normal")
+    user_state = USER_STATE.get(user_id) or Session()
+    session_files = user_state.session_files
+    session_filenames = user_state.session_filenames
+    key = user_state.saved_key
+    key_mode = user_state.key_mode
 
     if not session_files or not key:
         await context.bot.send_message(
@@ -1075,45 +4100,23 @@ async def method2_show_preview(user_id, context):
         return
 
     preview_text = "🔖 <b>Captured APKs Preview:</b>\n\n"
+    file_sizes = await session_file_sizes(context.bot, user_state)
+    captions = render_session_captions(user_id, user_state, key, key_mode, file_sizes)
 
     for idx, (file_id, file_name) in enumerate(zip(session_files, session_filenames), start=1):
-        try:
-            file_size = None
-            if hasattr(context.bot, "get_file"):
-                file_info = await context.bot.get_file(file_id)
-                file_size = file_info.file_size
-        except Exception as e:
-            print(f"Failed to fetch file size: {e}")
-            file_size = None
-
+        file_size = file_sizes[idx - 1]
         file_size_mb = round(file_size / (1024 * 1024), 1) if file_size else "?"
 
-        # Build Key Text based on selected mode
-        if key_mode == "quote":
-            key_text = f"<blockquote>Key - <code>{key}</code></blockquote>"
-        elif key_mode == "mono":
-            key_text = f"<code>Key - {key}</code>"
-        else:
-            key_text = f"Key - {key}"
-
-        # Check if it's last APK
+        # Same captions the post will use
+        preview_text += f"➤ <b>{file_name}</b>"
+        if file_size_mb != "?":
+            preview_text += f" ({file_size_mb} MB)"
         if idx == len(session_files):
             # Last APK use full user saved caption + key
-            if "Key -" in saved_caption:
-                final_caption = saved_caption.replace("Key -", key_text)
-            else:
-                final_caption = saved_caption + f"\n{key_text}"
-
-            preview_text += f"➤ <b>{file_name}</b>"
-            if file_size_mb != "?":
-                preview_text += f" ({file_size_mb} MB)"
-            preview_text += f"\n✍️ {final_caption}\n\n"
+            preview_text += f"\n✍️ {captions[idx - 1]}\n\n"
         else:
             # Other APKs simple Key
-            preview_text += f"➤ <b>{file_name}</b>"
-            if file_size_mb != "?":
-                preview_text += f" ({file_size_mb} MB)"
-            preview_text += f"\n🔑 {key_text}\n\n"
+            preview_text += f"\n🔑 {captions[idx - 1]}\n\n"
 
     # Inline Keyboard
     keyboard = [
@@ -1128,24 +4131,24 @@ async def method2_show_preview(user_id, context):
     try:
         await context.bot.edit_message_text(
             chat_id=user_id,
-            message_id=user_state.get("preview_message_id"),
+            message_id=user_state.preview_message_id,
             text=preview_text,
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     except Exception as e:
-        print(f"Error in showing preview: {e}")
+        upload_log.exception("Error in showing preview: %s", e)
 
 def build_method2_buttons(user_id):
-    state = USER_STATE.get(user_id, {})
+    state = USER_STATE.get(user_id) or Session()
     
     buttons = [
         [InlineKeyboardButton("✅ Yes", callback_data="method2_yes"),
          InlineKeyboardButton("❌ No", callback_data="method2_no")]
     ]
 
-    quote_applied = state.get("quote_applied", False)
-    mono_applied = state.get("mono_applied", False)
+    quote_applied = state.quote_applied
+    mono_applied = state.mono_applied
 
     row = []
 
@@ -1166,7 +4169,7 @@ def build_method2_buttons(user_id):
     return InlineKeyboardMarkup(buttons)
 
 async def method2_back_fullmenu(user_id, context):
-    preview_message_id = USER_STATE.get(user_id, {}).get("preview_message_id")
+    preview_message_id = (USER_STATE.get(user_id) or Session()).preview_message_id
 
     buttons = [
         [InlineKeyboardButton("✅ Yes", callback_data="method2_yes"),
@@ -1185,432 +4188,553 @@ async def method2_back_fullmenu(user_id, context):
         reply_markup=InlineKeyboardMarkup(buttons)
     )
 
+# --- Callback routing ---
+# Button presses are looked up in a table instead of walking an if-chain:
+# exact callback_data is one dict lookup, prefix routes (delete_apk_<n>) are
+# tried longest prefix first and get the parsed suffix as their argument.
+# The anti-spam cooldown lives here as well, because PTB builds a fresh
+# context for every update and anything stored on it is gone by the next tap.
+CALLBACK_COOLDOWN = float(os.getenv("CALLBACK_COOLDOWN", "1"))
+CALLBACK_COOLDOWN_USERS = int(os.getenv("CALLBACK_COOLDOWN_USERS", "10000"))
+
+class CallbackCooldown:
+    def __init__(self, window: float, max_users: int):
+        self.window = window
+        self.max_users = max_users
+        self.last_press = OrderedDict()  # user_id -> monotonic time, oldest first
+
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        last = self.last_press.get(user_id)
+        if last is not None and now - last < self.window:
+            return False
+        self.last_press[user_id] = now
+        self.last_press.move_to_end(user_id)
+        # Presses older than the window can't suppress anything any more
+        while self.last_press and (
+            len(self.last_press) > self.max_users
+            or now - next(iter(self.last_press.values())) >= self.window
+        ):
+            self.last_press.popitem(last=False)
+        return True
+
+class CallbackRouter:
+    def __init__(self):
+        self.exact = {}     # callback_data -> (handler, needs_session)
+        self.prefixes = []  # (prefix, parse, (handler, needs_session)), longest prefix first
+        self.stats = {"routed": 0, "suppressed": 0, "unknown": 0, "expired": 0}
+
+    def route(self, data: str = None, prefix: str = None, parse=str, needs_session: bool = True):
+        """Register handler(query, context, user_id, arg) for a callback_data value or prefix."""
+        def register(handler):
+            entry = (handler, needs_session)
+            if prefix is None:
+                self.exact[data] = entry
+            else:
+                self.prefixes.append((prefix, parse, entry))
+                self.prefixes.sort(key=lambda route: len(route[0]), reverse=True)
+            return handler
+        return register
+
+    def resolve(self, data: str):
+        """Return ((handler, needs_session), arg), or (None, None) if nothing matches."""
+        entry = self.exact.get(data)
+        if entry is not None:
+            return entry, None
+        for prefix, parse, entry in self.prefixes:
+            if data.startswith(prefix):
+                try:
+                    return entry, parse(data[len(prefix):])
+                except ValueError:
+                    break
+        return None, None
+
+CALLBACKS = CallbackRouter()
+CALLBACK_COOLDOWNS = CallbackCooldown(CALLBACK_COOLDOWN, CALLBACK_COOLDOWN_USERS)
+
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
-    data = query.data
-    
-    state = USER_STATE.get(user_id, {})
-    preview_message_id = state.get("preview_message_id")
-    
-    # --- Cooldown Anti Spam ---
-    now = time.time()
-    if not hasattr(context, "user_cooldowns"):
-        context.user_cooldowns = {}
-    if user_id in context.user_cooldowns and now - context.user_cooldowns[user_id] < 1:
+
+    if not CALLBACK_COOLDOWNS.allow(user_id):
+        CALLBACKS.stats["suppressed"] += 1
         await query.answer("⌛ Wait a second...", show_alert=False)
         return
-    context.user_cooldowns[user_id] = now
+    await query.answer()
 
-    # --- Help Buttons Handling ---
-    if data == "help_next":
-        keyboard = [
-            [InlineKeyboardButton("⬅️ Back", callback_data="help_back")]
-        ]
-        await query.edit_message_text(
-            "⚙️ *Auto Channel Monitor Commands:*\n\n"
-            "➔ /setsource1 - Set Source 1\n"
-            "➔ /setdest1 - Set Destination 1\n"
-            "➔ /setdestcaption1 - Set Caption 1\n"
-            "➔ /resetsetup1 - Reset Setup 1\n\n"
-            "➔ /setsource2 - Set Source 2\n"
-            "➔ /setdest2 - Set Destination 2\n"
-            "➔ /setdestcaption2 - Set Caption 2\n"
-            "➔ /resetsetup2 - Reset Setup 2\n\n"
-            "➔ /setsource3 - Set Source 3\n"
-            "➔ /setdest3 - Set Destination 3\n"
-            "➔ /setdestcaption3 - Set Caption 3\n"
-            "➔ /resetsetup3 - Reset Setup 3\n\n"
-            "➔ /viewsetup - View All Setups",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    route, arg = CALLBACKS.resolve(query.data or "")
+    if route is None:
+        CALLBACKS.stats["unknown"] += 1
+        log.debug("Unrouted callback %r", query.data)
         return
+    handler, needs_session = route
 
-    elif data == "help_back":
-        keyboard = [
-            [InlineKeyboardButton("➡️ Next", callback_data="help_next")]
-        ]
-        await query.edit_message_text(
-            "🛠 *Manual Upload Commands:*\n\n"
-            "➔ /start - Restart bot interaction\n"
-            "➔ /setchannelid - Set Upload Channel\n"
-            "➔ /setcaption - Set Upload Caption\n"
-            "➔ /resetcaption - Reset Caption\n"
-            "➔ /resetchannelid - Reset Channel\n"
-            "➔ /reset - Full Reset\n\n"
-            "➔ /adduser - Add Allowed User\n"
-            "➔ /removeuser - Remove User\n"
-            "➔ /userlist - List Users\n"
-            "➔ /ping - Bot Status\n"
-            "➔ /rules - Bot Rules\n",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
-
-    # --- Check user session ---
-    if user_id not in USER_STATE:
+    if needs_session and user_id not in USER_STATE:
+        CALLBACKS.stats["expired"] += 1
         await query.edit_message_text(
             "⏳ *Session expired or invalid!* ❌\nPlease restart using /start.",
             parse_mode="Markdown"
         )
         return
 
-    state = USER_STATE[user_id]
-    channel_id = USER_DATA.get(str(user_id), {}).get("channel")
+    CALLBACKS.stats["routed"] += 1
+    await handler(query, context, user_id, arg)
+
+# --- Help Buttons Handling ---
+@CALLBACKS.route("help_next", needs_session=False)
+async def callback_help_next(query, context, user_id, arg):
+    keyboard = [
+        [InlineKeyboardButton("⬅️ Back", callback_data="help_back")]
+    ]
+    await query.edit_message_text(
+        "⚙️ *Auto Channel Monitor Commands:*\n\n"
+        "_<name> is any setup name, e.g._ `setup1` _or_ `movies`\n\n"
+        "➔ /setsource <name> - Set Source\n"
+        "➔ /setdest <name> - Set Destinations\n"
+        "➔ /setdestcaption <name> - Set Caption\n"
+        "➔ /resetsetup <name> - Reset Setup\n"
+        "➔ /delsetup <name> - Delete Setup\n"
+        "➔ /setfilter <name> - Filter Rules\n"
+        "➔ /setkeypattern <name> - Key Formats\n\n"
+        "➔ /viewsetup - View All Setups\n"
+        "➔ /pending - Pending Forwards\n"
+        "➔ /canceljob - Cancel Forward",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+@CALLBACKS.route("help_back", needs_session=False)
+async def callback_help_back(query, context, user_id, arg):
+    keyboard = [
+        [InlineKeyboardButton("➡️ Next", callback_data="help_next")]
+    ]
+    await query.edit_message_text(
+        "🛠 *Manual Upload Commands:*\n\n"
+        "➔ /start - Restart bot interaction\n"
+        "➔ /setchannelid - Set Upload Channel\n"
+        "➔ /setcaption - Set Upload Caption\n"
+        "➔ /resetcaption - Reset Caption\n"
+        "➔ /resetchannelid - Reset Channel\n"
+        "➔ /reset - Full Reset\n\n"
+        "➔ /adduser - Add Users (IDs or .txt)\n"
+        "➔ /removeuser - Remove Users\n"
+        "➔ /userlist - List Users\n"
+        "➔ /stats - Bot Internals\n"
+        "➔ /ping - Bot Status\n"
+        "➔ /ping stats - Latency p50/p95\n"
+        "➔ /rules - Bot Rules\n",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# --- Set Channel or Caption ---
+@CALLBACKS.route("set_channel")
+async def callback_set_channel(query, context, user_id, arg):
+    USER_STATE[user_id].status = SessionStatus.WAITING_CHANNEL
+    await query.edit_message_text(
+        "📡 *Please send your Channel ID now!* Example: `@yourchannel` or `-100xxxxxxxxxx`",
+        parse_mode="Markdown"
+    )
+
+@CALLBACKS.route("set_caption")
+async def callback_set_caption(query, context, user_id, arg):
+    USER_STATE[user_id].status = SessionStatus.WAITING_CAPTION
+    await query.edit_message_text(
+        "📝 *Please send your Caption now!* Must contain: `Key -`",
+        parse_mode="Markdown"
+    )
+
+# --- Method 1 Selected ---
+@CALLBACKS.route("method_1")
+async def callback_method_1(query, context, user_id, arg):
+    USER_STATE[user_id].current_method = "method1"
+    USER_STATE[user_id].status = SessionStatus.NORMAL
+    channel_id = USER_DATA.get(str(user_id), {}).get("channel")
+
+    buttons = [
+        [InlineKeyboardButton("🌟 Bot Admin", url="https://t.me/TrailKeysHandlerBOT?startchannel=true")],
+        [InlineKeyboardButton("📡 Set Channel", callback_data="set_channel")],
+        [InlineKeyboardButton("📝 Set Caption", callback_data="set_caption")]
+    ]
+
+    if channel_id and USER_DATA.get(str(user_id), {}).get("caption"):
+        buttons.append([InlineKeyboardButton("📤 Send One APK", callback_data="send_apk_method1")])
+
+    buttons.append([InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")])
+
+    await query.edit_message_text(
+        "✅ *Method 1 Selected!*\n\nManual key capture system activated.\n\n"
+        "Keys are read from the APK caption: `Key -`, `Key:`, `Password -` or "
+        "`Password:` lines and code blocks. Every key found goes into the post.",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+# --- Method 2 Selected ---
+@CALLBACKS.route("method_2")
+async def callback_method_2(query, context, user_id, arg):
+    USER_STATE[user_id].current_method = "method2"
+    USER_STATE[user_id].status = SessionStatus.NORMAL
+    channel_id = USER_DATA.get(str(user_id), {}).get("channel")
+
+    buttons = [
+        [InlineKeyboardButton("🌟 Bot Admin", url="https://t.me/TrailKeyHandlerBOT?startchannel=true")],
+        [InlineKeyboardButton("📡 Set Channel", callback_data="set_channel")],
+        [InlineKeyboardButton("📝 Set Caption", callback_data="set_caption")]
+    ]
+
+    if channel_id and USER_DATA.get(str(user_id), {}).get("caption"):
+        buttons.append([InlineKeyboardButton("📤 Send 2-3 APKs", callback_data="send_apk_method2")])
+
+    buttons.append([InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")])
+
+    await query.edit_message_text(
+        "✅ *Method 2 Selected!*\n\nMulti APK Upload system activated.",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+# --- Method 2 Confirmations ---
+@CALLBACKS.route("method2_yes")
+async def callback_method2_yes(query, context, user_id, arg):
+    await method2_send_to_channel(user_id, context)
+
+@CALLBACKS.route("method2_no")
+async def callback_method2_no(query, context, user_id, arg):
+    cancel_method2_timer(user_id)
+    USER_STATE[user_id].clear_files()
+    await query.edit_message_text("❌ *Session canceled!*", parse_mode="Markdown")
+
+@CALLBACKS.route("method2_quote")
+async def callback_method2_quote(query, context, user_id, arg):
+    USER_STATE[user_id].key_mode = KeyMode.QUOTE
+    await method2_convert_quote(user_id, context)
+
+@CALLBACKS.route("method2_mono")
+async def callback_method2_mono(query, context, user_id, arg):
+    USER_STATE[user_id].key_mode = KeyMode.MONO
+    await method2_convert_mono(user_id, context)
+
+@CALLBACKS.route("method2_edit")
+async def callback_method2_edit(query, context, user_id, arg):
+    USER_STATE[user_id].status = SessionStatus.WAITING_NEW_CAPTION
+    await query.edit_message_text(
+        "📝 *Send new Caption now!* (Must include `Key -`)",
+        parse_mode="Markdown"
+    )
 
-    # --- Set Channel or Caption ---
-    if data == "set_channel":
-        USER_STATE[user_id]["status"] = "waiting_channel"
-        await query.edit_message_text(
-            "📡 *Please send your Channel ID now!* Example: `@yourchannel` or `-100xxxxxxxxxx`",
-            parse_mode="Markdown"
-        )
-        return
+@CALLBACKS.route("method2_preview")
+async def callback_method2_preview(query, context, user_id, arg):
+    await method2_show_preview(user_id, context)
 
-    if data == "set_caption":
-        USER_STATE[user_id]["status"] = "waiting_caption"
-        await query.edit_message_text(
-            "📝 *Please send your Caption now!* Must contain: `Key -`",
-            parse_mode="Markdown"
-        )
-        return
+@CALLBACKS.route("auto_recaption")
+async def callback_auto_recaption(query, context, user_id, arg):
+    await auto_recaption(user_id, context)
 
-    # --- Method 1 Selected ---
-    if data == "method_1":
-        USER_STATE[user_id]["current_method"] = "method1"
-        USER_STATE[user_id]["status"] = "normal"
+# --- Back to Methods ---
+@CALLBACKS.route("back_to_methods")
+async def callback_back_to_methods(query, context, user_id, arg):
+    cancel_method2_timer(user_id)
+    USER_STATE[user_id].current_method = None
+    USER_STATE[user_id].status = SessionStatus.SELECTING_METHOD
 
-        buttons = [
-            [InlineKeyboardButton("🌟 Bot Admin", url="https://t.me/TrailKeysHandlerBOT?startchannel=true")],
-            [InlineKeyboardButton("📡 Set Channel", callback_data="set_channel")],
-            [InlineKeyboardButton("📝 Set Caption", callback_data="set_caption")]
-        ]
+    keyboard = [
+        [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
+        [InlineKeyboardButton("🚀 Method 2", callback_data="method_2")]
+    ]
 
-        if channel_id and USER_DATA.get(str(user_id), {}).get("caption"):
-            buttons.append([InlineKeyboardButton("📤 Send One APK", callback_data="send_apk_method1")])
+    await query.edit_message_text(
+        "🔄 *Method Selection Reset!*\n\nPlease select again:",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-        buttons.append([InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")])
+# --- Manage posted APKs ---
+@CALLBACKS.route("delete_apk_post")
+async def callback_delete_apk_post(query, context, user_id, arg):
+    apk_posts = USER_STATE[user_id].apk_posts
 
-        await query.edit_message_text(
-            "✅ *Method 1 Selected!*\n\nManual key capture system activated.",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
-        return
+    keyboard = []
+    for idx, _ in enumerate(apk_posts):
+        keyboard.append([InlineKeyboardButton(f"🗑️ Delete APK {idx+1}", callback_data=f"delete_apk_{idx+1}")])
 
-    # --- Method 2 Selected ---
-    if data == "method_2":
-        USER_STATE[user_id]["current_method"] = "method2"
-        USER_STATE[user_id]["status"] = "normal"
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_manage_post")])
 
-        buttons = [
-            [InlineKeyboardButton("🌟 Bot Admin", url="https://t.me/TrailKeyHandlerBOT?startchannel=true")],
-            [InlineKeyboardButton("📡 Set Channel", callback_data="set_channel")],
-            [InlineKeyboardButton("📝 Set Caption", callback_data="set_caption")]
-        ]
+    await context.bot.edit_message_text(
+        chat_id=user_id,
+        message_id=USER_STATE[user_id].preview_message_id,
+        text="🗑️ *Select which APK you want to delete:*",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-        if channel_id and USER_DATA.get(str(user_id), {}).get("caption"):
-            buttons.append([InlineKeyboardButton("📤 Send 2-3 APKs", callback_data="send_apk_method2")])
+@CALLBACKS.route("back_to_manage_post")
+async def callback_back_to_manage_post(query, context, user_id, arg):
+    buttons = [
+        [InlineKeyboardButton("📄 View Last Post", url=USER_STATE[user_id].last_post_link)],
+        [InlineKeyboardButton("🗑️ Delete APK Post", callback_data="delete_apk_post")],
+        [InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")]
+    ]
 
-        buttons.append([InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")])
+    await context.bot.edit_message_text(
+        chat_id=user_id,
+        message_id=USER_STATE[user_id].preview_message_id,
+        text="✅ *Manage your posted APKs:*",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
 
-        await query.edit_message_text(
-            "✅ *Method 2 Selected!*\n\nMulti APK Upload system activated.",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
-        return
+@CALLBACKS.route(prefix="delete_apk_", parse=int)
+async def callback_delete_apk(query, context, user_id, apk_number):
+    apk_posts = USER_STATE[user_id].apk_posts
+    channel_id = USER_DATA.get(str(user_id), {}).get("channel")
 
-    # --- Method 2 Confirmations ---
-    if data == "method2_yes":
-        await method2_send_to_channel(user_id, context)
+    if not 0 < apk_number <= len(apk_posts):
         return
+    msg_id = apk_posts[apk_number - 1]
 
-    if data == "method2_no":
-        USER_STATE[user_id]["session_files"] = []
-        USER_STATE[user_id]["session_filenames"] = []
-        await query.edit_message_text("❌ *Session canceled!*", parse_mode="Markdown")
-        return
+    try:
+        await context.bot.delete_message(chat_id=channel_id, message_id=msg_id)
+    except Exception as e:
+        upload_log.warning("Delete failed: %s", e)
 
-    if data == "method2_quote":
-        USER_STATE[user_id]["key_mode"] = "quote"
-        await method2_convert_quote(user_id, context)
-        return
-    
-    if data == "method2_mono":
-        USER_STATE[user_id]["key_mode"] = "mono"
-        await method2_convert_mono(user_id, context)
-        return
+    # Remove deleted
+    apk_posts = [m for idx, m in enumerate(apk_posts) if idx != apk_number - 1 and m]
+    USER_STATE[user_id].apk_posts = apk_posts
 
-    if data == "method2_edit":
-        USER_STATE[user_id]["status"] = "waiting_new_caption"
-        await query.edit_message_text(
-            "📝 *Send new Caption now!* (Must include `Key -`)",
+    if not apk_posts:
+        # All posts deleted
+        USER_STATE[user_id].clear_files()
+        USER_STATE[user_id].saved_key = None
+        USER_STATE[user_id].apk_posts = NO_FILES
+        USER_STATE[user_id].last_apk_time = None
+        USER_STATE[user_id].waiting_key = False
+        USER_STATE[user_id].preview_message_id = None
+
+        await context.bot.edit_message_text(
+            chat_id=user_id,
+            message_id=query.message.message_id,
+            text="✅ *All APKs deleted!*\nNew season started.",
             parse_mode="Markdown"
         )
         return
 
-    if data == "method2_preview":
-        await method2_show_preview(user_id, context)
+    # If posts remaining, show delete menu again
+    keyboard = []
+    for idx, _ in enumerate(apk_posts):
+        keyboard.append([InlineKeyboardButton(f"🗑️ Delete APK {idx+1}", callback_data=f"delete_apk_{idx+1}")])
+
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_manage_post")])
+
+    await context.bot.edit_message_text(
+        chat_id=user_id,
+        message_id=query.message.message_id,
+        text=f"✅ *Deleted APK {apk_number} Successfully!*\nSelect another to delete:",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# --- Userlist pages ---
+@CALLBACKS.route(prefix="userlist_next_", parse=int, needs_session=False)
+async def callback_userlist_next(query, context, user_id, after):
+    await show_userlist_page(query, user_id, after=after)
+
+@CALLBACKS.route(prefix="userlist_prev_", parse=int, needs_session=False)
+async def callback_userlist_prev(query, context, user_id, before):
+    await show_userlist_page(query, user_id, before=before)
+
+async def show_userlist_page(query, user_id: int, after: int = None, before: int = None):
+    if user_id != OWNER_ID:
         return
-    
-    if data == "auto_recaption":
-        await auto_recaption(user_id, context)
+    if not ALLOWED_USERS:
+        await query.edit_message_text("No allowed users.")
         return
-    
-    # --- Back to Methods ---
-    if data == "back_to_methods":
-        USER_STATE[user_id]["current_method"] = None
-        USER_STATE[user_id]["status"] = "selecting_method"
+    text, markup = userlist_page(after=after, before=before)
+    await query.edit_message_text(text, parse_mode="HTML", reply_markup=markup, disable_web_page_preview=True)
 
-        keyboard = [
-            [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
-            [InlineKeyboardButton("🚀 Method 2", callback_data="method_2")]
-        ]
+@CALLBACKS.route("method2_back_fullmenu")
+async def callback_method2_back_fullmenu(query, context, user_id, arg):
+    state = USER_STATE[user_id]
+    preview_message_id = state.preview_message_id
+    key = state.saved_key
+    session_files = state.session_files
 
+    if not preview_message_id or not key or not session_files:
         await query.edit_message_text(
-            "🔄 *Method Selection Reset!*\n\nPlease select again:",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
-        
-    if data == "delete_apk_post":
-        apk_posts = USER_STATE.get(user_id, {}).get("apk_posts", [])
-    
-        keyboard = []
-        for idx, _ in enumerate(apk_posts):
-            keyboard.append([InlineKeyboardButton(f"🗑️ Delete APK {idx+1}", callback_data=f"delete_apk_{idx+1}")])
-    
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_manage_post")])
-    
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=USER_STATE[user_id]["preview_message_id"],
-            text="🗑️ *Select which APK you want to delete:*",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            text="⚠️ *Session expired or not found!*",
+            parse_mode="Markdown"
         )
         return
 
-    if data == "back_to_manage_post":
-        buttons = [
-            [InlineKeyboardButton("📄 View Last Post", url=USER_STATE[user_id]["last_post_link"])],
-            [InlineKeyboardButton("🗑️ Delete APK Post", callback_data="delete_apk_post")],
-            [InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")]
-        ]
-    
+    text = "🔖 *Key captured!*\n\nChoose what you want to do next:"
+
+    try:
         await context.bot.edit_message_text(
             chat_id=user_id,
-            message_id=USER_STATE[user_id]["preview_message_id"],
-            text="✅ *Manage your posted APKs:*",
+            message_id=preview_message_id,
+            text=text,
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(buttons)
+            reply_markup=build_method2_buttons(user_id)
         )
-        return
-        
-    if data.startswith("delete_apk_"):
-        apk_number = int(data.split("_")[-1])
-        apk_posts = USER_STATE.get(user_id, {}).get("apk_posts", [])
-        channel_id = USER_DATA.get(str(user_id), {}).get("channel")
-    
-        if apk_number <= len(apk_posts):
-            msg_id = apk_posts[apk_number - 1]
-    
-            try:
-                await context.bot.delete_message(chat_id=channel_id, message_id=msg_id)
-            except Exception as e:
-                print(f"Delete failed: {e}")
-    
-            # Remove deleted
-            apk_posts[apk_number - 1] = None
-            apk_posts = [m for m in apk_posts if m]
-            USER_STATE[user_id]["apk_posts"] = apk_posts
-    
-            if not apk_posts:
-                # All posts deleted
-                USER_STATE[user_id]["session_files"] = []
-                USER_STATE[user_id]["session_filenames"] = []
-                USER_STATE[user_id]["saved_key"] = None
-                USER_STATE[user_id]["apk_posts"] = []
-                USER_STATE[user_id]["last_apk_time"] = None
-                USER_STATE[user_id]["waiting_key"] = False
-                USER_STATE[user_id]["preview_message_id"] = None
-    
-                await context.bot.edit_message_text(
-                    chat_id=user_id,
-                    message_id=query.message.message_id,
-                    text="✅ *All APKs deleted!*\nNew season started.",
-                    parse_mode="Markdown"
-                )
-                return
-    
-            # If posts remaining, show delete menu again
-            keyboard = []
-            for idx, _ in enumerate(apk_posts):
-                keyboard.append([InlineKeyboardButton(f"🗑️ Delete APK {idx+1}", callback_data=f"delete_apk_{idx+1}")])
-    
-            keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_manage_post")])
-    
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=query.message.message_id,
-                text=f"✅ *Deleted APK {apk_number} Successfully!*\nSelect another to delete:",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return
-    
-    if data == "method2_back_fullmenu":
-        preview_message_id = USER_STATE.get(user_id, {}).get("preview_message_id")
-        key = USER_STATE.get(user_id, {}).get("saved_key", "")
-        session_files = USER_STATE.get(user_id, {}).get("session_files", [])
-    
-        if not preview_message_id or not key or not session_files:
-            await query.edit_message_text(
-                text="⚠️ *Session expired or not found!*",
-                parse_mode="Markdown"
-            )
-            return
-    
-        text = "🔖 *Key captured!*\n\nChoose what you want to do next:"
-    
-        try:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=preview_message_id,
-                text=text,
-                parse_mode="Markdown",
-                reply_markup=build_method2_buttons(user_id)
-            )
-        except Exception as e:
-            print(f"Error going back to Full Menu: {e}")
-    
-# Setup 1 - Set Source Channel
-async def set_source1(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    except Exception as e:
+        upload_log.warning("Error going back to Full Menu: %s", e)
+
+# --- Auto setup commands ---
+# Every command takes the setup name first (/setsource <name> ...). The old
+# numbered forms (/setsource1 ...) still work and map to "setup1".
+SETUP_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{1,32}$")
+
+def parse_setup_command(update: Update):
+    """Split a setup command into (setup name, remaining text)."""
+    parts = update.message.text.split(None, 1)
+    command = parts[0][1:].split("@")[0]
+    rest = parts[1].strip() if len(parts) > 1 else ""
+
+    numbered = re.search(r"(\d+)$", command)
+    if numbered:
+        return f"setup{numbered.group(1)}", rest
+
+    name_and_rest = rest.split(None, 1)
+    if not name_and_rest:
+        return None, ""
+    name = name_and_rest[0]
+    if name.isdigit():
+        name = f"setup{name}"
+    if not SETUP_NAME_PATTERN.match(name):
+        return None, ""
+    return name, name_and_rest[1].strip() if len(name_and_rest) > 1 else ""
+
+async def set_source(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("Only owner can set this!")
         return
-    if not context.args:
-        await update.message.reply_text("Usage: `/setsource1 @channelname or -100xxxx`", parse_mode="Markdown")
+    name, rest = parse_setup_command(update)
+    if not name or not rest:
+        await update.message.reply_text("Usage: `/setsource <name> @channelname or -100xxxx`", parse_mode="Markdown")
         return
-    AUTO_SETUP["setup1"]["source_channel"] = context.args[0]
-    save_config()
-    await update.message.reply_text(f"✅ Setup 1 Source Channel set to: `{context.args[0]}`", parse_mode="Markdown")
+    source = rest.split()[0]
+    await set_setup_field(name, "source_channel", source)
+    await update.message.reply_text(f"✅ Setup {setup_label(name)} Source Channel set to: `{source}`", parse_mode="Markdown")
 
-# Setup 1 - Set Destination Channel
-async def set_dest1(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def set_dest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("Only owner can set this!")
         return
-    if not context.args:
-        await update.message.reply_text("Usage: `/setdest1 @channelname or -100xxxx`", parse_mode="Markdown")
+    name, rest = parse_setup_command(update)
+    if not name or not rest:
+        await update.message.reply_text("Usage: `/setdest <name> @channel1 -100xxxx ...`", parse_mode="Markdown")
         return
-    AUTO_SETUP["setup1"]["dest_channel"] = context.args[0]
-    save_config()
-    await update.message.reply_text(f"✅ Setup 1 Destination Channel set to: `{context.args[0]}`", parse_mode="Markdown")
+    dests = rest.split()
+    await set_setup_destinations(name, dests)
+    await update.message.reply_text(f"✅ Setup {setup_label(name)} Destination Channels set to: `{' '.join(dests)}`", parse_mode="Markdown")
 
-# Setup 1 - Set Destination Caption
-async def set_destcaption1(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def set_destcaption(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("Only owner can set this!")
         return
-    text = update.message.text.split(' ', 1)
-    if len(text) < 2:
-        await update.message.reply_text("Usage: `/setdestcaption1 Caption with Key - placeholder`", parse_mode="Markdown")
+    name, caption = parse_setup_command(update)
+    if not name or not caption:
+        await update.message.reply_text("Usage: `/setdestcaption <name> Caption with Key - placeholder`", parse_mode="Markdown")
         return
-    caption = text[1]
     if "Key -" not in caption:
         await update.message.reply_text("❗ Caption must include `Key -` placeholder!", parse_mode="Markdown")
         return
-    AUTO_SETUP["setup1"]["dest_caption"] = caption
-    save_config()
-    await update.message.reply_text("✅ Setup 1 Destination Caption saved!", parse_mode="Markdown")
+    await set_setup_field(name, "dest_caption", caption)
+    await update.message.reply_text(f"✅ Setup {setup_label(name)} Destination Caption saved!", parse_mode="Markdown")
 
-# Setup 2 - Set Source Channel
-async def set_source2(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def set_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("Only owner can set this!")
         return
-    if not context.args:
-        await update.message.reply_text("Usage: `/setsource2 @channelname or -100xxxx`", parse_mode="Markdown")
+    name, rest = parse_setup_command(update)
+    rule_type, _, value = rest.partition(" ")
+    rule_type, value = rule_type.lower(), value.strip()
+    if not name or not (rule_type == "default" or rule_type in FILTER_RULE_TYPES and value):
+        await update.message.reply_text(
+            "Usage: `/setfilter <name> <rule> <value>`\n\n"
+            "➔ `size 1-50,80-` - MB ranges\n"
+            "➔ `name \\.apk$` - File name regex\n"
+            "➔ `caption (?i)beta` - Caption regex\n"
+            "➔ `mime application/vnd.android.package-archive`\n"
+            "➔ `sender @channel -100xxxx Signature`\n\n"
+            "`<rule> off` removes a rule, `/setfilter <name> default` restores the defaults.",
+            parse_mode="Markdown"
+        )
         return
-    AUTO_SETUP["setup2"]["source_channel"] = context.args[0]
-    save_config()
-    await update.message.reply_text(f"✅ Setup 2 Source Channel set to: `{context.args[0]}`", parse_mode="Markdown")
 
-# Setup 2 - Set Destination Channel
-async def set_dest2(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("Only owner can set this!")
-        return
-    if not context.args:
-        await update.message.reply_text("Usage: `/setdest2 @channelname or -100xxxx`", parse_mode="Markdown")
+    if rule_type == "default":
+        await set_setup_field(name, "rules", None)
+        await update.message.reply_text(f"✅ Setup {setup_label(name)} filters restored to defaults.")
         return
-    AUTO_SETUP["setup2"]["dest_channel"] = context.args[0]
-    save_config()
-    await update.message.reply_text(f"✅ Setup 2 Destination Channel set to: `{context.args[0]}`", parse_mode="Markdown")
 
-# Setup 2 - Set Destination Caption
-async def set_destcaption2(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rules = dict(setup_filter_rules(name))
+    if value.lower() == "off":
+        rules.pop(rule_type, None)
+    else:
+        try:
+            FILTER_RULE_COMPILERS[rule_type](value)
+        except (ValueError, re.error) as e:
+            await update.message.reply_text(f"❗ Invalid {rule_type} rule: {e}")
+            return
+        rules[rule_type] = value
+    await set_setup_field(name, "rules", rules)
+    await update.message.reply_text(
+        f"✅ Setup {setup_label(name)} filters: {describe_filter_rules(rules)}"
+    )
+
+async def set_key_pattern(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("Only owner can set this!")
         return
-    text = update.message.text.split(' ', 1)
-    if len(text) < 2:
-        await update.message.reply_text("Usage: `/setdestcaption2 Caption with Key - placeholder`", parse_mode="Markdown")
-        return
-    caption = text[1]
-    if "Key -" not in caption:
-        await update.message.reply_text("❗ Caption must include `Key -` placeholder!", parse_mode="Markdown")
+    name, rest = parse_setup_command(update)
+    if not name or not rest:
+        await update.message.reply_text(
+            "Usage: `/setkeypattern <name> <regex> [<regex> ...]`\n\n"
+            "Each regex needs one (group) around the key, use `\\s` for spaces:\n"
+            "➔ `Key\\s*-\\s*(\\S+) Pass:\\s*(\\S+)`\n\n"
+            "`/setkeypattern <name> default` restores the defaults.",
+            parse_mode="Markdown"
+        )
         return
-    AUTO_SETUP["setup2"]["dest_caption"] = caption
-    save_config()
-    await update.message.reply_text("✅ Setup 2 Destination Caption saved!", parse_mode="Markdown")
 
-# Setup 3 - Set Source Channel
-async def set_source3(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("Only owner can set this!")
+    if rest.lower() == "default":
+        await set_setup_field(name, "key_patterns", None)
+        await update.message.reply_text(f"✅ Setup {setup_label(name)} key patterns restored to defaults.")
         return
-    if not context.args:
-        await update.message.reply_text("Usage: `/setsource3 @channelname or -100xxxx`", parse_mode="Markdown")
+
+    patterns = rest.split()
+    try:
+        KeyExtractor(patterns)
+    except (ValueError, re.error) as e:
+        await update.message.reply_text(f"❗ Invalid key pattern: {e}")
         return
-    AUTO_SETUP["setup3"]["source_channel"] = context.args[0]
-    save_config()
-    await update.message.reply_text(f"✅ Setup 3 Source Channel set to: `{context.args[0]}`", parse_mode="Markdown")
+    await set_setup_field(name, "key_patterns", patterns)
+    await update.message.reply_text(f"✅ Setup {setup_label(name)} key patterns: {' • '.join(patterns)}")
 
-# Setup 3 - Set Destination Channel
-async def set_dest3(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def describe_filter_rules(rules: dict) -> str:
+    return " • ".join(f"{t} {rules[t]}" for t in FILTER_RULE_TYPES if rules.get(t)) or "none"
+
+async def reset_setup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("Only owner can set this!")
+        await update.message.reply_text("Only owner can reset setups!")
         return
-    if not context.args:
-        await update.message.reply_text("Usage: `/setdest3 @channelname or -100xxxx`", parse_mode="Markdown")
+    name, _ = parse_setup_command(update)
+    if not name or name not in AUTO_SETUP:
+        await update.message.reply_text("Usage: `/resetsetup <name>` (existing setup)", parse_mode="Markdown")
         return
-    AUTO_SETUP["setup3"]["dest_channel"] = context.args[0]
-    save_config()
-    await update.message.reply_text(f"✅ Setup 3 Destination Channel set to: `{context.args[0]}`", parse_mode="Markdown")
+    await replace_setup(name, default_setup())
+    await update.message.reply_text(f"✅ Setup {setup_label(name)} has been reset successfully!")
 
-# Setup 3 - Set Destination Caption
-async def set_destcaption3(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def delete_setup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("Only owner can set this!")
-        return
-    text = update.message.text.split(' ', 1)
-    if len(text) < 2:
-        await update.message.reply_text("Usage: `/setdestcaption3 Caption with Key - placeholder`", parse_mode="Markdown")
+        await update.message.reply_text("Only owner can delete setups!")
         return
-    caption = text[1]
-    if "Key -" not in caption:
-        await update.message.reply_text("❗ Caption must include `Key -` placeholder!", parse_mode="Markdown")
+    name, _ = parse_setup_command(update)
+    if not name or name not in AUTO_SETUP:
+        await update.message.reply_text("Usage: `/delsetup <name>` (existing setup)", parse_mode="Markdown")
         return
-    AUTO_SETUP["setup3"]["dest_caption"] = caption
-    save_config()
-    await update.message.reply_text("✅ Setup 3 Destination Caption saved!", parse_mode="Markdown")
+    await delete_setup(name)
+    await update.message.reply_text(f"🗑️ Setup {setup_label(name)} deleted.")
 
 async def view_setup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -1619,80 +4743,49 @@ async def view_setup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Only Owner can view setup!")
         return
 
-    text = ""
-    total = 0
-
-    for i in range(1, 4):
-        setup = AUTO_SETUP.get(f"setup{i}", {})
+    # Escape for MarkdownV2
+    def escape(text):
+        return re.sub(r'([_\*\[\]()~`>\#+\-=|{}.!\\])', r'\\\1', str(text))
 
+    blocks = []
+    for name in sorted(AUTO_SETUP, key=setup_sort_key):
+        setup = AUTO_SETUP[name]
         source = setup.get("source_channel")
-        dest = setup.get("dest_channel", "Not Set")
+        if not source:
+            continue
+
+        dest = ", ".join(setup_destinations(setup)) or "Not Set"
         caption = "Saved" if setup.get("dest_caption") else "Not Set"
         completed = setup.get("completed_count", 0)
+        duplicates = setup.get("duplicate_count", 0)
+        filters_text = describe_filter_rules(setup_filter_rules(name))
+        rejected = " • ".join(f"{rule} {count}" for rule, count in setup_rejections(name).items()) or "0"
+
+        blocks.append(
+            f"📌 Setup {escape(setup_label(name))}\n"
+            f"├─ 👤 Source : {escape(source)}\n"
+            f"├─ 🧬 Destination : {escape(dest)}\n"
+            f"├─ 📝 Caption : {caption}\n"
+            f"├─ 🧹 Filters : {escape(filters_text)}\n"
+            f"├─ 🔑 Key Patterns : {escape(' • '.join(setup_key_extractor(name).patterns))}\n"
+            f"├─ 🚫 Rejected : {escape(rejected)}\n"
+            f"├─ 🔢 Completed : {completed} Keys\n"
+            f"└─ ♻️ Duplicates Dropped : {duplicates}\n"
+            "━━━━━━━━━━━━━━━━━━━━\n"
+        )
 
-        if source:
-            total += 1
-
-            # Escape for MarkdownV2
-            source = re.sub(r'([_\*\~\`\>\#\+\-\=\|\{\}\.\!])', r'\\\1', source)
-            dest = re.sub(r'([_\*\~\`\>\#\+\-\=\|\{\}\.\!])', r'\\\1', dest)
-
-            text += (
-                f"📌 Setup {i}\n"
-                f"├─ 👤 Source : {source}\n"
-                f"├─ 🧬 Destination : {dest}\n"
-                f"├─ 📝 Caption : {caption}\n"
-                f"└─ 🔢 Completed : {completed} Keys\n"
-                "━━━━━━━━━━━━━━━━━━━━\n"
-            )
-
-    if total == 0:
+    if not blocks:
         await update.message.reply_text("❌ No setup configured yet.")
-    else:
-        header = f"🧾 *Total Setup : {total}*\n\n"
-        await update.message.reply_text(header + text, parse_mode="MarkdownV2")
-
-async def reset_setup1(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("Only owner can reset setup 1!")
-        return
-
-    AUTO_SETUP["setup1"] = {
-        "source_channel": "",
-        "dest_channel": "",
-        "dest_caption": "",
-        "completed_count": 0
-    }
-    save_config()
-    await update.message.reply_text("✅ Setup 1 has been reset successfully!")
-
-async def reset_setup2(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("Only owner can reset setup 2!")
-        return
-
-    AUTO_SETUP["setup2"] = {
-        "source_channel": "",
-        "dest_channel": "",
-        "dest_caption": "",
-        "completed_count": 0
-    }
-    save_config()
-    await update.message.reply_text("✅ Setup 2 has been reset successfully!")
-
-async def reset_setup3(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != OWNER_ID:
-        await update.message.reply_text("Only owner can reset setup 3!")
         return
 
-    AUTO_SETUP["setup3"] = {
-        "source_channel": "",
-        "dest_channel": "",
-        "dest_caption": "",
-        "completed_count": 0
-    }
-    save_config()
-    await update.message.reply_text("✅ Setup 3 has been reset successfully!")
+    # Stay under Telegram's 4096 character limit
+    text = f"🧾 *Total Setup : {len(blocks)}*\n\n"
+    for block in blocks:
+        if len(text) + len(block) > 3800:
+            await update.message.reply_text(text, parse_mode="MarkdownV2")
+            text = ""
+        text += block
+    await update.message.reply_text(text, parse_mode="MarkdownV2")
 
 async def auto_handle_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.channel_post:
@@ -1704,49 +4797,33 @@ async def auto_handle_channel_post(update: Update, context: ContextTypes.DEFAULT
     doc = message.document
     caption = message.caption or ""
 
-    print(f"✅ Received channel post from {source_username or chat_id}")
+    forward_log.info("✅ Received channel post from %s", source_username or chat_id, extra={"sample": "channel_post"})
     if not doc:
-        print("❌ No document attached.")
+        forward_log.debug("❌ No document attached.")
         return
 
-    if not doc.file_name.endswith(".apk"):
-        print("❌ Not an APK file. Ignoring.")
-        return
+    setup_names = SETUP_INDEX.get(chat_id, [])
+    if source_username:
+        setup_names = setup_names + SETUP_INDEX.get(source_username.casefold(), [])
 
-    file_size = doc.file_size
-    file_size_mb = file_size / (1024 * 1024)
+    if not setup_names:
+        forward_log.info("❌ No matching setup found for this source channel.", extra={"sample": "no_setup"})
+        return
 
-    matched_setup = None
-    setup_number = None
+    matched_setups = []
+    for setup_name in setup_names:
+        LOG_SETUP.set(setup_label(setup_name))
+        forward_log.debug("✅ Matched to Setup %s", setup_label(setup_name))
 
-    for i in range(1, 4):
-        setup = AUTO_SETUP.get(f"setup{i}")
-        if not setup or not setup.get("source_channel"):
+        rejected_by = setup_filter(setup_name).rejection(message)
+        if rejected_by:
+            count_rejection(setup_name, rejected_by)
+            forward_log.info("❌ Setup %s: %s rule not matched.", setup_label(setup_name), rejected_by,
+                             extra={"sample": "filter_rejected"})
             continue
+        matched_setups.append(setup_name)
 
-        src = setup["source_channel"]
-
-        if src.startswith("@") and source_username and src.lower() == source_username.lower():
-            matched_setup = setup
-            setup_number = i
-            break
-        elif src == chat_id:
-            matched_setup = setup
-            setup_number = i
-            break
-
-    if not matched_setup:
-        print("❌ No matching setup found for this source channel.")
-        return
-
-    print(f"✅ Matched to Setup {setup_number}")
-
-    # Size filter
-    if setup_number == 1 and not (1 <= file_size_mb <= 50):
-        print("❌ Size not matched for Setup 1.")
-        return
-    if setup_number == 2 and not (80 <= file_size_mb <= 2048):
-        print("❌ Size not matched for Setup 2.")
+    if not matched_setups:
         return
 
     if not caption:
@@ -1755,108 +4832,312 @@ async def auto_handle_channel_post(update: Update, context: ContextTypes.DEFAULT
             text="⚠️ *Alert!*\n➔ *APK received without caption.*\n🚫 *Processing skipped!*",
             parse_mode="Markdown"
         )
-        print("❌ Caption missing. Error sent to owner.")
+        forward_log.warning("❌ Caption missing. Error sent to owner.")
         return
 
-    match = re.search(r'Key\s*-\s*(\S+)', caption)
-    if not match:
+    # Setups sharing the default patterns share one extraction
+    setup_keys = {}
+    extracted = {}
+    for setup_name in matched_setups:
+        extractor = setup_key_extractor(setup_name)
+        if extractor not in extracted:
+            extracted[extractor] = caption_keys(extractor, message)
+        if extracted[extractor]:
+            setup_keys[setup_name] = extracted[extractor]
+
+    if not setup_keys:
         await context.bot.send_message(
             chat_id=OWNER_ID,
             text="⚠️ *Warning!*\n➔ *Key missing in caption.*\n⛔ *File not processed!*",
             parse_mode="Markdown"
         )
-        print("❌ Key missing in caption. Error sent to owner.")
+        forward_log.warning("❌ Key missing in caption. Error sent to owner.")
         return
 
-    key = match.group(1)
-    dest_caption = matched_setup["dest_caption"].replace("Key -", f"Key - `{key}`")
-    dest_channel = matched_setup["dest_channel"]
+    source_name = source_username if source_username else chat_id
 
-    # Send initial countdown message
-    countdown_msg = await context.bot.send_message(
-        chat_id=OWNER_ID,
-        text=f"⏳ Waiting to process APK... 20 seconds left.",
-        parse_mode="Markdown"
-    )
+    for setup_name, key in setup_keys.items():
+        LOG_SETUP.set(setup_label(setup_name))
+        setup = AUTO_SETUP[setup_name]
+
+        # Drop destinations that already got this APK + key; the ones left
+        # are claimed now, so a repost during the delay is dropped as well
+        digests = {dest: DEDUP.digest(doc.file_unique_id, key, dest) for dest in setup_destinations(setup)}
+        claimed = await DEDUP.claim(digests.values())
+        dedup_digests = {dest: digest for dest, digest in digests.items() if digest in claimed}
+        duplicates = len(digests) - len(dedup_digests)
+
+        if duplicates:
+            DEDUP.stats["dropped"] += duplicates
+            await increment_setup_field(setup_name, "duplicate_count", duplicates)
+            forward_log.info("♻️ Setup %s: dropped %d duplicate forward(s)", setup_label(setup_name), duplicates)
+            if not dedup_digests:
+                continue
+
+        dest_caption = setup_caption_template(setup_name).render(
+            key, "markdown", file_name=doc.file_name, file_size=doc.file_size
+        )
 
-    # Countdown edit
-    for sec in range(19, 0, -1):
-        await asyncio.sleep(1)
+        # The countdown goes out before the job is scheduled, so the report
+        # always has a message to edit however short the delay
+        job_id = FORWARD_SCHEDULER.reserve()
         try:
-            await context.bot.edit_message_text(
+            countdown_msg = await context.bot.send_message(
                 chat_id=OWNER_ID,
-                message_id=countdown_msg.message_id,
-                text=f"⏳ Waiting to process APK... {sec} seconds left.",
-                parse_mode="Markdown"
+                text=f"⏳ Setup {setup_label(setup_name)}: waiting to process APK... {int(FORWARD_DELAY)} seconds left.\n"
+                     f"🆔 Job #{job_id} • /pending • /canceljob {job_id}",
             )
-        except Exception as e:
-            print(f"Countdown edit failed: {e}")
+        except Exception:
+            await release_dedup_claims(dedup_digests.values())
+            raise
+
+        # Hand the delayed send to the scheduler so this handler returns now
+        job = FORWARD_SCHEDULER.schedule(
+            FORWARD_DELAY,
+            forward_apk,
+            job_id=job_id,
+            setup_name=setup_name,
+            source_name=source_name,
+            dest_channels=list(dedup_digests),
+            dest_caption=dest_caption,
+            file_id=doc.file_id,
+            key=key,
+            dedup_digests=dedup_digests,
+            message_id=countdown_msg.message_id
+        )
+        forward_log.info("⏳ Scheduled job #%d for Setup %s in %ss", job.job_id, setup_label(setup_name), FORWARD_DELAY)
 
-    # After countdown complete
-    await asyncio.sleep(1)
+def post_link_for(channel_id, message_id) -> str:
+    channel_id = str(channel_id)
+    if channel_id.startswith("@"):
+        return f"https://t.me/{channel_id.strip('@')}/{message_id}"
+    if channel_id.startswith("-100"):
+        return f"https://t.me/c/{channel_id[4:]}/{message_id}"
+    return "Unknown"
+
+async def send_to_destination(bot, dest_channel, file_id, caption, semaphore) -> dict:
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            sent_msg = await bot.send_document(
+                chat_id=dest_channel,
+                document=file_id,
+                caption=caption,
+                parse_mode="Markdown",
+                disable_notification=True
+            )
+            return {
+                "dest": dest_channel,
+                "link": post_link_for(dest_channel, sent_msg.message_id),
+                "latency_ms": (time.perf_counter() - started) * 1000,
+                "error": None
+            }
+        except Exception as e:
+            forward_log.warning("❌ Send to %s failed: %s", dest_channel, e)
+            return {
+                "dest": dest_channel,
+                "link": None,
+                "latency_ms": (time.perf_counter() - started) * 1000,
+                "error": str(e)
+            }
+
+async def release_dedup_claims(digests):
+    try:
+        await DEDUP.release(digests)
+    except Exception as e:
+        dedup_log.warning("Dedup release failed: %s", e)
 
+async def record_dedup_claims(digests):
     try:
-        sent_msg = await context.bot.send_document(
-            chat_id=dest_channel,
-            document=doc.file_id,
-            caption=dest_caption,
-            parse_mode="Markdown",
-            disable_notification=True
-        )
+        await DEDUP.record(digests)
+    except Exception as e:
+        dedup_log.warning("Dedup record failed: %s", e)
 
-        matched_setup["completed_count"] += 1
-        save_config()
+async def forward_apk(bot, job):
+    setup_name = job.data["setup_name"]
+    dest_channels = job.data["dest_channels"]
+    key = job.data["key"]
+    message_id = job.data["message_id"]
+    LOG_SETUP.set(setup_label(setup_name))
 
-        # Post link generator
-        if str(dest_channel).startswith("@"):
-            post_link = f"https://t.me/{dest_channel.strip('@')}/{sent_msg.message_id}"
-        elif str(dest_channel).startswith("-100"):
-            post_link = f"https://t.me/c/{str(dest_channel)[4:]}/{sent_msg.message_id}"
-        else:
-            post_link = "Unknown"
+    # Escape for MarkdownV2
+    def escape(text):
+        return re.sub(r'([_\*\[\]()~`>\#+\-=|{}.!\\])', r'\\\1', str(text))
 
-        # Escape for MarkdownV2
-        def escape(text):
-            return re.sub(r'([_\*~`>\#+\-=|{}.!])', r'\\\1', str(text))
+    try:
+        if not dest_channels:
+            raise ValueError(f"Setup {setup_label(setup_name)} has no destination channel")
+
+        # Fan out to every destination at once, bounded by FANOUT_CONCURRENCY
+        semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+        results = await asyncio.gather(*(
+            send_to_destination(bot, dest, job.data["file_id"], job.data["dest_caption"], semaphore)
+            for dest in dest_channels
+        ))
+
+        # Delivered destinations become durable, failed ones may be retried
+        # by a later repost
+        await record_dedup_claims(
+            job.data["dedup_digests"][result["dest"]] for result in results if not result["error"]
+        )
+        await release_dedup_claims(
+            job.data["dedup_digests"][result["dest"]] for result in results if result["error"]
+        )
 
-        source_name = source_username if source_username else chat_id
-        source = escape(source_name)
-        dest = escape(dest_channel)
-        key_escape = escape(key)
-        post_link_escape = escape(post_link)
+        delivered = sum(1 for result in results if not result["error"])
+        if delivered and setup_name in AUTO_SETUP:
+            await increment_setup_field(setup_name, "completed_count")
 
-        key_escape = f"`{key_escape}`"
+        lines = [
+            f"📌 Setup {escape(setup_label(setup_name))} Completed \\({delivered}/{len(results)}\\)",
+            f"├─ 👤 Source : {escape(job.data['source_name'])}",
+            f"├─ 📡 Key : `{escape(keys_label(key))}`"
+        ]
+        for idx, result in enumerate(results, start=1):
+            branch = "└─" if idx == len(results) else "├─"
+            latency = escape(f"{result['latency_ms']:.0f} ms")
+            if result["error"]:
+                lines.append(f"{branch} ❌ {escape(result['dest'])} • {latency} • {escape(result['error'][:200])}")
+            else:
+                lines.append(f"{branch} 🧬 {escape(result['dest'])} • {latency} • [Click Here]({escape(result['link'])})")
+        lines.append("━━━━━━━━━━━━━━━━━━━━")
 
-        # Final edit success message
-        await context.bot.edit_message_text(
+        # Final edit with the per-destination report
+        await bot.edit_message_text(
             chat_id=OWNER_ID,
-            message_id=countdown_msg.message_id,
-            text=(
-                f"📌 Setup {setup_number} Completed\n"
-                f"├─ 👤 Source : {source}\n"
-                f"├─ 🧬 Destination : {dest}\n"
-                f"├─ 📡 Key : {key_escape}\n"
-                f"└─ 🆔 Post Link : [Click Here]({post_link_escape})\n"
-                "━━━━━━━━━━━━━━━━━━━━"
-            ),
+            message_id=message_id,
+            text="\n".join(lines),
             parse_mode="MarkdownV2",
             disable_web_page_preview=True
         )
 
-        print("✅ Successfully forwarded and notified owner.")
+        forward_log.info("✅ Job #%d forwarded to %d/%d destinations and owner notified.", job.job_id, delivered, len(results))
 
     except Exception as e:
+        await release_dedup_claims(job.data["dedup_digests"].values())
         error_message = traceback.format_exc()
-        await context.bot.edit_message_text(
+        await bot.edit_message_text(
             chat_id=OWNER_ID,
-            message_id=countdown_msg.message_id,
-            text=f"❌ *Error Sending APK!*\n\n`{error_message}`",
+            message_id=message_id,
+            text=f"❌ *Error Sending APK\\!*\n\n`{escape(error_message)}`",
             parse_mode="MarkdownV2"
         )
-        print("❌ Error while sending document:\n", error_message)
+        forward_log.error("❌ Error while sending document for job #%d", job.job_id, exc_info=e)
 
-def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+async def pending_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != OWNER_ID:
+        await update.message.reply_text("❌ Only Owner can view pending jobs!")
+        return
+
+    # In sharded mode every worker answers /pending with its own jobs
+    shard = "" if SHARD_INDEX < 0 else f" (shard {SHARD_INDEX + 1}/{SHARD_WORKERS})"
+    jobs = FORWARD_SCHEDULER.pending()
+    if not jobs:
+        await update.message.reply_text(f"✅ No pending forwards{shard}.")
+        return
+
+    now = asyncio.get_running_loop().time()
+    lines = [f"⏳ <b>Pending Forwards{shard}:</b> {len(jobs)}\n"]
+    for job in jobs[:50]:
+        lines.append(
+            f"🆔 <b>#{job.job_id}</b> • Setup {html.escape(setup_label(job.data['setup_name']))} → "
+            f"{html.escape(', '.join(map(str, job.data['dest_channels'])))} • "
+            f"<code>{html.escape(keys_label(job.data['key']))}</code> • {max(0, int(job.due - now))}s"
+        )
+    if len(jobs) > 50:
+        lines.append(f"… and {len(jobs) - 50} more")
+
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+async def cancel_job(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != OWNER_ID:
+        await update.message.reply_text("❌ Only Owner can cancel jobs!")
+        return
+
+    if not context.args or not context.args[0].lstrip("#").isdigit():
+        await update.message.reply_text("Usage: `/canceljob <job_id>`", parse_mode="Markdown")
+        return
+
+    job = FORWARD_SCHEDULER.cancel(int(context.args[0].lstrip("#")))
+    if not job:
+        await update.message.reply_text("❌ No pending job with that ID.")
+        return
+
+    await release_dedup_claims(job.data.get("dedup_digests", {}).values())
+
+    if job.data.get("message_id"):
+        try:
+            await context.bot.edit_message_text(
+                chat_id=OWNER_ID,
+                message_id=job.data["message_id"],
+                text=f"🚫 Job #{job.job_id} cancelled. APK not forwarded."
+            )
+        except Exception as e:
+            forward_log.warning("Cancel edit failed: %s", e)
+
+    await update.message.reply_text(f"🚫 Job #{job.job_id} cancelled.")
+
+BACKGROUND_TASKS = []
+BACKGROUND_SERVERS = []
+
+async def post_init(application: Application):
+    SESSION_SNAPSHOTS.start_loading()
+    await DEDUP.open()
+    BACKGROUND_TASKS.append(asyncio.create_task(config_flusher()))
+    BACKGROUND_TASKS.append(asyncio.create_task(rejection_flusher()))
+    BACKGROUND_TASKS.append(asyncio.create_task(session_snapshotter()))
+    BACKGROUND_TASKS.append(asyncio.create_task(session_sweeper()))
+    BACKGROUND_TASKS.append(asyncio.create_task(FORWARD_SCHEDULER.run(application.bot)))
+    BACKGROUND_TASKS.append(asyncio.create_task(dedup_janitor()))
+    BACKGROUND_TASKS.append(asyncio.create_task(HEALTH.monitor(application)))
+    if METRICS_PORT:
+        BACKGROUND_SERVERS.append(await start_metrics_server(application))
+
+async def post_shutdown(application: Application):
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    for server in BACKGROUND_SERVERS:
+        server.close()
+    # Let a cancelled flush finish its write before the final one starts
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    await flush_rejections()
+    await STORAGE.flush()
+    STORAGE.close()
+    await SESSION_SNAPSHOTS.snapshot()
+    await DEDUP.close()
+
+def build_application(with_updater: bool = True) -> Application:
+    bot = TrackingBot(
+        BOT_TOKEN,
+        base_url=BOT_API_URL,
+        request=HTTPXRequest(connection_pool_size=256),
+        get_updates_request=HTTPXRequest(),
+        rate_limiter=OUTBOUND_LIMITER
+    )
+    builder = (
+        Application.builder()
+        .bot(bot)
+        .concurrent_updates(UPDATE_PROCESSOR)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
+
+    # Only the first matching handler of a group runs, so every
+    # pre-processing hook gets a group of its own
+    app.add_handler(TypeHandler(Update, track_update_latency), group=-4)
+    app.add_handler(TypeHandler(Update, bind_log_context), group=-3)
+
+    # Shard workers pick up what other workers wrote to the shared store
+    if SHARD_INDEX >= 0:
+        app.add_handler(TypeHandler(Update, refresh_shared_state_hook), group=-2)
+
+    # Restore a snapshotted session before any handler sees the update,
+    # and queue it for the next snapshot once the handlers are done
+    app.add_handler(TypeHandler(Update, restore_session_hook), group=-1)
+    app.add_handler(TypeHandler(Update, mark_session_dirty_hook), group=1)
 
     # Main owner/user commands
     app.add_handler(CommandHandler("start", start))
@@ -1875,37 +5156,45 @@ def main():
     app.add_handler(CommandHandler("adduser", add_user))
     app.add_handler(CommandHandler("removeuser", remove_user))
     app.add_handler(CommandHandler("userlist", userlist))
+    app.add_handler(CommandHandler("stats", stats))
 
-    # Auto setup commands
-    app.add_handler(CommandHandler("setsource1", set_source1))
-    app.add_handler(CommandHandler("setdest1", set_dest1))
-    app.add_handler(CommandHandler("setdestcaption1", set_destcaption1))
-
-    app.add_handler(CommandHandler("setsource2", set_source2))
-    app.add_handler(CommandHandler("setdest2", set_dest2))
-    app.add_handler(CommandHandler("setdestcaption2", set_destcaption2))
+    # Auto setup commands (numbered aliases map to setup1..setup3)
+    app.add_handler(CommandHandler(["setsource", "setsource1", "setsource2", "setsource3"], set_source))
+    app.add_handler(CommandHandler(["setdest", "setdest1", "setdest2", "setdest3"], set_dest))
+    app.add_handler(CommandHandler(["setdestcaption", "setdestcaption1", "setdestcaption2", "setdestcaption3"], set_destcaption))
+    app.add_handler(CommandHandler(["resetsetup", "resetsetup1", "resetsetup2", "resetsetup3"], reset_setup))
+    app.add_handler(CommandHandler("delsetup", delete_setup_command))
+    app.add_handler(CommandHandler("setfilter", set_filter))
+    app.add_handler(CommandHandler("setkeypattern", set_key_pattern))
 
-    app.add_handler(CommandHandler("setsource3", set_source3))
-    app.add_handler(CommandHandler("setdest3", set_dest3))
-    app.add_handler(CommandHandler("setdestcaption3", set_destcaption3))
-
-    # Reset single setup commands
-    app.add_handler(CommandHandler("resetsetup1", reset_setup1))
-    app.add_handler(CommandHandler("resetsetup2", reset_setup2))
-    app.add_handler(CommandHandler("resetsetup3", reset_setup3))
+    # Delayed forward jobs
+    app.add_handler(CommandHandler("pending", pending_jobs))
+    app.add_handler(CommandHandler("canceljob", cancel_job))
 
     # View setup command
     app.add_handler(CommandHandler("viewsetup", view_setup))   # <<< ADD this line carefully!
 
     # Auto forward and manual upload
     app.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POSTS, auto_handle_channel_post))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(USER_FILE_COMMANDS), user_file_command))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
 
     # Handle callback buttons (for help menu etc.)
     app.add_handler(CallbackQueryHandler(handle_callback))
 
-    app.run_polling()
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+    return app
+
+def main():
+    if SHARD_WORKERS > 1:
+        asyncio.run(run_shard_front(SHARD_WORKERS))
+    elif BOT_MODE == "webhook":
+        asyncio.run(run_webhook(build_application(with_updater=False)))
+    else:
+        build_application().run_polling()
 
 if __name__ == "__main__":
     main()